@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+#
+# Benchmarks. These talk to the same dockerized Mongo as test.py does,
+# in a database of their own.
+#
+
+import cdjbot as bot
+import test
+import dockerip
+import asyncio
+import datetime
+import random
+import time
+import tracemalloc
+import tempfile
+import os
+import json
+
+BENCH_MONGO_URL = dockerip.get_docker_host_mongo_url("cdjbot-bench")
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def make_clean_store(clock, store_class=bot.MongoStore):
+    store = store_class(BENCH_MONGO_URL, clock)
+    store.drop_all_collections()
+    return store
+
+
+#
+# Soak: simulated months of checkins on a VirtualLooper, reporting per-week
+# handler latency and memory so that drift shows up.
+#
+def soak_day_updates(rand, day, users):
+    updates = []
+    for user_id in range(1, users + 1):
+        if rand.random() < 0.3:
+            continue
+        started = day + datetime.timedelta(minutes=rand.randrange(6 * 60, 23 * 60))
+        minutes = rand.choice([15, 30, 45, 60])
+        text = "/ci{} topic {}".format(minutes, rand.randrange(10))
+        updates.append((started, test.make_message_dict(text, user_id=user_id)))
+        ending = rand.random()
+        if ending < 0.6:
+            updates.append((started + datetime.timedelta(minutes=minutes + rand.randrange(10)),
+                            test.make_message_dict("/co", user_id=user_id)))
+        elif ending < 0.7:
+            updates.append((started + datetime.timedelta(minutes=rand.randrange(1, minutes)),
+                            test.make_message_dict("/abort", user_id=user_id)))
+        elif ending < 0.8:
+            updates.append((started + datetime.timedelta(minutes=rand.randrange(1, minutes)),
+                            test.make_message_dict("/cstats", user_id=user_id)))
+        # Everyone else forgets, and leaves it to the reminder and the sweeper.
+    return sorted(updates, key=lambda u: u[0])
+
+
+async def soak(loop, days, users, seed):
+    start = datetime.datetime(2016, 1, 4)
+    looper = bot.VirtualLooper(loop, start)
+    store = make_clean_store(looper)
+    metrics = bot.Metrics()
+    mock_bot = test.make_mock_bot()
+    app = bot.DojoBotApp(mock_bot, store, looper, metrics)
+    sweeper = bot.Sweeper(looper, metrics, store)
+    rand = random.Random(seed)
+
+    tracemalloc.start()
+    print("week  updates  p50(ms)  p99(ms)  records  timers  memory(KB)")
+    latencies = []
+    for d in range(days):
+        day = start + datetime.timedelta(days=d)
+        for when, data in soak_day_updates(rand, day, users):
+            await looper.advance_to(when)
+            began = time.perf_counter()
+            app._dispatch(data)
+            # The handler runs until it finishes or sleeps on its reminder.
+            await asyncio.sleep(0)
+            latencies.append(time.perf_counter() - began)
+        await looper.advance_to(day + datetime.timedelta(days=1))
+        await sweeper.tick()
+        # The mock keeps every call; don't let that count as our growth.
+        mock_bot.reset_mock()
+        if d % 7 == 6:
+            current, peak = tracemalloc.get_traced_memory()
+            print("{:4}  {:7}  {:7.2f}  {:7.2f}  {:7}  {:6}  {:10}".format(
+                d // 7 + 1, len(latencies),
+                percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+                store.record_count(), looper.pending_timers, current // 1024))
+            latencies = []
+    tracemalloc.stop()
+    print(metrics.report())
+
+
+#
+# Replay: feeds a TrafficCapture into a fresh app against the mock bot, at
+# |speed| times the captured pace (0 for as fast as possible). Time inside
+# the app is virtual either way, so reminders fire as they did.
+#
+def compare_summaries(expected, actual):
+    owners = set(expected) | set(actual)
+    diverged = sorted(o for o in owners if expected.get(o) != actual.get(o))
+    print("Diverged owners: {} of {}".format(len(diverged), len(owners)))
+    for o in diverged[:10]:
+        print("  {}: expected {}, got {}".format(o, expected.get(o), actual.get(o)))
+
+
+async def replay(loop, capture_path, speed, backend, summary_out, summary_in):
+    updates = list(bot.TrafficCapture.read(capture_path))
+    if not updates:
+        print("Empty capture.")
+        return
+    start = updates[0][0]
+    looper = bot.VirtualLooper(loop, start)
+    metrics = bot.Metrics()
+    mongo = make_clean_store(looper)
+    store = mongo
+    tmp = tempfile.TemporaryDirectory()
+    if backend == 'journal':
+        store = bot.JournaledStore(mongo, bot.Journal(os.path.join(tmp.name, 'journal')))
+    elif backend != 'mongo':
+        raise ValueError("Unknown backend: {}".format(backend))
+    mock_bot = test.make_mock_bot()
+    app = bot.DojoBotApp(mock_bot, store, looper, metrics)
+
+    latencies = []
+    wall_start = time.perf_counter()
+    for i, (when, data) in enumerate(updates):
+        if speed:
+            ahead = (when - start).total_seconds() / speed - (time.perf_counter() - wall_start)
+            if 0 < ahead:
+                await asyncio.sleep(ahead)
+        await looper.advance_to(when)
+        began = time.perf_counter()
+        app._dispatch(data)
+        await asyncio.sleep(0)
+        latencies.append(time.perf_counter() - began)
+        if backend == 'journal' and i % 100 == 99:
+            await store.flush(looper, metrics)
+        if i % 1000 == 999:
+            mock_bot.reset_mock()
+    if backend == 'journal':
+        await store.flush(looper, metrics)
+    elapsed = time.perf_counter() - wall_start
+
+    print("Updates: {} in {:.2f}s, {:.1f}/s".format(len(updates), elapsed, len(updates) / elapsed))
+    print("Latency(ms): p50={:.2f} p90={:.2f} p99={:.2f} max={:.2f}".format(
+        *[ percentile(latencies, p) * 1000 for p in [0.5, 0.9, 0.99, 1.0] ]))
+    # JSON wants string keys.
+    summary = { str(k): v for k, v in mongo.record_summary().items() }
+    if summary_out:
+        with open(summary_out, 'w') as f:
+            json.dump(summary, f, sort_keys=True)
+    if summary_in:
+        with open(summary_in) as f:
+            compare_summaries(json.load(f), summary)
+    tmp.cleanup()
+
+
+#
+# Handlers: how many updates per second DojoBotApp._handle gets through
+# with test.py's mock bot, against Mongo or against a store which does
+# nothing, to see the per-call overhead of the coroutine stack itself.
+#
+class NullStore(object):
+    def find_user(self, id):
+        return None
+
+    def find_last_open_for(self, owner_id):
+        return None
+
+    def add_record(self, rec, closing=None):
+        return rec.with_id(1)
+
+    def update_record(self, rec, base=None):
+        pass
+
+    def record_stats_weekly(self, owner_id):
+        return bot.RecordStats(0, 0, 0)
+
+    def record_stats_monthly(self, owner_id):
+        return bot.RecordStats(0, 0, 0)
+
+    def find_recent_record_topics(self, owner_id, n):
+        return []
+
+
+async def handlers(loop, count, store_kind):
+    store = NullStore() if store_kind == 'null' else make_clean_store(bot.Looper(loop))
+    app = bot.DojoBotApp(test.make_mock_bot(), store, test.FakeLooper())
+    texts = [ "/ci15 topic", "/cstats", "/co" ]
+    began = time.perf_counter()
+    for i in range(count):
+        await app._handle(test.make_message_dict(texts[i % len(texts)], user_id=i % 100))
+    elapsed = time.perf_counter() - began
+    print("Handled {} updates in {:.2f}s, {:.0f}/s".format(count, elapsed, count / elapsed))
+
+
+#
+# Api: per-message sendMessage latency against test.py's local fake Bot API
+# server, on the pooled session and with a fresh connection per call. There
+# is no TLS or real round trip here, so against api.telegram.org the saving
+# is larger than what this shows.
+#
+async def api_latencies(url, count, keepalive):
+    metrics = bot.Metrics()
+    target = bot.DojoBot('TOKEN', metrics, url, keepalive=keepalive)
+    latencies = []
+    for i in range(count):
+        began = time.perf_counter()
+        await target.sendMessage(test.USER_ID, "hello {}".format(i))
+        latencies.append(time.perf_counter() - began)
+    await target.close()
+    print("{}: p50={:.3f}ms p99={:.3f}ms, connections created={} reused={}".format(
+        "keepalive" if keepalive else "no keepalive",
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+        metrics.count('bot.connections.created'), metrics.count('bot.connections.reused')))
+    return latencies
+
+
+async def api(loop, count):
+    server = test.FakeBotApi()
+    await server.start()
+    fresh = await api_latencies(server.url, count, False)
+    pooled = await api_latencies(server.url, count, True)
+    await server.stop()
+    print("Saved per message: {:.3f}ms".format(
+        (sum(fresh) / len(fresh) - sum(pooled) / len(pooled)) * 1000))
+
+
+#
+# Spans: not a benchmark as such, but where the time of each command goes,
+# from a CDJBOT_TRACE_PATH file. For every span name under the updates of
+# a command, the time it takes per update and its share of the update.
+#
+async def spans(loop, path):
+    by_trace = {}
+    for span in bot.SpanFile.read(path):
+        by_trace.setdefault(span['traceId'], []).append(span)
+    by_command = {}
+    for trace in by_trace.values():
+        roots = [ s for s in trace if 'parentId' not in s and s['name'] == 'update' ]
+        if roots:
+            by_command.setdefault(roots[0]['tags'].get('command'), []).append((roots[0], trace))
+    for command, updates in sorted(by_command.items()):
+        durations = [ root['duration'] / 1000 for root, trace in updates ]
+        print("{}: n={} p50={:.2f}ms p99={:.2f}ms".format(
+            command, len(updates), percentile(durations, 0.5), percentile(durations, 0.99)))
+        per_name = {}
+        for root, trace in updates:
+            for s in trace:
+                if s is not root:
+                    per_name[s['name']] = per_name.get(s['name'], 0) + s['duration'] / 1000
+        total = sum(durations)
+        for name, ms in sorted(per_name.items(), key=lambda i: -i[1]):
+            print("  {:32} {:8.2f}ms/update {:5.0%}".format(
+                name, ms / len(updates), ms / total if total else 0))
+
+
+#
+# Events: write path latency of checkins and checkouts, against MongoStore
+# updating records and buckets in place, and against EventStore appending
+# to its log. The projection is timed separately, as the Projector runs it
+# off the write path.
+#
+def write_latencies(store, count):
+    checkins, checkouts = [], []
+    for i in range(count):
+        began = time.perf_counter()
+        rec = store.add_record(test.make_record_with_text("/ci15 topic {}".format(i % 10), user_id=i % 100))
+        checkins.append(time.perf_counter() - began)
+        began = time.perf_counter()
+        store.update_record(rec.with_closed(), rec)
+        checkouts.append(time.perf_counter() - began)
+    return checkins, checkouts
+
+
+async def events(loop, count):
+    for store_class in [ bot.MongoStore, bot.EventStore ]:
+        store = make_clean_store(bot.Looper(loop), store_class)
+        checkins, checkouts = write_latencies(store, count)
+        print("{}: checkin p50={:.3f}ms p99={:.3f}ms, checkout p50={:.3f}ms p99={:.3f}ms".format(
+            store_class.__name__,
+            percentile(checkins, 0.5) * 1000, percentile(checkins, 0.99) * 1000,
+            percentile(checkouts, 0.5) * 1000, percentile(checkouts, 0.99) * 1000))
+    began = time.perf_counter()
+    applied = 0
+    while True:
+        n = store.project()
+        applied += n
+        if n < store.PROJECT_BATCH_SIZE:
+            break
+    elapsed = time.perf_counter() - began
+    print("Projected {} events in {:.2f}s, {:.0f}/s".format(applied, elapsed, applied / elapsed))
+
+
+BENCHMARKS = {
+    'events': lambda loop, options: events(loop, options.count),
+    'spans': lambda loop, options: spans(loop, options.spans),
+    'api': lambda loop, options: api(loop, options.count),
+    'handlers': lambda loop, options: handlers(loop, options.count, options.store),
+    'soak': lambda loop, options: soak(loop, options.days, options.users, options.seed),
+    'replay': lambda loop, options: replay(
+        loop, options.capture, 0 if options.speed == 'max' else float(options.speed),
+        options.backend, options.summary_out, options.compare),
+}
+
+if __name__ == "__main__":
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options] {}".format("|".join(sorted(BENCHMARKS))))
+    parser.add_option("--days", dest="days", type="int", default=90,
+                      help="Simulated days for soak")
+    parser.add_option("--users", dest="users", type="int", default=50,
+                      help="Simulated users for soak")
+    parser.add_option("--seed", dest="seed", type="int", default=1,
+                      help="Random seed")
+    parser.add_option("--count", dest="count", type="int", default=10000,
+                      help="Updates for handlers, messages for api, sessions for events")
+    parser.add_option("--store", dest="store", default="null",
+                      help="Store for handlers: null or mongo")
+    parser.add_option("--capture", dest="capture",
+                      help="Capture file (CDJBOT_CAPTURE_PATH) to replay")
+    parser.add_option("--speed", dest="speed", default="max",
+                      help="Replay pace: 'max', or a multiple of the captured pace")
+    parser.add_option("--backend", dest="backend", default="mongo",
+                      help="Store to replay against: mongo or journal")
+    parser.add_option("--summary-out", dest="summary_out",
+                      help="Write the final store summary here")
+    parser.add_option("--compare", dest="compare",
+                      help="Compare the final store against a summary from an earlier replay")
+    parser.add_option("--spans", dest="spans",
+                      help="Span file (CDJBOT_TRACE_PATH) for spans")
+    parser.add_option("--uvloop", dest="uvloop", default=False, action="store_true",
+                      help="Run on uvloop")
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or args[0] not in BENCHMARKS:
+        parser.error("Pick one of: {}".format(", ".join(sorted(BENCHMARKS))))
+
+    if options.uvloop:
+        import uvloop
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.new_event_loop()
+    loop.run_until_complete(BENCHMARKS[args[0]](loop, options))
+    loop.close()
@@ -1,4 +1,4 @@
 #!/bin/bash
-virtualenv -p python3 env
+python3 -m venv env
 . ./env/bin/activate
 pip3 install -r requirements.txt
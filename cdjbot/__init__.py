@@ -1,13 +1,29 @@
-import telepot
-import telepot.async
-import telepot.namedtuple as nt
+import aiohttp
 import collections
 import re
 import datetime
 import pymongo
 import functools as ft
 import asyncio
-import dateutil.parser as dp
+import time
+import os
+import bson
+import bson.json_util
+import contextlib
+import heapq
+import itertools
+import gzip
+import hashlib
+import hmac
+import json
+import copy
+import cProfile
+import io
+import pstats
+import threading
+import tracemalloc
+import contextvars
+import random
 
 # Has side effect here. Shouldn't we do this or don't we care?
 def rename_mongo_dict_id(d):
@@ -23,9 +39,28 @@ def drop_dict_id_for_mongo(d):
     return d
 
 
+# |minutes| is planned, |actual_minutes| is from started_at to finished_at,
+# both for closed records only.
 class RecordStats(collections.namedtuple(
-        'RecordStatsBase', ['minutes', 'close_count', 'abort_count'])):
-    pass
+        'RecordStatsBase', ['minutes', 'close_count', 'abort_count', 'actual_minutes'],
+        defaults=[0])):
+    HEATMAP_LEVELS = [ (30, '\u2591'), (60, '\u2592'), (120, '\u2593'), (None, '\u2588') ]
+    WEEKDAYS = [ 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun' ]
+
+    @classmethod
+    def of(cls, records):
+        stats = [ 0, 0, 0, 0 ]
+        for r in records:
+            if r.state == Record.CLOSED:
+                stats[0] += r.planned_minutes or 0
+                stats[1] += 1
+                stats[3] += r.actual_minutes()
+            elif r.state == Record.ABORTED:
+                stats[2] += 1
+        return RecordStats(*stats)
+
+    def merge(self, other):
+        return RecordStats(*[ a + b for a, b in zip(self, other) ])
 
     @classmethod
     def format_weekly_monthly(cls, wstats, mstats):
@@ -38,6 +73,25 @@ Monthly: {} CI, Spent {}.
 """.format(wstats.close_count, to_hhmm(wstats.minutes),
            mstats.close_count, to_hhmm(mstats.minutes)).strip()
 
+    # |by_day| maps days to RecordStats. One row per weekday, one column
+    # per week from |begin|, shaded by actual minutes.
+    @classmethod
+    def format_heatmap(cls, by_day, begin, weeks):
+        def shade(stats):
+            if not stats or not stats.actual_minutes:
+                return '\u00b7'
+            return next(c for limit, c in cls.HEATMAP_LEVELS
+                        if limit is None or stats.actual_minutes < limit)
+        rows = [ "Actual minutes for {} weeks from {:%Y-%m-%d}:".format(weeks, begin) ]
+        for wd, name in enumerate(cls.WEEKDAYS):
+            rows.append("{} {}".format(name, "".join(
+                shade(by_day.get(begin + datetime.timedelta(days=w * 7 + wd)))
+                for w in range(weeks))))
+        total = ft.reduce(RecordStats.merge, by_day.values(), RecordStats(0, 0, 0))
+        rows.append("{} CI, {} minutes planned, {} actual".format(
+            total.close_count, total.minutes, total.actual_minutes))
+        return "\n".join(rows)
+
 
 #
 # Checkin record to persist.
@@ -50,21 +104,28 @@ class Record(collections.namedtuple(
     OPEN = 'open'
     CLOSED = 'closed'
     ABORTED = 'aborted'
+    # Anything longer is a typo, and far enough out overflows datetime.
+    MAX_PLANNED_MINUTES = 24 * 60
 
     @classmethod
     def _minutes_from_command(cls, command):
         m = re.search("/ci(\\d+)", command)
-        return int(m.group(1)) if m else None
+        return cls._sane_minutes(int(m.group(1))) if m else None
 
     @classmethod
     def _minutes_from_args(cls, args):
         if len(args) < 2:
             return None
         try:
-            return int(args[1])
+            return cls._sane_minutes(int(args[1]))
         except ValueError:
             return None
 
+    # None, to be asked again, unless 0 < |minutes| <= MAX_PLANNED_MINUTES.
+    @classmethod
+    def _sane_minutes(cls, minutes):
+        return minutes if 0 < minutes <= cls.MAX_PLANNED_MINUTES else None
+
     @classmethod
     def _topic_from_message(cls, message):
         if message.command == "/ci":
@@ -76,7 +137,7 @@ class Record(collections.namedtuple(
             return None
 
     @classmethod
-    def from_message(cls, message):
+    def from_message(cls, message, now=None):
         minutes = cls._minutes_from_command(message.command)
         if not minutes:
             minutes = cls._minutes_from_args(message.args)
@@ -84,7 +145,7 @@ class Record(collections.namedtuple(
         return Record(id=None,
                       owner_id=message.sender_id,
                       owner_name=message.sender_name,
-                      started_at=datetime.datetime.utcnow(),
+                      started_at=now or datetime.datetime.utcnow(),
                       finished_at=None,
                       planned_minutes=minutes,
                       topic=topic,
@@ -102,26 +163,82 @@ class Record(collections.namedtuple(
     def with_planned_minutes(self, minutes):
         if minutes <= 0:
             raise ValueError("Negative Number")
+        if self.MAX_PLANNED_MINUTES < minutes:
+            raise ValueError("Too Long")
         return self._replace(planned_minutes=minutes)
 
-    def with_closed(self):
+    def with_closed(self, now=None):
         return self._replace(
-            finished_at=datetime.datetime.utcnow(),
+            finished_at=now or datetime.datetime.utcnow(),
             state=self.CLOSED)
 
-    def with_aborted(self):
+    def with_aborted(self, now=None):
         return self._replace(
-            finished_at=datetime.datetime.utcnow(),
+            finished_at=now or datetime.datetime.utcnow(),
             state=self.ABORTED)
 
+    # For sessions nobody has closed. These finish when they were planned to.
+    def with_expired(self, close):
+        return self._replace(
+            finished_at=self.planned_until(),
+            state=self.CLOSED if close else self.ABORTED)
+
+    # Records from before MAX_PLANNED_MINUTES may have planned longer.
+    def planned_until(self):
+        return self.started_at + datetime.timedelta(
+            minutes=min(self.planned_minutes, self.MAX_PLANNED_MINUTES))
+
+    # Whole minutes between starting and finishing, 0 while still open.
+    def actual_minutes(self):
+        if not self.finished_at:
+            return 0
+        return max(int((self.finished_at - self.started_at).total_seconds() // 60), 0)
+
     @classmethod
     def from_dict(cls, d):
         return Record(**rename_mongo_dict_id(d))
 
     def to_dict(self):
-        # http://stackoverflow.com/questions/26180528/python-named-tuple-to-dictionary
-        d = vars(super()) or super()._asdict()
-        return drop_dict_id_for_mongo(d)
+        return drop_dict_id_for_mongo(self._asdict())
+
+    # Only the fields which differ from |base|, so that updates don't
+    # rewrite the whole document.
+    def diff(self, base):
+        mine = self.to_dict()
+        theirs = base.to_dict()
+        return { k: v for k, v in mine.items() if theirs.get(k) != v }
+
+    # Fields touched by with_closed() and with_aborted().
+    def finish_dict(self):
+        return { 'finished_at': self.finished_at, 'state': self.state }
+
+
+#
+# A page of records found by MongoStore.search_records(), and the stats of
+# all the records found.
+#
+class SearchResult(collections.namedtuple(
+        'SearchResultBase', ['query', 'records', 'count', 'stats', 'page', 'page_size'])):
+
+    @property
+    def pages(self):
+        return (self.count + self.page_size - 1) // self.page_size
+
+    @property
+    def has_more(self):
+        return self.page + 1 < self.pages
+
+    def format(self):
+        if not self.count:
+            return "Nothing about \"{}\" yet.".format(self.query)
+        lines = [ "\"{}\": {} sessions, {} CI, Spent {:02}:{:02} ({} minutes actual)".format(
+            self.query, self.count, self.stats.close_count,
+            int(self.stats.minutes / 60), self.stats.minutes % 60, self.stats.actual_minutes) ]
+        for r in self.records:
+            lines.append("{:%Y-%m-%d %H:%M} {}m {} ({})".format(
+                r.started_at, r.planned_minutes or '?', r.topic, r.state))
+        lines.append("Page {} of {}".format(self.page + 1, self.pages))
+        return "\n".join(lines)
 
 
 class User(object):
@@ -152,14 +269,484 @@ class User(object):
         return User(d['telegram'], d['located'])
 
 
-# A mockable asyncio.loop wrapper
+# A mockable asyncio.loop wrapper. It is also the clock.
 class Looper(object):
     def __init__(self, loop):
         self._loop = loop
 
-    @asyncio.coroutine
-    def sleep(self, seconds):
-        return asyncio.sleep(seconds, self._loop)
+    def now(self):
+        return datetime.datetime.utcnow()
+
+    async def sleep(self, seconds):
+        return await asyncio.sleep(seconds)
+
+    # For blocking calls like the ones to pymongo.
+    async def run_in_executor(self, fn, *args):
+        # Executor threads don't get our context, and with it the current span.
+        return await self._loop.run_in_executor(None, contextvars.copy_context().run, fn, *args)
+
+    def create_task(self, coro):
+        return self._loop.create_task(coro)
+
+    def current_task(self):
+        return asyncio.current_task(loop=self._loop)
+
+    async def wait(self, tasks, timeout):
+        return await asyncio.wait(tasks, timeout=timeout)
+
+
+#
+# Looper on simulated time, for long-horizon tests and benchmarks. sleep()
+# returns only once advance_to() moves the clock past its deadline, so
+# weeks of traffic can run in seconds. Whoever wakes up gets one loop
+# iteration to run before the next timer fires, which is enough for code
+# that only blocks on sleep() and the executor-free store.
+#
+class VirtualLooper(Looper):
+    def __init__(self, loop, now):
+        super().__init__(loop)
+        self._now = now
+        self._timers = []
+        self._seq = itertools.count()
+
+    def now(self):
+        return self._now
+
+    async def sleep(self, seconds):
+        deadline = self._now + datetime.timedelta(seconds=seconds)
+        waiter = self._loop.create_future()
+        heapq.heappush(self._timers, (deadline, next(self._seq), waiter))
+        await waiter
+
+    async def advance_to(self, when):
+        while self._timers and self._timers[0][0] <= when:
+            deadline, i, waiter = heapq.heappop(self._timers)
+            self._now = max(self._now, deadline)
+            if not waiter.done():
+                waiter.set_result(None)
+                await asyncio.sleep(0)
+        self._now = max(self._now, when)
+
+    @property
+    def pending_timers(self):
+        return len(self._timers)
+
+
+#
+# Process-local counters and timings.
+#
+class Metrics(object):
+    def __init__(self):
+        self._counters = collections.Counter()
+        self._timings = {}
+
+    def incr(self, name, n=1):
+        self._counters[name] += n
+
+    def observe(self, name, seconds):
+        count, total, worst = self._timings.get(name, (0, 0.0, 0.0))
+        self._timings[name] = (count + 1, total + seconds, max(worst, seconds))
+
+    def count(self, name):
+        return self._counters[name]
+
+    def report(self):
+        lines = [ "{}: {}".format(k, v) for k, v in sorted(self._counters.items()) ]
+        for k, (count, total, worst) in sorted(self._timings.items()):
+            lines.append("{}: n={} avg={:.3f}s max={:.3f}s".format(
+                k, count, total / count, worst))
+        return "\n".join(lines)
+
+
+#
+# Spans for seeing where an update spends its time. The current span is a
+# context variable, so spans nest across awaits within a task, and into
+# tasks and executor calls started from it. Nothing is recorded until
+# there is somewhere to write them: see Tracer.start().
+#
+class Span(object):
+    def __init__(self, tracer, name, tags):
+        self._tracer = tracer
+        self.name = name
+        self.tags = tags
+        self.trace_id = None
+        self.id = '{:016x}'.format(random.getrandbits(64))
+        self.parent_id = None
+        self.timestamp = None
+        self.duration = None
+        self._token = None
+
+    def __enter__(self):
+        parent = self._tracer.current.get()
+        if parent:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.id
+        else:
+            self.trace_id = '{:032x}'.format(random.getrandbits(128))
+        self.timestamp = time.time()
+        self._started = time.perf_counter()
+        self._token = self._tracer.current.set(self)
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.duration = time.perf_counter() - self._started
+        self._tracer.current.reset(self._token)
+        if value is not None:
+            self.tags['error'] = repr(value)
+        self._tracer.finished(self)
+        return False
+
+    # Zipkin v2 JSON, which a collector takes as is.
+    def to_dict(self):
+        found = {
+            'traceId': self.trace_id,
+            'id': self.id,
+            'name': self.name,
+            'timestamp': int(self.timestamp * 1e6),
+            'duration': int(self.duration * 1e6),
+            'localEndpoint': { 'serviceName': Tracer.SERVICE_NAME },
+            'tags': { k: str(v) for k, v in self.tags.items() },
+        }
+        if self.parent_id:
+            found['parentId'] = self.parent_id
+        return found
+
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        return False
+
+
+class Tracer(object):
+    SERVICE_NAME = 'cdjbot'
+    NULL_SPAN = NullSpan()
+
+    def __init__(self):
+        self.current = contextvars.ContextVar('cdjbot_span', default=None)
+        self._export = None
+
+    # |export| gets every finished span, possibly from an executor thread.
+    def start(self, export):
+        self._export = export
+
+    def stop(self):
+        self._export = None
+
+    def span(self, name, **tags):
+        if not self._export:
+            return self.NULL_SPAN
+        return Span(self, name, tags)
+
+    def finished(self, span):
+        export = self._export
+        if export:
+            export(span)
+
+
+tracer = Tracer()
+
+
+# Runs the decorated function, or coroutine function, in a span of |name|.
+def traced(name):
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @ft.wraps(fn)
+            async def traced_coro(*args, **kwargs):
+                with tracer.span(name):
+                    return await fn(*args, **kwargs)
+            return traced_coro
+
+        @ft.wraps(fn)
+        def traced_fn(*args, **kwargs):
+            with tracer.span(name):
+                return fn(*args, **kwargs)
+        return traced_fn
+    return decorate
+
+
+#
+# Appends finished spans to a JSONL file, one Zipkin v2 span a line.
+# "jq -s ." makes it something to POST to a collector's /api/v2/spans.
+#
+class SpanFile(object):
+    FLUSH_EVERY = 100
+
+    def __init__(self, path):
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+        self._unflushed = 0
+
+    def __call__(self, span):
+        line = json.dumps(span.to_dict())
+        with self._lock:
+            self._file.write(line + '\n')
+            self._unflushed += 1
+            if self.FLUSH_EVERY <= self._unflushed:
+                self._file.flush()
+                self._unflushed = 0
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    @classmethod
+    def read(cls, path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Torn by a crash.
+                    continue
+
+
+#
+# Where startup time goes. Phases may overlap when they run concurrently.
+#
+class StartupTimer(object):
+    def __init__(self, started=None):
+        self._started = started or time.monotonic()
+        self._phases = []
+
+    def record(self, name, seconds):
+        self._phases.append((name, seconds))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - started)
+
+    async def timed(self, name, coro):
+        with self.phase(name):
+            return await coro
+
+    def report(self):
+        lines = [ "{}: {:.3f}s".format(name, seconds) for name, seconds in self._phases ]
+        lines.append("total: {:.3f}s".format(time.monotonic() - self._started))
+        return "\n".join(lines)
+
+
+#
+# A file which exists only while the bot is up and serving, for the
+# container health check and the upstart post-start script to look at.
+#
+class ReadinessProbe(object):
+    def __init__(self, path):
+        self._path = path
+
+    def ready(self, report=""):
+        with open(self._path, 'w') as f:
+            f.write(report)
+
+    def clear(self):
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+
+#
+# Something to run every |interval| seconds, off the request path.
+#
+class BackgroundJob(object):
+    NAME = 'job'
+
+    def __init__(self, looper, metrics, interval):
+        self._looper = looper
+        self._metrics = metrics
+        self._interval = interval
+        self._running = None
+        self._ticking = False
+        self._stopping = False
+
+    async def run(self):
+        self._running = self._looper.current_task()
+        while not self._stopping:
+            await self._looper.sleep(self._interval)
+            self._ticking = True
+            try:
+                await self.tick()
+            finally:
+                self._ticking = False
+
+    # Returns once run() has. A tick in progress gets to finish, as
+    # cancelling it wouldn't reach what it runs in the executor.
+    async def stop(self):
+        self._stopping = True
+        if not self._running:
+            return
+        if not self._ticking:
+            self._running.cancel()
+        try:
+            await self._running
+        except asyncio.CancelledError:
+            pass
+
+    async def tick(self):
+        started = time.monotonic()
+        try:
+            with tracer.span(self.NAME):
+                await self.run_once()
+        except Exception as e:
+            self._metrics.incr(self.NAME + '.errors')
+            print("{} failed: {}".format(self.NAME, e))
+        self._metrics.observe(self.NAME, time.monotonic() - started)
+
+    async def run_once(self):
+        raise Exception("Should never be called.")
+
+
+class MetricsReporter(BackgroundJob):
+    NAME = 'metrics_reporter'
+
+    # |label| tells apart the reports of several tenants.
+    def __init__(self, looper, metrics, interval, label=None):
+        super().__init__(looper, metrics, interval)
+        self._label = label
+
+    async def run_once(self):
+        report = self._metrics.report()
+        print("[{}]\n{}".format(self._label, report) if self._label else report)
+
+
+#
+# Opt-in diagnostics. With |profile_every| N, one update in N runs under
+# cProfile, adding up into a single profile for ProfileReporter to dump.
+# Memory is only traced from the first memory_diff() on. Both cost next
+# to nothing until then.
+#
+class Diagnostics(object):
+    TRACEMALLOC_FRAMES = 5
+
+    # Drives a coroutine with |profile| enabled only while it runs, and not
+    # while it waits, so that other updates don't end up in the profile.
+    class Steps(object):
+        def __init__(self, coro, profile):
+            self._coro = coro
+            self._profile = profile
+
+        def __await__(self):
+            value, error = None, None
+            while True:
+                self._profile.enable()
+                try:
+                    if error:
+                        waiting = self._coro.throw(error)
+                    else:
+                        waiting = self._coro.send(value)
+                except StopIteration as e:
+                    return e.value
+                finally:
+                    self._profile.disable()
+                try:
+                    value, error = (yield waiting), None
+                except GeneratorExit:
+                    self._coro.close()
+                    raise
+                except BaseException as e:
+                    value, error = None, e
+
+    def __init__(self, profile_every=0, admin_ids=()):
+        self._profile_every = profile_every
+        self._admin_ids = frozenset(admin_ids)
+        self._profile = cProfile.Profile() if profile_every else None
+        self._updates = 0
+        self._profiled = 0
+        # memory_diff() runs in the executor, and may be asked for twice.
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def is_admin(self, user_id):
+        return user_id in self._admin_ids
+
+    # Returns |coro| as is, or wrapped to be profiled if it's sampled.
+    def profiled(self, coro):
+        if not self._profile_every:
+            return coro
+        self._updates += 1
+        if self._updates % self._profile_every:
+            return coro
+        self._profiled += 1
+        return self._run_profiled(coro)
+
+    async def _run_profiled(self, coro):
+        return await self.Steps(coro, self._profile)
+
+    # Dumps the profile so far to |path| if given, and returns the top of it.
+    def profile_report(self, path=None, limit=25):
+        if not self._profiled:
+            return "Profiled 0 of {} updates".format(self._updates)
+        out = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=out)
+        if path:
+            stats.dump_stats(path)
+        stats.sort_stats('cumulative').print_stats(limit)
+        return "Profiled {} of {} updates\n{}".format(self._profiled, self._updates, out.getvalue())
+
+    # Blocking. What grew since the previous call, starting to trace if
+    # nobody has yet.
+    def memory_diff(self, limit=10):
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.TRACEMALLOC_FRAMES)
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__) ])
+            previous, self._snapshot = self._snapshot, snapshot
+        if not previous:
+            return "Tracing allocations from now on. Ask again to see what grew."
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [ "Traced {} KB, peak {} KB. Top growth:".format(current // 1024, peak // 1024) ]
+        lines.extend(str(s) for s in snapshot.compare_to(previous, 'lineno')[:limit])
+        return "\n".join(lines)
+
+
+class ProfileReporter(BackgroundJob):
+    NAME = 'profile_reporter'
+
+    def __init__(self, looper, metrics, diagnostics, interval, path=None):
+        super().__init__(looper, metrics, interval)
+        self._diagnostics = diagnostics
+        self._path = path
+
+    async def run_once(self):
+        print(self._diagnostics.profile_report(self._path))
+
+
+#
+# Expires sessions nobody came back to close, for example because the
+# reminder was lost in a restart.
+#
+class Sweeper(BackgroundJob):
+    NAME = 'sweeper'
+    ABORT = 'abort'
+    CLOSE = 'close'
+
+    def __init__(self, looper, metrics, store, interval=300,
+                 grace_minutes=60, policy=ABORT, batch_size=100, max_batches=10):
+        super().__init__(looper, metrics, interval)
+        if policy not in [self.ABORT, self.CLOSE]:
+            raise ValueError("Unknown sweep policy: {}".format(policy))
+        self._store = store
+        self._grace = datetime.timedelta(minutes=grace_minutes)
+        self._close = policy == self.CLOSE
+        self._batch_size = batch_size
+        self._max_batches = max_batches
+
+    async def run_once(self):
+        for i in range(self._max_batches):
+            expired = await self._looper.run_in_executor(
+                self._store.expire_abandoned_records,
+                self._grace, self._close, self._batch_size)
+            self._metrics.incr('sweeper.batches')
+            self._metrics.incr('sweeper.expired', expired)
+            if expired < self._batch_size:
+                break
 
 
 #
@@ -167,17 +754,27 @@ class Looper(object):
 #
 class Conversation(object):
     def __init__(self, bot, store, looper, msg):
+        self._setup(bot, store, looper, msg.sender_id)
+
+    def _setup(self, bot, store, looper, owner_id):
         self._bot = bot
         self._store = store
         self._looper = looper
-        self._user = store.find_user(msg.sender_id)
+        self._user = store.find_user(owner_id)
+
+    # What it takes to pick up where we left off in another process.
+    def to_state(self):
+        return None
 
-    @asyncio.coroutine
-    def follow(self, update_message):
+    # The record see_you_later() is going to ask about, if any.
+    @property
+    def reminder(self):
+        return None
+
+    async def follow(self, update_message):
         raise Exception("Should never be called.")
 
-    @asyncio.coroutine
-    def see_you_later(self):
+    async def see_you_later(self):
         pass
 
     @property
@@ -193,79 +790,102 @@ class CheckinConversation(Conversation):
     MINUTES = 'minutes'
 
     @classmethod
-    @asyncio.coroutine
-    def start(cls, bot, store, looper, init_message):
-        ongoing = store.find_last_open_for(init_message.sender_id)
-        if ongoing:
-            store.update_record(ongoing.with_closed())
+    async def start(cls, bot, store, looper, init_message):
         c = cls(bot, store, looper, init_message)
-        yield from c._carry()
+        await c._carry()
         return c
 
     def __init__(self, bot, store, looper, init_message):
         super().__init__(bot, store, looper, init_message)
 
         self._asking = None
-        self._record = Record.from_message(init_message)
-        self._stats = store.record_stats_weekly(init_message.sender_id)
+        self._record = Record.from_message(init_message, looper.now())
+        # The ongoing session is closed as of now, but it is written
+        # together with the new record once we know everything about it.
+        ongoing = store.find_last_open_for(init_message.sender_id)
+        self._closing = ongoing.with_closed(looper.now()) if ongoing else None
+        self._stats = None
 
-    @asyncio.coroutine
-    def _finish(self):
+    @traced('checkin.finish')
+    async def _finish(self):
         self._asking = None
-        self._record = self._store.add_record(self._record)
+        self._record = self._store.add_record(self._record, closing=self._closing)
+        self._closing = None
+        self._stats = self._store.record_stats_weekly(self._record.owner_id)
         if self._user:
-            yield from self._bot.declare_checkin(self._user.chat_id, self._record, self._stats)
-        yield from self._bot.declare_checkin(self._record.owner_id, self._record, self._stats)
+            await self._bot.declare_checkin(self._user.chat_id, self._record, self._stats)
+        await self._bot.declare_checkin(self._record.owner_id, self._record, self._stats)
 
-    @asyncio.coroutine
-    def _ask(self):
+    @traced('checkin.ask')
+    async def _ask(self):
         if not self._record.topic:
             suggs = self._store.find_recent_record_topics(self._record.owner_id, 5)
             if suggs:
-                yield from self._bot.ask_topic_with_suggestions(self._record, [ [s] for s in suggs ])
+                await self._bot.ask_topic_with_suggestions(self._record, [ [s] for s in suggs ])
             else:
-                yield from self._bot.ask_topic(self._record)
+                await self._bot.ask_topic(self._record)
             self._asking = self.TOPIC
         elif not self._record.planned_minutes:
-            yield from self._bot.ask_minutes(self._record)
+            await self._bot.ask_minutes(self._record)
             self._asking = self.MINUTES
 
-    @asyncio.coroutine
-    def _handle(self, message):
+    async def _handle(self, message):
         if self._asking == self.TOPIC and message.text:
             self._record = self._record.with_topic(message.text)
         elif self._asking == self.MINUTES and message.text:
             try:
                 self._record = self._record.with_planned_minutes(int(message.text))
             except ValueError:
-                yield from self._bot.tell_error(self._record.owner_id, "Doesn't seem like a number :-(")
+                await self._bot.tell_error(self._record.owner_id, "Doesn't seem like a number :-(")
         else:
-            yield from self._bot.tell_error(self._record.owner_id, "Something wrong happened :-(")
+            await self._bot.tell_error(self._record.owner_id, "Something wrong happened :-(")
             self._record = None
 
-    @asyncio.coroutine
-    def _carry(self):
+    async def _carry(self):
         if self.needs_more:
-            yield from self._ask()
+            await self._ask()
         else:
-            yield from self._finish()
+            await self._finish()
 
     @property
     def key(self):
         return self._record.owner_id
 
-    @asyncio.coroutine
-    def follow(self, update_message):
-        yield from self._handle(update_message)
-        yield from self._carry()
+    async def follow(self, update_message):
+        await self._handle(update_message)
+        await self._carry()
 
-    @asyncio.coroutine
-    def see_you_later(self):
+    def to_state(self):
+        return {
+            'record': self._record._asdict(),
+            'asking': self._asking,
+            'closing': self._closing._asdict() if self._closing else None
+        }
+
+    @classmethod
+    def from_state(cls, bot, store, looper, state):
+        c = cls.__new__(cls)
+        record = Record(**state['record'])
+        c._setup(bot, store, looper, record.owner_id)
+        c._record = record
+        c._asking = state['asking']
+        c._closing = Record(**state['closing']) if state['closing'] else None
+        c._stats = None
+        return c
+
+    @property
+    def reminder(self):
+        return self._record
+
+    async def see_you_later(self):
         owner_id = self._record.owner_id
-        yield from self._looper.sleep(self._record.planned_minutes * 60)
-        ongoing = self._store.find_last_open_for(owner_id)
-        if ongoing and ongoing.id == self._record.id:
-            yield from self._bot.ask_checkout(owner_id)
+        # Not always planned_minutes: the reminder may come from a previous process.
+        left = self._record.planned_until() - self._looper.now()
+        await self._looper.sleep(max(left.total_seconds(), 0))
+        with tracer.span('checkin.remind'):
+            ongoing = self._store.find_last_open_for(owner_id)
+            if ongoing and ongoing.id == self._record.id:
+                await self._bot.ask_checkout(owner_id)
 
     @property
     def needs_more(self):
@@ -274,14 +894,13 @@ class CheckinConversation(Conversation):
 
 class ClosingConversation(Conversation):
     @classmethod
-    @asyncio.coroutine
-    def start(cls, bot, store, looper, init_message):
+    async def start(cls, bot, store, looper, init_message):
         c = cls(bot, store, looper, init_message)
         rec = c._store.find_last_open_for(init_message.sender_id)
         if not rec:
-            yield from c._bot.tell_error(init_message.sender_id, "No ongoing checkin :-(")
+            await c._bot.tell_error(init_message.sender_id, "No ongoing checkin :-(")
         else:
-            yield from c._close(rec)
+            await c._close(rec)
         return c
 
 
@@ -289,21 +908,20 @@ class ClosingConversation(Conversation):
 # Checkout
 #
 class CheckoutConversation(ClosingConversation):
-    @asyncio.coroutine
-    def _close(self, rec):
-        self._store.update_record(rec.with_closed())
-        yield from self._bot.declare_checkout(rec)
+    @traced('checkout.close')
+    async def _close(self, rec):
+        self._store.update_record(rec.with_closed(self._looper.now()), rec)
+        await self._bot.declare_checkout(rec)
         wstats = self._store.record_stats_weekly(rec.owner_id)
         mstats = self._store.record_stats_monthly(rec.owner_id)
-        yield from self._bot.tell_stats(rec.owner_id, RecordStats.format_weekly_monthly(wstats, mstats))
+        await self._bot.tell_stats(rec.owner_id, RecordStats.format_weekly_monthly(wstats, mstats))
 
 
 class QuitConversation(Conversation):
     @classmethod
-    @asyncio.coroutine
-    def start(cls, bot, store, looper, init_message):
+    async def start(cls, bot, store, looper, init_message):
         c = cls(bot, store, looper, init_message)
-        yield from bot.ack_quit(init_message.sender_id)
+        await bot.ack_quit(init_message.sender_id)
         return c
 
 
@@ -311,152 +929,1484 @@ class QuitConversation(Conversation):
 # Abort
 #
 class AbortConversation(ClosingConversation):
-    @asyncio.coroutine
-    def _close(self, rec):
-        self._store.update_record(rec.with_aborted())
-        yield from self._bot.declare_abort(rec)
+    @traced('abort.close')
+    async def _close(self, rec):
+        self._store.update_record(rec.with_aborted(self._looper.now()), rec)
+        await self._bot.declare_abort(rec)
 
 #
 # Quick Statistics
 #
 class StatConversation(Conversation):
     @classmethod
-    @asyncio.coroutine
-    def start(cls, bot, store, looper, init_message):
+    async def start(cls, bot, store, looper, init_message):
         c = cls(bot, store, looper, init_message)
         owner = init_message.sender_id
         wstats = store.record_stats_weekly(owner)
         mstats = store.record_stats_monthly(owner)
-        yield from bot.tell_stats(owner, RecordStats.format_weekly_monthly(wstats, mstats))
+        await bot.tell_stats(owner, RecordStats.format_weekly_monthly(wstats, mstats))
+        return c
+
+
+class HistoryConversation(Conversation):
+    WEEKS = 12
+
+    @classmethod
+    async def start(cls, bot, store, looper, init_message):
+        c = cls(bot, store, looper, init_message)
+        owner = init_message.sender_id
+        begin = store.beginning_of_this_week(looper.now()) - datetime.timedelta(weeks=cls.WEEKS - 1)
+        by_day = store.record_days(owner, begin)
+        await bot.tell_stats(owner, RecordStats.format_heatmap(by_day, begin, cls.WEEKS))
+        return c
+
+
+#
+# /search <words>, then "more" for the next page while there is one.
+#
+class SearchConversation(Conversation):
+    MORE = 'more'
+
+    @classmethod
+    async def start(cls, bot, store, looper, init_message):
+        c = cls(bot, store, looper, init_message)
+        c._owner_id = init_message.sender_id
+        c._query = " ".join(init_message.args[1:])
+        c._result = None
+        if not c._query:
+            await bot.tell_error(c._owner_id, "Search for what? /search <words>")
+        else:
+            await c._tell(0)
+        return c
+
+    async def _tell(self, page):
+        self._result = self._store.search_records(self._owner_id, self._query, page)
+        await self._bot.tell_search_results(self._owner_id, self._result)
+
+    async def follow(self, update_message):
+        if update_message.text.strip().lower() == self.MORE:
+            await self._tell(self._result.page + 1)
+        else:
+            self._result = None
+            await self._bot.tell_error(
+                self._owner_id, "Stopped searching for \"{}\". /search <words> to look again.".format(self._query))
+
+    @property
+    def needs_more(self):
+        return bool(self._result and self._result.has_more)
+
+
+class ReportConversation(Conversation):
+    @classmethod
+    async def start(cls, bot, store, looper, init_message, reports):
+        c = cls(bot, store, looper, init_message)
+        owner_id = init_message.sender_id
+        chat_id = init_message.chat_id
+        if chat_id:
+            # Everyone who said /iamhere in this group.
+            owner_ids = set(u.telegram_id for u in store.find_users_in_chat(chat_id))
+            owner_ids.add(owner_id)
+            report = await reports.report_for(looper, ('chat', chat_id), owner_ids)
+            await bot.tell_report(chat_id, report.format())
+        else:
+            report = await reports.report_for(looper, ('user', owner_id), [ owner_id ])
+            await bot.tell_report(owner_id, report.format())
+        return c
+
+
+class MemoryDiffConversation(Conversation):
+    @classmethod
+    async def start(cls, bot, store, looper, init_message, diagnostics):
+        c = cls(bot, store, looper, init_message)
+        text = await looper.run_in_executor(diagnostics.memory_diff)
+        await bot.sendMessage(init_message.sender_id, text)
         return c
 
 
 class LocatingConversation(Conversation):
     @classmethod
-    @asyncio.coroutine
-    def start(cls, bot, store, looper, init_message):
+    async def start(cls, bot, store, looper, init_message):
         c = cls(bot, store, looper, init_message)
         owner_id = init_message.sender_id
         owner_name = init_message.sender_name
         chat_title = init_message.chat_title
         chat_id = init_message.chat_id
         if not chat_id:
-            yield from bot.tell_error(owner_id, "Use this command from within a group!")
+            await bot.tell_error(owner_id, "Use this command from within a group!")
             return c
         store.upsert_user(User(init_message.sender_dict, init_message.chat_dict))
-        yield from bot.tell_where_you_are(owner_id, owner_name, chat_id, chat_title)
+        await bot.tell_where_you_are(owner_id, owner_name, chat_id, chat_title)
         return c
 
 
+#
+# Moves finished records out of the hot collection once they are older
+# than |horizon_days|. Stats come from the daily buckets, which cover the
+# archive too, but topic suggestions only look at the hot collection.
+#
+class Archiver(BackgroundJob):
+    NAME = 'archiver'
+    MIN_HORIZON_DAYS = 32
+
+    def __init__(self, looper, metrics, store, interval=3600,
+                 horizon_days=90, batch_size=500, max_batches=10):
+        super().__init__(looper, metrics, interval)
+        if horizon_days < self.MIN_HORIZON_DAYS:
+            raise ValueError("Archive horizon should be at least {} days".format(
+                self.MIN_HORIZON_DAYS))
+        self._store = store
+        self._horizon = datetime.timedelta(days=horizon_days)
+        self._batch_size = batch_size
+        self._max_batches = max_batches
+
+    async def run_once(self):
+        for i in range(self._max_batches):
+            horizon = self._looper.now() - self._horizon
+            archived = await self._looper.run_in_executor(
+                self._store.archive_records, horizon, self._batch_size)
+            self._metrics.incr('archiver.batches')
+            self._metrics.incr('archiver.archived', archived)
+            if archived < self._batch_size:
+                break
+
+
 #
 # Mongo-backed Data Storage
 #
 class MongoStore(object):
     COL_RECORD = 'records'
     COL_USERS = 'users'
-    BEGINNING = dp.parse('2000-01-01 00:00:00')
+    COL_ARCHIVE = 'records_archive'
+    COL_DAYS = 'record_days'
+    COL_STATE = 'app_state'
+    BEGINNING = datetime.datetime(2000, 1, 1)
+    # How many times add_record() retries when it races with another checkin.
+    OPEN_RETRY_LIMIT = 3
+    DUPLICATE_KEY = 11000
+    # Fail fast rather than blocking the handler for pymongo's default 30s.
+    SERVER_SELECTION_TIMEOUT_MS = 5000
+    STREAM_BATCH_SIZE = 1000
+    PRIMARY = 'primary'
+    SECONDARY = 'secondary'
+    # The least MongoDB takes. secondaryPreferred keeps a single node working.
+    MAX_STALENESS_SECONDS = 90
+    READ_PREFERENCES = {
+        PRIMARY: pymongo.ReadPreference.PRIMARY,
+        SECONDARY: pymongo.read_preferences.SecondaryPreferred(
+            max_staleness=MAX_STALENESS_SECONDS),
+    }
+    # Where each read goes, and how long it may take in seconds. Reads which
+    # can live with some staleness go to secondaries. find_last_open_for()
+    # decides what a command acts on, so it stays on the primary.
+    READ_ROUTES = {
+        'find_last_open_for': (PRIMARY, 2),
+        'record_stats': (SECONDARY, 5),
+        'record_days': (SECONDARY, 5),
+        'find_recent_record_topics': (SECONDARY, 2),
+        'find_user': (SECONDARY, 2),
+        'find_users_in_chat': (SECONDARY, 5),
+        'search_records': (SECONDARY, 5),
+        # Runs in the executor for /report, and may take a while. A cursor
+        # outlives any one call, so this bounds its time on the server.
+        'stream_record_fields': (SECONDARY, 60),
+    }
+    # Record fields which the daily buckets depend on.
+    DAY_FIELDS = frozenset([ 'state', 'started_at', 'finished_at', 'planned_minutes' ])
+    SEARCH_PAGE_SIZE = 10
+    # RecordStats of the records found, plus how many there are.
+    SEARCH_GROUP = {
+        '_id': None,
+        'count': { '$sum': 1 },
+        'minutes': { '$sum': {
+            '$cond': [ { '$eq': [ '$state', Record.CLOSED ] }, '$planned_minutes', 0 ] } },
+        'close_count': { '$sum': { '$cond': [ { '$eq': [ '$state', Record.CLOSED ] }, 1, 0 ] } },
+        'abort_count': { '$sum': { '$cond': [ { '$eq': [ '$state', Record.ABORTED ] }, 1, 0 ] } },
+        # Record.actual_minutes(), from milliseconds.
+        'actual_minutes': { '$sum': { '$cond': [
+            { '$eq': [ '$state', Record.CLOSED ] },
+            { '$max': [ 0, { '$floor': { '$divide': [
+                { '$subtract': [ '$finished_at', '$started_at' ] }, 60000 ] } } ] },
+            0 ] } },
+    }
 
     @classmethod
     def _align_to_day(cls, d):
         return datetime.datetime(d.year, d.month, d.day)
     @classmethod
-    def beginning_of_this_week(cls):
-        now = datetime.datetime.utcnow()
+    def beginning_of_this_week(cls, now=None):
+        now = now or datetime.datetime.utcnow()
         return cls._align_to_day(now - datetime.timedelta(days=now.weekday()))
 
     @classmethod
-    def beginning_of_this_month(cls):
-        now = datetime.datetime.utcnow()
-        return cls._align_to_day(now - datetime.timedelta(days=now.day))
+    def beginning_of_this_month(cls, now=None):
+        now = now or datetime.datetime.utcnow()
+        return cls._align_to_day(now - datetime.timedelta(days=now.day - 1))
 
-    def __init__(self, url):
-        self._client = pymongo.MongoClient(url)
-        self._db = self._client.get_default_database()
+    @classmethod
+    def make_client(cls, url):
+        return pymongo.MongoClient(url, serverSelectionTimeoutMS=cls.SERVER_SELECTION_TIMEOUT_MS)
+
+    # |clock| is anything with now(), usually the Looper. Stores can share
+    # a |client|, and with it its connection pool, each in its own
+    # |database|. Without one it's the database named in |url|.
+    def __init__(self, url, clock=None, client=None, database=None):
+        self._clock = clock or Looper(None)
+        self._client = client or self.make_client(url)
+        self._db = self._client[database] if database else self._client.get_default_database()
         self._records = self._db[self.COL_RECORD]
         self._users = self._db[self.COL_USERS]
-
-    @asyncio.coroutine
-    def print_description(self):
+        self._archive = self._db[self.COL_ARCHIVE]
+        self._days = self._db[self.COL_DAYS]
+        self._state = self._db[self.COL_STATE]
+        self._listeners = []
+        # (collection name, mode) -> Collection with that read preference
+        self._routed = {}
+        # owner_id -> time.monotonic() of their last write, for those within
+        # MAX_STALENESS_SECONDS or not much longer.
+        self._written_at = {}
+        self._written_lock = threading.Lock()
+        self._pruned_at = time.monotonic()
+        # Whether backfill_record_days() is done, once it is.
+        self._days_filled = False
+
+    # Blocking. The constructor doesn't touch the network; this does.
+    @traced('store.connect')
+    def connect(self):
+        self._client.admin.command('ping')
+        self._ensure_indexes()
+
+    def _ensure_indexes(self):
+        # At most one open session per owner. This is what keeps concurrent
+        # checkins from the same user from leaving two sessions open.
+        self._close_duplicate_opens()
+        self._records.create_index(
+            [ ('owner_id', pymongo.ASCENDING) ],
+            name='one_open_per_owner', unique=True,
+            partialFilterExpression={ 'state': Record.OPEN })
+        # For the sweeper to find stale open sessions.
+        self._records.create_index(
+            [ ('state', pymongo.ASCENDING), ('started_at', pymongo.ASCENDING) ],
+            name='state_started_at')
+        # For per-owner history: recent topics and analytics.
+        self._records.create_index(
+            [ ('owner_id', pymongo.ASCENDING), ('started_at', pymongo.ASCENDING) ],
+            name='owner_started_at')
+        self._archive.create_index(
+            [ ('owner_id', pymongo.ASCENDING), ('started_at', pymongo.ASCENDING) ],
+            name='owner_started_at')
+        # For /search. The owner_id prefix keeps each search to one user's
+        # records. Topics come in any language, so no stemming or stop words.
+        for collection in [ self._records, self._archive ]:
+            collection.create_index(
+                [ ('owner_id', pymongo.ASCENDING), ('topic', pymongo.TEXT) ],
+                name='owner_topic', default_language='none')
+        self._days.create_index(
+            [ ('owner_id', pymongo.ASCENDING), ('day', pymongo.ASCENDING) ], name='owner_day')
+        # A database without records has no buckets to backfill.
+        if not self._records.find_one() and not self._archive.find_one():
+            self._state.replace_one({ '_id': self.COL_DAYS }, { '_id': self.COL_DAYS }, upsert=True)
+
+    # Closes all but the latest open session of each owner, which versions
+    # from before one_open_per_owner could leave behind, and which would
+    # keep it from being built. Each one ends when the next one started.
+    def _close_duplicate_opens(self):
+        for found in self._records.aggregate([
+                { '$match': { 'state': Record.OPEN } },
+                { '$sort': { 'started_at': pymongo.DESCENDING } },
+                { '$group': { '_id': '$owner_id', 'opens': { '$push': {
+                    'id': '$_id', 'started_at': '$started_at' } } } } ]):
+            opens = found['opens']
+            for newer, older in zip(opens, opens[1:]):
+                self._records.update_one(
+                    { '_id': older['id'], 'state': Record.OPEN },
+                    { '$set': { 'finished_at': newer['started_at'], 'state': Record.CLOSED } })
+                self._update_day(found['_id'], older['started_at'])
+            if 1 < len(opens):
+                print("Closed {} duplicate open sessions of {}".format(len(opens) - 1, found['_id']))
+
+    async def print_description(self):
         print("DB Name: {}".format(self._db.name))
 
     # This is MongoStore specific, used from unit tests.
     def drop_all_collections(self):
         self._db.drop_collection(self.COL_RECORD)
         self._db.drop_collection(self.COL_USERS)
+        self._db.drop_collection(self.COL_ARCHIVE)
+        self._db.drop_collection(self.COL_DAYS)
+        self._db.drop_collection(self.COL_STATE)
+        self._ensure_indexes()
+
+    # |listener| is called with the owner_id of every record which is added
+    # or changed. It may be called from an executor thread.
+    def add_change_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _changed(self, owner_id):
+        self.mark_written(owner_id)
+        for listener in self._listeners:
+            listener(owner_id)
+
+    # Sends reads about |owner_id| to the primary for a while. Writers
+    # which don't go through this store, like JournaledStore, call this
+    # when they take a write.
+    def mark_written(self, owner_id):
+        now = time.monotonic()
+        with self._written_lock:
+            self._written_at[owner_id] = now
+            if self._pruned_at + self.MAX_STALENESS_SECONDS < now:
+                horizon = now - self.MAX_STALENESS_SECONDS
+                self._written_at = { o: t for o, t in self._written_at.items() if horizon < t }
+                self._pruned_at = now
+
+    # Returns the mode and timeout for |op|. Owners who wrote something
+    # within the staleness bound read from the primary, so that they see
+    # their own writes, say the stats right after /co.
+    def _route(self, op, owner_ids=()):
+        mode, timeout = self.READ_ROUTES[op]
+        if mode == self.SECONDARY:
+            horizon = time.monotonic() - self.MAX_STALENESS_SECONDS
+            if any(horizon < self._written_at.get(o, horizon) for o in owner_ids):
+                mode = self.PRIMARY
+        return mode, timeout
+
+    def _routed_collection(self, collection, mode):
+        key = (collection.name, mode)
+        found = self._routed.get(key)
+        if not found:
+            found = collection.with_options(read_preference=self.READ_PREFERENCES[mode])
+            self._routed[key] = found
+        return found
+
+    @contextlib.contextmanager
+    def _reading(self, op, collection, *owner_ids):
+        mode, timeout = self._route(op, owner_ids)
+        with pymongo.timeout(timeout):
+            yield self._routed_collection(collection, mode)
 
-    def add_record(self, rec):
-        result = self._records.insert_one(rec.to_dict())
-        return rec.with_id(result.inserted_id)
-
+    @classmethod
+    def _is_duplicate_open(cls, error):
+        return any(e['code'] == cls.DUPLICATE_KEY
+                   for e in error.details.get('writeErrors', []))
+
+    # Inserts |rec|. If |closing| is given, the open session it came from is
+    # closed in the same ordered bulk write. Whichever session is open when
+    # |rec| is, closing or not, gets closed in its favor, as /ci does. A
+    # record which already has an id is inserted with it, and adding it
+    # again is a no-op.
+    @traced('store.add_record')
+    def add_record(self, rec, closing=None):
+        for i in range(self.OPEN_RETRY_LIMIT):
+            doc = rec.to_dict()
+            if rec.id:
+                doc['_id'] = rec.id
+            requests = []
+            if closing:
+                requests.append(pymongo.UpdateOne(
+                    { '_id': closing.id, 'state': Record.OPEN },
+                    { '$set': closing.finish_dict() }))
+            requests.append(pymongo.InsertOne(doc))
+            try:
+                self._records.bulk_write(requests, ordered=True)
+                self._added(rec, closing)
+                return rec.with_id(doc['_id'])
+            except pymongo.errors.BulkWriteError as e:
+                if rec.id and self._records.find_one({ '_id': rec.id }, { '_id': 1 }):
+                    # The buckets may not have made it the first time.
+                    self._added(rec, closing)
+                    return rec
+                if not self._is_duplicate_open(e):
+                    raise
+                # Someone else opened a session in between, or before an
+                # outage which |rec| was journaled through. Close that one
+                # when |rec| started, as read from the primary which just
+                # refused us.
+                found = self._records.find_one({ 'owner_id': rec.owner_id, 'state': Record.OPEN })
+                if found:
+                    ongoing = Record.from_dict(found)
+                    closing = ongoing.with_closed(max(rec.started_at, ongoing.started_at))
+                else:
+                    closing = None
+        raise RuntimeError("Gave up checking in {}".format(rec.owner_id))
+
+    def _added(self, rec, closing):
+        if closing:
+            self._update_day(closing.owner_id, closing.started_at)
+        if rec.state != Record.OPEN:
+            self._update_day(rec.owner_id, rec.started_at)
+        self._changed(rec.owner_id)
+
+    @traced('store.find_last_open_for')
     def find_last_open_for(self, owner_id):
-        cursor = self._records.find({ 'owner_id': owner_id, 'state': Record.OPEN })
-        found = ft.reduce(lambda a,i: i, cursor, None)
+        with self._reading('find_last_open_for', self._records, owner_id) as records:
+            found = records.find_one({ 'owner_id': owner_id, 'state': Record.OPEN })
         return Record.from_dict(found) if found else None
 
-    def update_record(self, rec):
-        self._records.update_one({"_id": rec.id }, { "$set": rec.to_dict() })
+    # Sends only the fields which changed from |base| when it's given.
+    def update_record(self, rec, base=None):
+        fields = rec.diff(base) if base else rec.to_dict()
+        if fields:
+            self.update_record_fields(rec.id, fields)
+
+    @traced('store.update_record_fields')
+    def update_record_fields(self, id, fields):
+        found = self._records.find_one_and_update(
+            { "_id": id }, { "$set": fields }, projection={ 'owner_id': 1, 'started_at': 1 })
+        if not found:
+            return
+        if self.DAY_FIELDS.intersection(fields):
+            self._update_day(found['owner_id'], fields.get('started_at', found['started_at']))
+        self._changed(found['owner_id'])
+
+    # Closes (or aborts) up to |limit| open sessions which were planned to
+    # finish more than |grace| ago. Returns how many were expired.
+    @traced('store.expire_abandoned_records')
+    def expire_abandoned_records(self, grace, close, limit):
+        requests = []
+        days = set()
+        for rec in self._abandoned_records(grace, limit):
+            days.add((rec.owner_id, self._align_to_day(rec.started_at)))
+            requests.append(pymongo.UpdateOne(
+                { '_id': rec.id, 'state': Record.OPEN },
+                { '$set': rec.with_expired(close).finish_dict() }))
+        if not requests:
+            return 0
+        expired = self._records.bulk_write(requests, ordered=False).modified_count
+        for owner_id, day in days:
+            self._update_day(owner_id, day)
+        for owner_id in set(owner_id for owner_id, day in days):
+            self._changed(owner_id)
+        return expired
+
+    # Up to |limit| open records which were planned to finish more than
+    # |grace| ago. One which can't tell when that was is skipped rather
+    # than left to fail the sweep for everyone after it.
+    def _abandoned_records(self, grace, limit):
+        horizon = self._clock.now() - grace
+        cursor = self._records.find(
+            { 'state': Record.OPEN, 'started_at': { '$lt': horizon } },
+            sort=[ ('started_at', pymongo.ASCENDING) ])
+        found = 0
+        try:
+            for doc in cursor:
+                try:
+                    rec = Record.from_dict(doc)
+                    if horizon < rec.planned_until():
+                        continue
+                except (TypeError, ValueError, OverflowError) as e:
+                    print("Skipping record {} in the sweep: {}".format(doc.get('_id'), e))
+                    continue
+                yield rec
+                found += 1
+                if limit <= found:
+                    break
+        finally:
+            cursor.close()
 
     def last_record(self):
         # XXX: Super inefficient. Use it only for testing.
         f = ft.reduce(lambda a,i: i, self._records.find(), None)
         return Record.from_dict(f)
 
+    @traced('store.record_count')
     def record_count(self):
-        return self._records.count()
+        return self._records.count_documents({})
 
     def record_stats_weekly(self, owner_id):
-        return self.record_stats(owner_id, self.beginning_of_this_week())
+        return self.record_stats(owner_id, self.beginning_of_this_week(self._clock.now()))
 
     def record_stats_monthly(self, owner_id):
-        return self.record_stats(owner_id, self.beginning_of_this_month())
-
-    def record_stats(self, owner_id, since=BEGINNING):
-        closed_cond = { '$eq': [ '$state', Record.CLOSED ] }
-        aborted_cond = { '$eq': [ '$state', Record.ABORTED ] }
-        found = self._records.aggregate([
-            { '$match': {
-                'owner_id': owner_id,
-                'started_at': { '$gt': since }
-            } },
-            { '$project': {
-                '_id': 0,
-                'minutes': { '$cond': { 'if': closed_cond, 'then': '$planned_minutes', 'else': 0 } },
-                'close_count': { '$cond': { 'if': closed_cond, 'then': 1, 'else': 0 } },
-                'abort_count': { '$cond': { 'if': aborted_cond, 'then': 1, 'else': 0 } },
-            } },
-            { '$group': {
-                '_id': None,
-                'minutes':  { '$sum' : '$minutes' },
-                'close_count': { '$sum' : '$close_count' },
-                'abort_count': { '$sum' : '$abort_count' }
-            } }
-        ])
-
-        agg = [ f for f in found ]
-        if not len(agg):
+        return self.record_stats(owner_id, self.beginning_of_this_month(self._clock.now()))
+
+    # Sums the daily buckets from the day of |since| up to, but not
+    # including, the day of |until|. Archived records are counted as well.
+    # Records started at midnight of |since| count, as the whole day does.
+    @traced('store.record_stats')
+    def record_stats(self, owner_id, since=BEGINNING, until=None):
+        if not self._days_ready():
+            return ft.reduce(RecordStats.merge,
+                             self._scan_days('record_stats', owner_id, since, until).values(),
+                             RecordStats(0, 0, 0))
+        day = { '$gte': self._align_to_day(since) }
+        if until:
+            day['$lt'] = self._align_to_day(until)
+        with self._reading('record_stats', self._days, owner_id) as days:
+            found = list(days.aggregate([
+                { '$match': { 'owner_id': owner_id, 'day': day } },
+                { '$group': dict({ '_id': None }, **{
+                    f: { '$sum': '$' + f } for f in RecordStats._fields }) }
+            ]))
+        if not found:
             return RecordStats(0, 0, 0)
-        return RecordStats(agg[0]['minutes'], agg[0]['close_count'], agg[0]['abort_count'])
-
+        return RecordStats(*[ found[0][f] for f in RecordStats._fields ])
+
+    # day -> RecordStats for the days in [|since|, |until|) with anything in them.
+    @traced('store.record_days')
+    def record_days(self, owner_id, since, until=None):
+        if not self._days_ready():
+            return self._scan_days('record_days', owner_id, since, until)
+        day = { '$gte': self._align_to_day(since) }
+        if until:
+            day['$lt'] = self._align_to_day(until)
+        with self._reading('record_days', self._days, owner_id) as days:
+            return { f['day']: RecordStats(*[ f[k] for k in RecordStats._fields ])
+                     for f in days.find({ 'owner_id': owner_id, 'day': day }) }
+
+    # Until backfill_record_days() is done, buckets are missing whatever
+    # finished before they were there.
+    def _days_ready(self):
+        if not self._days_filled:
+            self._days_filled = bool(self._state.find_one({ '_id': self.COL_DAYS }))
+        return self._days_filled
+
+    # What the buckets would say, from the records themselves.
+    def _scan_days(self, op, owner_id, since, until):
+        started_at = { '$gte': self._align_to_day(since) }
+        if until:
+            started_at['$lt'] = self._align_to_day(until)
+        found = {}
+        for collection in [ self._records, self._archive ]:
+            with self._reading(op, collection, owner_id) as routed:
+                for f in routed.find({ 'owner_id': owner_id, 'started_at': started_at }):
+                    rec = Record.from_dict(f)
+                    found[rec.id] = rec
+        by_day = collections.defaultdict(list)
+        for rec in found.values():
+            by_day[self._align_to_day(rec.started_at)].append(rec)
+        return { day: RecordStats.of(recs) for day, recs in by_day.items() }
+
+    # Recomputes the bucket of |owner_id| for the day of |when| from its
+    # records, hot and archived. That makes it safe to redo at any time,
+    # including while the same records are being archived. The bucket is
+    # written only if no one else wrote it since we read its version, or
+    # a recomputation from records read before theirs could win over it;
+    # otherwise we read again.
+    @traced('store.update_day')
+    def _update_day(self, owner_id, when):
+        begin = self._align_to_day(when)
+        key = { 'owner_id': owner_id, 'day': begin }
+        match = {
+            'owner_id': owner_id,
+            'started_at': { '$gte': begin, '$lt': begin + datetime.timedelta(days=1) } }
+        while True:
+            current = self._days.find_one({ '_id': key }, { 'version': 1 })
+            found = {}
+            for collection in [ self._records, self._archive ]:
+                for f in collection.find(match):
+                    rec = Record.from_dict(f)
+                    found[rec.id] = rec
+            version = current.get('version') if current else None
+            bucket = dict(RecordStats.of(found.values())._asdict(), _id=key,
+                          version=(version or 0) + 1, **key)
+            try:
+                if not current:
+                    self._days.insert_one(bucket)
+                    return
+                if self._days.replace_one({ '_id': key, 'version': version }, bucket).matched_count:
+                    return
+            except pymongo.errors.DuplicateKeyError:
+                pass
+
+    # Fills the buckets for records from before they existed. Returns how
+    # many buckets were computed, 0 once it's been done.
+    @traced('store.backfill_record_days')
+    def backfill_record_days(self):
+        if self._state.find_one({ '_id': self.COL_DAYS }):
+            return 0
+        days = set()
+        for collection in [ self._records, self._archive ]:
+            for f in collection.find({ 'state': { '$ne': Record.OPEN } },
+                                     { 'owner_id': 1, 'started_at': 1 }):
+                days.add((f['owner_id'], self._align_to_day(f['started_at'])))
+        for owner_id, day in days:
+            self._update_day(owner_id, day)
+        self._state.replace_one({ '_id': self.COL_DAYS }, { '_id': self.COL_DAYS }, upsert=True)
+        self._days_filled = True
+        return len(days)
+
+    # Moves up to |limit| finished records started before |horizon| to the
+    # archive. Each step can be re-run after a crash: archived copies are
+    # idempotent, and the hot copy goes away last. The daily buckets don't
+    # change, as they count each record once wherever it is.
+    @traced('store.archive_records')
+    def archive_records(self, horizon, limit):
+        found = list(self._records.find(
+            { 'state': { '$in': [ Record.CLOSED, Record.ABORTED ] },
+              'started_at': { '$lt': horizon } },
+            sort=[ ('started_at', pymongo.ASCENDING) ], limit=limit))
+        if not found:
+            return 0
+        try:
+            self._archive.insert_many(found, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            # Left over by a run which didn't get to delete them.
+            if not all(w['code'] == self.DUPLICATE_KEY for w in e.details['writeErrors']):
+                raise
+        self._records.delete_many({ '_id': { '$in': [ f['_id'] for f in found ] } })
+        return len(found)
+
+    # Yields just |fields| of every record, hot and archived, owned by one
+    # of |owner_ids|, without loading them all at once.
+    def stream_record_fields(self, owner_ids, fields):
+        owner_ids = list(owner_ids)
+        match = { 'owner_id': { '$in': owner_ids } }
+        projection = dict({ f: 1 for f in fields }, _id=0)
+        mode, timeout = self._route('stream_record_fields', owner_ids)
+        for collection in [ self._records, self._archive ]:
+            cursor = self._routed_collection(collection, mode).find(
+                match, projection, batch_size=self.STREAM_BATCH_SIZE, max_time_ms=timeout * 1000)
+            try:
+                yield from cursor
+            finally:
+                cursor.close()
+
+    # Records of |owner_id| with any of the words of |query| in their topic,
+    # newest first, hot ones before archived ones. Each collection takes one
+    # aggregation for both its part of the page and its stats.
+    @traced('store.search_records')
+    def search_records(self, owner_id, query, page=0, page_size=SEARCH_PAGE_SIZE):
+        skip = page * page_size
+        records, count, stats = [], 0, RecordStats(0, 0, 0)
+        for collection in [ self._records, self._archive ]:
+            facets = { 'stats': [ { '$group': self.SEARCH_GROUP } ] }
+            if len(records) < page_size:
+                facets['page'] = [
+                    { '$sort': { 'started_at': pymongo.DESCENDING, '_id': pymongo.DESCENDING } },
+                    { '$skip': max(skip - count, 0) },
+                    { '$limit': page_size - len(records) } ]
+            pipeline = [ { '$match': self._search_match(owner_id, query) } ]
+            if collection is self._records:
+                # Archiving copies a record before it deletes the hot one,
+                # so it can be in both for a while. It counts as archived.
+                pipeline += [
+                    { '$lookup': { 'from': self.COL_ARCHIVE, 'localField': '_id',
+                                   'foreignField': '_id', 'as': 'archived' } },
+                    { '$match': { 'archived': [] } },
+                    { '$project': { 'archived': 0 } } ]
+            with self._reading('search_records', collection, owner_id) as c:
+                found = next(c.aggregate(pipeline + [ { '$facet': facets } ]))
+            records.extend(Record.from_dict(f) for f in found.get('page', []))
+            if found['stats']:
+                count += found['stats'][0]['count']
+                stats = stats.merge(RecordStats(*[ found['stats'][0][f] for f in RecordStats._fields ]))
+        return SearchResult(query, records, count, stats, page, page_size)
+
+    # What search_records() finds, from the owner_topic text index. Tests
+    # without one have it match otherwise.
+    def _search_match(self, owner_id, query):
+        return { 'owner_id': owner_id, '$text': { '$search': query } }
+
+    @traced('store.find_recent_record_topics')
     def find_recent_record_topics(self, owner_id, n):
-        topics = [
-            i['topic']
-            for i
-            in self._records.find(
-                { 'owner_id': owner_id }, limit=n
-            ).sort('started_at', pymongo.DESCENDING)
-        ]
+        with self._reading('find_recent_record_topics', self._records, owner_id) as records:
+            topics = [
+                i['topic']
+                for i
+                in records.find(
+                    { 'owner_id': owner_id }, limit=n
+                ).sort('started_at', pymongo.DESCENDING)
+            ]
 
         return list(set(topics))
 
+    # For DojoBotApp to hand over to the next process.
+    @traced('store.save_app_state')
+    def save_app_state(self, state):
+        self._state.replace_one({ '_id': 'app' }, dict(state, _id='app'), upsert=True)
+
+    # Returns the saved state once; the next call gets an empty one.
+    @traced('store.take_app_state')
+    def take_app_state(self):
+        found = self._state.find_one_and_delete({ '_id': 'app' })
+        if not found:
+            return {}
+        del found['_id']
+        return found
+
+    # owner_id -> state -> [count, planned minutes], for comparing stores.
+    def record_summary(self):
+        summary = {}
+        for found in self._records.aggregate([
+                { '$group': {
+                    '_id': { 'owner_id': '$owner_id', 'state': '$state' },
+                    'count': { '$sum': 1 },
+                    'minutes': { '$sum': '$planned_minutes' } } } ]):
+            key = found['_id']
+            summary.setdefault(key['owner_id'], {})[key['state']] = [
+                found['count'], found['minutes'] ]
+        return summary
+
+    @traced('store.upsert_user')
     def upsert_user(self, user):
-        return self._users.update_one(
+        found = self._users.update_one(
             { 'telegram.id': user.telegram_id },
             { '$set': user.to_dict() }, upsert=True)
+        self.mark_written(user.telegram_id)
+        return found
 
+    @traced('store.find_user')
     def find_user(self, id):
-        found = self._users.find_one({ 'telegram.id': id })
+        with self._reading('find_user', self._users, id) as users:
+            found = users.find_one({ 'telegram.id': id })
         return User.from_dict(found) if found else None
 
+    @traced('store.find_users_in_chat')
+    def find_users_in_chat(self, chat_id):
+        with self._reading('find_users_in_chat', self._users) as users:
+            return [ User.from_dict(f) for f in users.find({ 'located.id': chat_id }) ]
+
+
+#
+# A MongoStore whose writes are appended to a log of record events. The
+# records, the daily buckets and the topics are projections of that log,
+# which the Projector brings up to date in the background. Reads about an
+# owner with events still pending apply theirs first, so that everyone
+# sees their own writes. An owner's events only touch their own records,
+# buckets and topics, so they can go ahead of everyone else's.
+#
+# Applying an event again is harmless, so after a restart the projector
+# goes back a little before its checkpoint, for events which got their
+# ids just before it but were written after. Within a process, appends
+# are serialized so that ids come in the order they are written. Only
+# one process should write to a database at a time, as with MongoStore.
+#
+class EventStore(MongoStore):
+    COL_EVENTS = 'record_events'
+    COL_TOPICS = 'record_topics'
+    CHECKIN = 'checkin'
+    CHECKOUT = 'checkout'
+    ABORT = 'abort'
+    EXPIRE = 'expire'
+    UPDATE = 'update'
+    # Records from before the log, from backfill_events().
+    IMPORT = 'import'
+    # These only apply to open sessions.
+    FINISHING = frozenset([ CHECKOUT, ABORT, EXPIRE ])
+    # What Record.finish_dict() has.
+    FINISH_FIELDS = frozenset([ 'finished_at', 'state' ])
+    PROJECT_BATCH_SIZE = 500
+    CHECKPOINT_SETTLE_SECONDS = 30
+    CHECKPOINT_ID = 'projector'
+    # How long a read waits for the projector to finish its batch before
+    # it goes ahead without its owner's pending events.
+    CATCH_UP_WAIT_SECONDS = 1
+
+    def __init__(self, url, clock=None, client=None, database=None):
+        super().__init__(url, clock, client, database)
+        self._events = self._db[self.COL_EVENTS]
+        self._topics = self._db[self.COL_TOPICS]
+        self._append_lock = threading.Lock()
+        self._project_lock = threading.Lock()
+        # Id of the last event applied, once read from the checkpoint.
+        self._applied = None
+        self._loaded = False
+        # Until the first catch-up, anything from before a restart may be pending.
+        self._behind = True
+        # owner_id -> id of their last event, until it has been applied
+        self._pending = {}
+        # Ids of events which _catch_up() applied ahead of the projector.
+        self._caught_up = set()
+
+    def _ensure_indexes(self):
+        super()._ensure_indexes()
+        # A record is checked in once, however many times add_record() is
+        # called for it.
+        self._events.create_index(
+            [ ('record_id', pymongo.ASCENDING) ],
+            name='one_checkin_per_record', unique=True,
+            partialFilterExpression={ 'type': self.CHECKIN })
+        # For _catch_up().
+        self._events.create_index(
+            [ ('owner_id', pymongo.ASCENDING), ('_id', pymongo.ASCENDING) ], name='owner_id')
+        self._ensure_topic_index()
+
+    def _ensure_topic_index(self):
+        self._topics.create_index(
+            [ ('owner_id', pymongo.ASCENDING), ('last_started_at', pymongo.DESCENDING) ],
+            name='owner_last_started_at')
+
+    def drop_all_collections(self):
+        self._db.drop_collection(self.COL_EVENTS)
+        self._db.drop_collection(self.COL_TOPICS)
+        super().drop_all_collections()
+        self._applied, self._loaded, self._behind, self._pending = None, False, True, {}
+        self._caught_up = set()
+
+    def _event(self, kind, owner_id, record_id, **payload):
+        return dict(payload, type=kind, owner_id=owner_id, record_id=record_id, at=self._clock.now())
+
+    @traced('store.append_events')
+    def _append(self, events):
+        with self._append_lock:
+            for event in events:
+                event['_id'] = bson.ObjectId()
+                self._pending[event['owner_id']] = event['_id']
+                self.mark_written(event['owner_id'])
+            self._events.insert_many(events, ordered=True)
+
+    # Check-outs and aborts only, as anything else may touch a finished record.
+    def _update_event(self, id, owner_id, fields):
+        kind = self.UPDATE
+        if self.FINISH_FIELDS.issuperset(fields):
+            kind = { Record.CLOSED: self.CHECKOUT, Record.ABORTED: self.ABORT }.get(
+                fields.get('state'), self.UPDATE)
+        return self._event(kind, owner_id, id, fields=fields)
+
+    @traced('store.add_record')
+    def add_record(self, rec, closing=None):
+        rec = rec.with_id(rec.id or bson.ObjectId())
+        events = []
+        if closing:
+            events.append(self._update_event(closing.id, closing.owner_id, closing.finish_dict()))
+        events.append(self._event(
+            self.CHECKIN, rec.owner_id, rec.id, record=dict(rec.to_dict(), _id=rec.id)))
+        try:
+            self._append(events)
+        except pymongo.errors.BulkWriteError as e:
+            # Checked in already. Adding it again is a no-op.
+            if not self._is_duplicate_open(e):
+                raise
+        return rec
+
+    def update_record(self, rec, base=None):
+        fields = rec.diff(base) if base else rec.to_dict()
+        if fields:
+            self._append([ self._update_event(rec.id, rec.owner_id, fields) ])
+
+    # The journal has only the id. The record may not be projected yet.
+    @traced('store.update_record_fields')
+    def update_record_fields(self, id, fields):
+        found = (self._events.find_one({ 'record_id': id, 'type': self.CHECKIN }, { 'owner_id': 1 }) or
+                 self._records.find_one({ '_id': id }, { 'owner_id': 1 }))
+        if found:
+            self._append([ self._update_event(id, found['owner_id'], fields) ])
+
+    # Returns how many sessions were found to expire. Those which were
+    # finished in the meantime are left as they are by the projection.
+    @traced('store.expire_abandoned_records')
+    def expire_abandoned_records(self, grace, close, limit):
+        self._catch_up(*list(self._pending))
+        events = [ self._event(self.EXPIRE, rec.owner_id, rec.id,
+                               fields=rec.with_expired(close).finish_dict())
+                   for rec in self._abandoned_records(grace, limit) ]
+        if events:
+            self._append(events)
+        return len(events)
+
+    def _index_topic(self, owner_id, topic, started_at):
+        if topic:
+            self._topics.update_one(
+                { '_id': { 'owner_id': owner_id, 'topic': topic } },
+                { '$max': { 'last_started_at': started_at },
+                  '$set': { 'owner_id': owner_id, 'topic': topic } },
+                upsert=True)
+
+    # Adds the (owner_id, day) pairs whose buckets |event| changes to |days|.
+    def _apply(self, event, days):
+        owner_id = event['owner_id']
+        if event['type'] in [ self.CHECKIN, self.IMPORT ]:
+            doc = event['record']
+            if event['type'] == self.IMPORT:
+                try:
+                    self._records.update_one(
+                        { '_id': doc['_id'] },
+                        { '$setOnInsert': { k: v for k, v in doc.items() if k != '_id' } },
+                        upsert=True)
+                except pymongo.errors.DuplicateKeyError:
+                    # Its owner has checked in again since.
+                    return
+            else:
+                if doc['state'] == Record.OPEN:
+                    # A checkin ends whatever its owner still had open, as
+                    # add_record() does when it loses a race.
+                    for found in self._records.find(
+                            { 'owner_id': owner_id, 'state': Record.OPEN,
+                              '_id': { '$ne': doc['_id'] } }, { 'started_at': 1 }):
+                        self._records.update_one(
+                            { '_id': found['_id'], 'state': Record.OPEN },
+                            { '$set': { 'finished_at': doc['started_at'], 'state': Record.CLOSED } })
+                        days.add((owner_id, self._align_to_day(found['started_at'])))
+                self._records.replace_one({ '_id': doc['_id'] }, doc, upsert=True)
+            if doc['state'] != Record.OPEN:
+                days.add((owner_id, self._align_to_day(doc['started_at'])))
+            self._index_topic(owner_id, doc.get('topic'), doc['started_at'])
+            return
+        query = { '_id': event['record_id'] }
+        if event['type'] in self.FINISHING:
+            query['state'] = Record.OPEN
+        fields = event['fields']
+        found = self._records.find_one_and_update(
+            query, { '$set': fields }, projection={ 'started_at': 1, 'topic': 1 },
+            return_document=pymongo.ReturnDocument.AFTER)
+        if not found:
+            return
+        if self.DAY_FIELDS.intersection(fields):
+            days.add((owner_id, self._align_to_day(found['started_at'])))
+        if 'topic' in fields:
+            self._index_topic(owner_id, found['topic'], found['started_at'])
+
+    def _read_checkpoint(self):
+        found = self._state.find_one({ '_id': self.CHECKPOINT_ID })
+        if not found:
+            return None
+        return bson.ObjectId.from_datetime(found['applied'].generation_time - datetime.timedelta(
+            seconds=self.CHECKPOINT_SETTLE_SECONDS))
+
+    # Applies up to PROJECT_BATCH_SIZE events to the projections, and
+    # returns how many there were.
+    @traced('store.project')
+    def project(self):
+        with self._project_lock:
+            if not self._loaded:
+                self._applied = self._read_checkpoint()
+                self._loaded = True
+            with self._append_lock:
+                # Everything appended so far has a smaller id.
+                horizon = bson.ObjectId()
+            events = list(self._events.find(
+                { '_id': { '$gt': self._applied } } if self._applied else {},
+                sort=[ ('_id', pymongo.ASCENDING) ], limit=self.PROJECT_BATCH_SIZE))
+            days = set()
+            for event in events:
+                if event['_id'] in self._caught_up:
+                    self._caught_up.discard(event['_id'])
+                else:
+                    self._apply(event, days)
+            for owner_id, day in days:
+                self._update_day(owner_id, day)
+            if events:
+                self._applied = events[-1]['_id']
+                self._state.replace_one(
+                    { '_id': self.CHECKPOINT_ID },
+                    { '_id': self.CHECKPOINT_ID, 'applied': self._applied }, upsert=True)
+            drained = len(events) < self.PROJECT_BATCH_SIZE
+            if drained:
+                self._behind = False
+            applied = horizon if drained else self._applied
+            with self._append_lock:
+                self._pending = { o: i for o, i in self._pending.items() if applied < i }
+        for owner_id in set(e['owner_id'] for e in events):
+            self._changed(owner_id)
+        return len(events)
+
+    # Applies what's pending for |owner_ids| before reading about them: up
+    # to a batch of their events, leaving the checkpoint and everyone else
+    # to the projector. Until the projector has caught up once after a
+    # restart, anyone may have something pending.
+    def _catch_up(self, *owner_ids):
+        owner_ids = [ o for o in owner_ids if self._behind or o in self._pending ]
+        if not owner_ids:
+            return
+        if not self._project_lock.acquire(timeout=self.CATCH_UP_WAIT_SECONDS):
+            print("Reading ahead of the projector for {}".format(owner_ids))
+            return
+        try:
+            if not self._loaded:
+                self._applied = self._read_checkpoint()
+                self._loaded = True
+            with self._append_lock:
+                horizon = bson.ObjectId()
+            match = { 'owner_id': { '$in': owner_ids } }
+            if self._applied:
+                match['_id'] = { '$gt': self._applied }
+            events = [ e for e in self._events.find(
+                           match, sort=[ ('_id', pymongo.ASCENDING) ], limit=self.PROJECT_BATCH_SIZE)
+                       if e['_id'] not in self._caught_up ]
+            days = set()
+            for event in events:
+                self._apply(event, days)
+                self._caught_up.add(event['_id'])
+            for owner_id, day in days:
+                self._update_day(owner_id, day)
+            if len(events) < self.PROJECT_BATCH_SIZE:
+                with self._append_lock:
+                    for owner_id in owner_ids:
+                        if self._pending.get(owner_id, horizon) < horizon:
+                            del self._pending[owner_id]
+        finally:
+            self._project_lock.release()
+        for owner_id in set(e['owner_id'] for e in events):
+            self._changed(owner_id)
+
+    # Drops the projections and applies the whole log again. The log has
+    # archived records too, which then go from the hot ones again. Their
+    # buckets and topics stay. Returns how many events there were.
+    @traced('store.rebuild_projections')
+    def rebuild_projections(self):
+        with self._project_lock:
+            for name in [ self.COL_RECORD, self.COL_DAYS, self.COL_TOPICS ]:
+                self._db.drop_collection(name)
+            self._state.delete_many({ '_id': { '$in': [ self.CHECKPOINT_ID, self.COL_DAYS ] } })
+            super()._ensure_indexes()
+            self._ensure_topic_index()
+            self._applied, self._loaded, self._behind = None, True, True
+            self._caught_up = set()
+            self._days_filled = False
+        applied = 0
+        while True:
+            n = self.project()
+            applied += n
+            if n < self.PROJECT_BATCH_SIZE:
+                break
+        archived = []
+        for found in self._archive.find({}, { '_id': 1 }, batch_size=self.STREAM_BATCH_SIZE):
+            archived.append(found['_id'])
+            if len(archived) == self.PROJECT_BATCH_SIZE:
+                self._records.delete_many({ '_id': { '$in': archived } })
+                archived = []
+        if archived:
+            self._records.delete_many({ '_id': { '$in': archived } })
+        self.backfill_record_days()
+        return applied
+
+    # Imports the records from before the log, once, so that the log has
+    # everything. Returns how many were imported.
+    @traced('store.backfill_events')
+    def backfill_events(self):
+        if self._state.find_one({ '_id': self.COL_EVENTS }):
+            return 0
+        imported = 0
+        batch = []
+        for found in self._records.find({}, batch_size=self.STREAM_BATCH_SIZE):
+            batch.append(self._event(self.IMPORT, found['owner_id'], found['_id'], record=found))
+            if len(batch) == self.PROJECT_BATCH_SIZE:
+                self._append(batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            self._append(batch)
+            imported += len(batch)
+        self._state.replace_one({ '_id': self.COL_EVENTS }, { '_id': self.COL_EVENTS }, upsert=True)
+        return imported
+
+    def find_last_open_for(self, owner_id):
+        self._catch_up(owner_id)
+        return super().find_last_open_for(owner_id)
+
+    def record_stats(self, owner_id, since=MongoStore.BEGINNING, until=None):
+        self._catch_up(owner_id)
+        return super().record_stats(owner_id, since, until)
+
+    def record_days(self, owner_id, since, until=None):
+        self._catch_up(owner_id)
+        return super().record_days(owner_id, since, until)
+
+    def stream_record_fields(self, owner_ids, fields):
+        owner_ids = list(owner_ids)
+        self._catch_up(*owner_ids)
+        yield from super().stream_record_fields(owner_ids, fields)
+
+    def search_records(self, owner_id, query, page=0, page_size=MongoStore.SEARCH_PAGE_SIZE):
+        self._catch_up(owner_id)
+        return super().search_records(owner_id, query, page, page_size)
+
+    # The most recent distinct topics, archived records included.
+    @traced('store.find_recent_record_topics')
+    def find_recent_record_topics(self, owner_id, n):
+        self._catch_up(owner_id)
+        with self._reading('find_recent_record_topics', self._topics, owner_id) as topics:
+            return [ f['topic'] for f in topics.find(
+                { 'owner_id': owner_id }, sort=[ ('last_started_at', pymongo.DESCENDING) ], limit=n) ]
+
+
+class Projector(BackgroundJob):
+    NAME = 'projector'
+
+    def __init__(self, looper, metrics, store, interval=1):
+        super().__init__(looper, metrics, interval)
+        self._store = store
+
+    async def run_once(self):
+        while True:
+            applied = await self._looper.run_in_executor(self._store.project)
+            self._metrics.incr('projector.events', applied)
+            if applied < self._store.PROJECT_BATCH_SIZE:
+                break
+
+
+#
+# Trips after |threshold| consecutive failures, and lets a single call
+# through again every |reset_seconds| until one succeeds.
+#
+class CircuitBreaker(object):
+    def __init__(self, threshold=3, reset_seconds=30):
+        self._threshold = threshold
+        self._reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allows(self):
+        if not self.is_open:
+            return True
+        if time.monotonic() - self._opened_at < self._reset_seconds:
+            return False
+        # This one is the trial. Everyone else waits for another period.
+        self._opened_at = time.monotonic()
+        return True
+
+    def succeeded(self):
+        self._failures = 0
+        self._opened_at = None
+
+    def failed(self):
+        self._failures += 1
+        if self._threshold <= self._failures:
+            self._opened_at = time.monotonic()
+
+
+#
+# Lets through |rate| calls a second, with bursts of up to |burst|. Callers
+# wait their turn in the order they came (this is GCRA), on the looper's
+# clock.
+#
+class RateLimiter(object):
+    def __init__(self, looper, rate, burst=1):
+        self._looper = looper
+        self._interval = datetime.timedelta(seconds=1.0 / rate)
+        self._tolerance = self._interval * (burst - 1)
+        # When the next call would be due at exactly |rate|.
+        self._due = None
+
+    # Returns how long, in seconds, the caller had to wait.
+    async def acquire(self):
+        now = self._looper.now()
+        due = max(self._due or now, now)
+        self._due = due + self._interval
+        wait = (due - self._tolerance - now).total_seconds()
+        if 0 < wait:
+            await self._looper.sleep(wait)
+            return wait
+        return 0
+
+
+#
+# Append-only file of record mutations which haven't made it to the store
+# yet. Entries are flushed to the OS as they're appended, and fsync()ed
+# every |sync_every| entries or whenever sync() is called, so a machine
+# crash can lose at most that window. The sequence number of the last
+# replayed entry lives next to it in a checkpoint file.
+#
+class Journal(object):
+    def __init__(self, path, sync_every=32):
+        self._path = path
+        self._checkpoint_path = path + '.ckpt'
+        self._sync_every = sync_every
+        self._unsynced = 0
+        self._seq = 0
+        self._pending = collections.deque()
+        self._recover()
+        self._file = open(self._path, 'a')
+
+    def _read_checkpoint(self):
+        try:
+            with open(self._checkpoint_path) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_checkpoint(self, seq):
+        tmp = self._checkpoint_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._checkpoint_path)
+
+    def _recover(self):
+        self._seq = self._read_checkpoint()
+        if not os.path.exists(self._path):
+            return
+        with open(self._path) as f:
+            for line in f:
+                try:
+                    entry = bson.json_util.loads(line)
+                except ValueError:
+                    # A torn write at the tail. Everything before it is good.
+                    break
+                if self._seq < entry['seq']:
+                    self._pending.append(entry)
+                    self._seq = entry['seq']
+        # Rewrite what's left so that a torn tail doesn't stay in the way.
+        self._rewrite()
+
+    def _rewrite(self):
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as f:
+            for entry in self._pending:
+                f.write(bson.json_util.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def append(self, entry):
+        self._seq += 1
+        entry = dict(entry, seq=self._seq)
+        self._file.write(bson.json_util.dumps(entry) + "\n")
+        self._file.flush()
+        self._pending.append(entry)
+        self._unsynced += 1
+        if self._sync_every <= self._unsynced:
+            self.sync()
+        return entry
+
+    def sync(self):
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def peek(self, n):
+        return [ e for e, i in zip(self._pending, range(n)) ]
+
+    # Drops entries up to |seq|, which the store now has.
+    def commit(self, seq):
+        while self._pending and self._pending[0]['seq'] <= seq:
+            self._pending.popleft()
+        self._write_checkpoint(seq)
+        if not self._pending:
+            self._file.close()
+            self._rewrite()
+            self._file = open(self._path, 'a')
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+#
+# Write-behind store. Record and user mutations go to the journal and
+# return right away; JournalFlusher replays them to the underlying store in
+# order. Reads go to the underlying store unless the breaker is open, in
+# which case they degrade to empty answers. Open sessions and users which
+# are still in the journal are served from memory so that /co works during
+# an outage. Anything else fails right away while the breaker is open,
+# instead of waiting on server selection.
+#
+class JournaledStore(object):
+    def __init__(self, store, journal, breaker=None):
+        self._store = store
+        self._journal = journal
+        self._breaker = breaker or CircuitBreaker()
+        # owner_id -> (seq, open Record or None)
+        self._open = {}
+        # telegram_id -> (seq, User)
+        self._users = {}
+        for entry in journal.peek(len(journal)):
+            self._track(entry)
+
+    def __getattr__(self, name):
+        found = getattr(self._store, name)
+        return ft.partial(self._call, found) if callable(found) else found
+
+    # These don't touch the network, and shouldn't take the breaker's trial call.
+    def add_change_listener(self, listener):
+        self._store.add_change_listener(listener)
+
+    def mark_written(self, owner_id):
+        self._store.mark_written(owner_id)
+
+    # Errors which the same call may not run into later. pymongo.timeout()
+    # from READ_ROUTES raises ExecutionTimeout, or errors with .timeout set.
+    @classmethod
+    def _is_transient(cls, error):
+        return (isinstance(error, (pymongo.errors.ConnectionFailure,
+                                   pymongo.errors.ExecutionTimeout,
+                                   pymongo.errors.WriteConcernError)) or
+                error.timeout)
+
+    @property
+    def breaker(self):
+        return self._breaker
+
+    def _track(self, entry):
+        if entry['op'] == 'user':
+            user = User.from_dict(entry['user'])
+            self._users[user.telegram_id] = (entry['seq'], user)
+        elif entry['op'] == 'add':
+            rec = Record.from_dict(dict(entry['record']))
+            self._open[rec.owner_id] = (entry['seq'], rec if rec.state == Record.OPEN else None)
+        elif entry['op'] == 'update' and 'state' in entry['fields']:
+            found = self._open.get(entry['owner_id'])
+            rec = found[1] if found else None
+            if entry['fields']['state'] == Record.OPEN:
+                rec = rec._replace(**entry['fields']) if rec else None
+            else:
+                rec = None
+            self._open[entry['owner_id']] = (entry['seq'], rec)
+
+    def _read(self, fallback, fn, *args):
+        if not self._breaker.allows():
+            return fallback
+        try:
+            found = fn(*args)
+        except pymongo.errors.PyMongoError as e:
+            if not self._is_transient(e):
+                raise
+            print("Store read failed: {}".format(e))
+            self._breaker.failed()
+            return fallback
+        self._breaker.succeeded()
+        return found
+
+    # _read() without a fallback: raises ConnectionFailure right away while
+    # the breaker is open.
+    def _call(self, fn, *args, **kwargs):
+        if not self._breaker.allows():
+            raise pymongo.errors.ConnectionFailure("The store is out, per the circuit breaker")
+        try:
+            found = fn(*args, **kwargs)
+        except pymongo.errors.PyMongoError as e:
+            if self._is_transient(e):
+                self._breaker.failed()
+            raise
+        self._breaker.succeeded()
+        return found
+
+    # _read() for generators. Falls back to nothing if the store fails
+    # before the first item; after that, a part of the answer would pass
+    # for all of it, so the error goes to the caller.
+    def _stream(self, fn, *args):
+        if not self._breaker.allows():
+            return
+        started = False
+        try:
+            for item in fn(*args):
+                started = True
+                yield item
+        except pymongo.errors.PyMongoError as e:
+            if not self._is_transient(e):
+                raise
+            print("Store read failed: {}".format(e))
+            self._breaker.failed()
+            if started:
+                raise
+            return
+        self._breaker.succeeded()
+
+    def add_record(self, rec, closing=None):
+        rec = rec if rec.id else rec.with_id(bson.ObjectId())
+        entry = self._journal.append({
+            'op': 'add',
+            'record': dict(rec.to_dict(), _id=rec.id),
+            'closing': dict(closing.to_dict(), _id=closing.id) if closing else None })
+        self._track(entry)
+        self._store.mark_written(rec.owner_id)
+        return rec
+
+    def update_record(self, rec, base=None):
+        fields = rec.diff(base) if base else rec.to_dict()
+        if fields:
+            self._track(self._journal.append({
+                'op': 'update', 'id': rec.id, 'owner_id': rec.owner_id, 'fields': fields }))
+            self._store.mark_written(rec.owner_id)
+
+    def upsert_user(self, user):
+        self._track(self._journal.append({ 'op': 'user', 'user': user.to_dict() }))
+        self._store.mark_written(user.telegram_id)
+
+    def find_last_open_for(self, owner_id):
+        if owner_id in self._open:
+            return self._open[owner_id][1]
+        return self._read(None, self._store.find_last_open_for, owner_id)
+
+    def record_stats(self, owner_id, since=MongoStore.BEGINNING, until=None):
+        return self._read(RecordStats(0, 0, 0), self._store.record_stats, owner_id, since, until)
+
+    def record_stats_weekly(self, owner_id):
+        return self._read(RecordStats(0, 0, 0), self._store.record_stats_weekly, owner_id)
+
+    def record_stats_monthly(self, owner_id):
+        return self._read(RecordStats(0, 0, 0), self._store.record_stats_monthly, owner_id)
+
+    def record_days(self, owner_id, since, until=None):
+        return self._read({}, self._store.record_days, owner_id, since, until)
+
+    def find_recent_record_topics(self, owner_id, n):
+        return self._read([], self._store.find_recent_record_topics, owner_id, n)
+
+    def search_records(self, owner_id, query, page=0, page_size=MongoStore.SEARCH_PAGE_SIZE):
+        return self._read(SearchResult(query, [], 0, RecordStats(0, 0, 0), page, page_size),
+                          self._store.search_records, owner_id, query, page, page_size)
+
+    def stream_record_fields(self, owner_ids, fields):
+        return self._stream(self._store.stream_record_fields, owner_ids, fields)
+
+    def find_user(self, id):
+        if id in self._users:
+            return self._users[id][1]
+        return self._read(None, self._store.find_user, id)
+
+    def find_users_in_chat(self, chat_id):
+        return self._read([], self._store.find_users_in_chat, chat_id)
+
+    def _apply(self, entry):
+        if entry['op'] == 'add':
+            closing = entry['closing']
+            self._store.add_record(
+                Record.from_dict(dict(entry['record'])),
+                closing=Record.from_dict(dict(closing)) if closing else None)
+        elif entry['op'] == 'update':
+            self._store.update_record_fields(entry['id'], entry['fields'])
+        elif entry['op'] == 'user':
+            self._store.upsert_user(User.from_dict(entry['user']))
+
+    # Runs in the executor. Returns the entries which the store refused for
+    # good, and raises on errors which may go away, to be retried. A /ci
+    # journaled while its owner had a session open in the store closes
+    # that session, in add_record().
+    def _apply_all(self, entries):
+        refused = []
+        for entry in entries:
+            try:
+                self._apply(entry)
+            except pymongo.errors.PyMongoError as e:
+                if self._is_transient(e):
+                    raise
+                print("Dropping journal entry {}: {}".format(entry['seq'], e))
+                refused.append(entry)
+        return refused
+
+    async def flush(self, looper, metrics, batch_size=100):
+        self._journal.sync()
+        while len(self._journal) and self._breaker.allows():
+            entries = self._journal.peek(batch_size)
+            try:
+                refused = await looper.run_in_executor(self._apply_all, entries)
+            except pymongo.errors.PyMongoError as e:
+                if not self._is_transient(e):
+                    raise
+                print("Journal flush failed: {}".format(e))
+                self._breaker.failed()
+                metrics.incr('journal.flush_failures')
+                return
+            self._breaker.succeeded()
+            seq = entries[-1]['seq']
+            self._journal.commit(seq)
+            for owner_id, (tracked, rec) in list(self._open.items()):
+                if tracked <= seq:
+                    del self._open[owner_id]
+            for telegram_id, (tracked, user) in list(self._users.items()):
+                if tracked <= seq:
+                    del self._users[telegram_id]
+            metrics.incr('journal.replayed', len(entries))
+            metrics.incr('journal.refused', len(refused))
+
+
+class JournalFlusher(BackgroundJob):
+    NAME = 'journal_flusher'
+
+    def __init__(self, looper, metrics, store, interval=1):
+        super().__init__(looper, metrics, interval)
+        self._store = store
+
+    async def run_once(self):
+        await self._store.flush(self._looper, self._metrics)
+
 
 #
 # Wrapping message JSON dict
@@ -514,28 +2464,373 @@ class Message(object):
 
 
 #
-# Adding some apps pecific sendMessage variants.
+# Taps raw updates into a gzipped JSONL file for bench.py replay. User and
+# chat ids are replaced by a keyed hash so that they stay consistent within
+# a capture without being the real ones, and names go away.
+#
+# tap() only queues the update. Anonymizing, compressing and writing
+# happen in write_pending(), which CaptureWriter runs in the executor.
+#
+class TrafficCapture(object):
+    EPOCH = datetime.datetime(1970, 1, 1)
+    # Updates beyond this many are dropped rather than queued, should the
+    # writer fall behind.
+    MAX_PENDING = 10000
+
+    def __init__(self, path, salt):
+        self._file = gzip.open(path, 'at')
+        self._salt = salt.encode('utf-8')
+        # [(now, update)] which tap() has queued for write_pending().
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.dropped = 0
+
+    def _anonymize_id(self, id):
+        digest = hmac.new(self._salt, str(id).encode('utf-8'), hashlib.sha256).digest()
+        hashed = int.from_bytes(digest[:4], 'big') & 0x7fffffff
+        # Group chats have negative ids, and the app cares.
+        return -hashed if id < 0 else hashed
+
+    def anonymize(self, data):
+        data = copy.deepcopy(data)
+        sender = data.get('from')
+        if sender:
+            sender['id'] = self._anonymize_id(sender['id'])
+            for k in ['first_name', 'last_name', 'firstname']:
+                sender.pop(k, None)
+            sender['username'] = 'user{}'.format(sender['id'])
+        chat = data.get('chat')
+        if chat:
+            chat['id'] = self._anonymize_id(chat['id'])
+            if 'title' in chat:
+                chat['title'] = 'chat{}'.format(chat['id'])
+            for k in ['username', 'first_name', 'last_name']:
+                chat.pop(k, None)
+        return data
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def tap(self, data, now):
+        with self._pending_lock:
+            if self.MAX_PENDING <= len(self._pending):
+                self.dropped += 1
+                return
+            self._pending.append((now, data))
+
+    # Blocking. Returns how many updates were written.
+    def write_pending(self):
+        with self._write_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, []
+            for now, data in pending:
+                self._file.write(json.dumps({
+                    't': (now - self.EPOCH).total_seconds(),
+                    'update': self.anonymize(data) }) + "\n")
+            if pending:
+                self._file.flush()
+            return len(pending)
+
+    def close(self):
+        self.write_pending()
+        self._file.close()
+
+    @classmethod
+    def read(cls, path):
+        with gzip.open(path, 'rt') as f:
+            for line in f:
+                found = json.loads(line)
+                yield cls.EPOCH + datetime.timedelta(seconds=found['t']), found['update']
+
+
+class CaptureWriter(BackgroundJob):
+    NAME = 'capture_writer'
+
+    def __init__(self, looper, metrics, capture, interval=5):
+        super().__init__(looper, metrics, interval)
+        self._capture = capture
+
+    async def run_once(self):
+        written = await self._looper.run_in_executor(self._capture.write_pending)
+        self._metrics.incr('capture.written', written)
+
+
+class BotApiError(Exception):
+    pass
+
+
+#
+# Folds check-in announcements to a group chat into one digest message,
+# edited as more people join, instead of one message each. A whole group
+# checking in at :00 would otherwise run into Telegram's per-group limit
+# of about 20 messages a minute.
 #
-class DojoBot(telepot.async.Bot):
-    @asyncio.coroutine
-    def print_description(self):
-        me =  yield from self.getMe()
+class GroupAnnouncer(object):
+    # How long a digest takes new check-ins before the next one gets a
+    # message of its own.
+    WINDOW_SECONDS = 300
+    # Check-ins after the first wait at most this long to show up. This
+    # also keeps edits of one digest within the per-group limit.
+    EDIT_DELAY_SECONDS = 3
+    # Keeps a digest well within the 4096 characters of a message.
+    MAX_ENTRIES = 20
+
+    class Digest(object):
+        def __init__(self, opened_at):
+            self.opened_at = opened_at
+            self.message_id = None
+            self.entries = []
+            self.shown = 0
+            self.editing = False
+
+        @property
+        def text(self):
+            return "\n\n".join(self.entries)
+
+    def __init__(self, bot, looper, metrics=None):
+        self._bot = bot
+        self._looper = looper
+        self._metrics = metrics or Metrics()
+        self._digests = {}
+        # DojoBotApp swaps in its own, so that shutdown() waits for edits.
+        self.spawn = looper.create_task
+
+    def _open_digest_for(self, chat_id):
+        digest = self._digests.get(chat_id)
+        if not digest or len(digest.entries) >= self.MAX_ENTRIES:
+            return None
+        if datetime.timedelta(seconds=self.WINDOW_SECONDS) <= self._looper.now() - digest.opened_at:
+            return None
+        return digest
+
+    async def announce(self, chat_id, text):
+        digest = self._open_digest_for(chat_id)
+        if digest:
+            digest.entries.append(text)
+            self._metrics.incr('announcer.coalesced')
+            # The first check-in is still being sent if there is no message_id,
+            # and it takes care of the rest once it's done.
+            if digest.message_id and not digest.editing:
+                digest.editing = True
+                self.spawn(self._edit_later(chat_id, digest))
+            return
+        await self._start(chat_id, [ text ])
+
+    # Sends |entries| as a new digest. If that fails, whatever was added to
+    # it in the meantime goes out as one more.
+    async def _start(self, chat_id, entries):
+        digest = self.Digest(self._looper.now())
+        digest.entries.extend(entries)
+        self._digests[chat_id] = digest
+        self._metrics.incr('announcer.sent')
+        try:
+            sent = await self._bot.sendMessage(
+                chat_id, digest.text, reply_markup=self._bot.HIDE_KEYBOARD)
+        except Exception:
+            if self._digests.get(chat_id) is digest:
+                del self._digests[chat_id]
+            if len(entries) < len(digest.entries):
+                self.spawn(self._resend(chat_id, digest.entries[len(entries):]))
+            raise
+        digest.message_id = sent['message_id']
+        digest.shown = len(entries)
+        if digest.shown < len(digest.entries):
+            digest.editing = True
+            self.spawn(self._edit_later(chat_id, digest))
+
+    async def _resend(self, chat_id, entries):
+        try:
+            await self._start(chat_id, entries)
+        except Exception as e:
+            print("Failed to announce to {}: {}".format(chat_id, e))
+            self._metrics.incr('announcer.failed')
+
+    async def _edit_later(self, chat_id, digest):
+        await self._looper.sleep(self.EDIT_DELAY_SECONDS)
+        if not digest.message_id:
+            # An earlier edit failed and already sent the rest.
+            return
+        digest.editing = False
+        shown = len(digest.entries)
+        try:
+            await self._bot.editMessageText(chat_id, digest.message_id, digest.text)
+            digest.shown = shown
+            self._metrics.incr('announcer.edits')
+        except Exception as e:
+            # Gone or not editable anymore. What it doesn't show yet starts afresh.
+            print("Failed to update the digest for {}: {}".format(chat_id, e))
+            self._metrics.incr('announcer.failed')
+            if self._digests.get(chat_id) is digest:
+                del self._digests[chat_id]
+            digest.message_id = None
+            await self._resend(chat_id, digest.entries[digest.shown:])
+
+
+#
+# A thin Telegram Bot API client, plus some app specific sendMessage variants.
+#
+class DojoBot(object):
+    API_URL = 'https://api.telegram.org'
+    POLL_TIMEOUT = 30
+    # Extra time a long poll gets over POLL_TIMEOUT before we give up on it.
+    POLL_SLACK_SECONDS = 10
+    SEND_TIMEOUT_SECONDS = 10
+    # One long poll plus a few sends in flight. Telegram won't take much
+    # more than 30 messages/s from one bot anyway.
+    CONNECTION_LIMIT = 8
+    KEEPALIVE_SECONDS = 60
+    DNS_CACHE_SECONDS = 300
+    # Telegram's limit for one bot, in messages a second.
+    SEND_RATE = 30
+    # What |send_limiter| holds back.
+    LIMITED_METHODS = frozenset([ 'sendMessage', 'editMessageText' ])
+    HIDE_KEYBOARD = { 'remove_keyboard': True }
+
+    @classmethod
+    def keyboard(cls, kb):
+        return { 'keyboard': kb }
+
+    # |keepalive| is there for bench.py to compare against a fresh
+    # connection per call. Group announcements are coalesced when there
+    # is a |looper| to time them with. Bots can share a |session| from
+    # make_session(), which they then leave open on close().
+    def __init__(self, token, metrics=None, api_url=None, keepalive=True, looper=None,
+                 session=None, send_limiter=None):
+        self._token = token
+        self._metrics = metrics or Metrics()
+        self._announcer = GroupAnnouncer(self, looper, self._metrics) if looper else None
+        self._api_url = api_url or self.API_URL
+        self._keepalive = keepalive
+        self._session = session
+        self._owns_session = session is None
+        self._send_limiter = send_limiter
+        self._offset = None
+
+    # Announcements finish in the background. |spawn| is how they start
+    # those tasks, so that whoever runs the bot can wait for them.
+    def use_spawner(self, spawn):
+        if self._announcer:
+            self._announcer.spawn = spawn
+
+    @classmethod
+    def _make_trace_config(cls, metrics):
+        async def created(session, context, params):
+            metrics.incr('bot.connections.created')
+
+        async def reused(session, context, params):
+            metrics.incr('bot.connections.reused')
+
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(created)
+        trace.on_connection_reuseconn.append(reused)
+        return trace
+
+    # Has to be called with the loop running.
+    @classmethod
+    def make_session(cls, metrics, keepalive=True, limit=CONNECTION_LIMIT):
+        if keepalive:
+            pooling = { 'keepalive_timeout': cls.KEEPALIVE_SECONDS }
+        else:
+            pooling = { 'force_close': True }
+        connector = aiohttp.TCPConnector(
+            limit=limit, ttl_dns_cache=cls.DNS_CACHE_SECONDS, **pooling)
+        return aiohttp.ClientSession(
+            connector=connector, trace_configs=[cls._make_trace_config(metrics)])
+
+    # Polling and sending share this session, and so its connection pool.
+    def _get_session(self):
+        if not self._session:
+            self._session = self.make_session(self._metrics, self._keepalive)
+        return self._session
+
+    async def _api(self, method, params, timeout=SEND_TIMEOUT_SECONDS):
+        params = { k: v for k, v in params.items() if v is not None }
+        url = "{}/bot{}/{}".format(self._api_url, self._token, method)
+        if self._send_limiter and method in self.LIMITED_METHODS:
+            if 0 < await self._send_limiter.acquire():
+                self._metrics.incr('bot.api.throttled')
+        started = time.monotonic()
+        try:
+            with tracer.span('bot.' + method):
+                async with self._get_session().post(
+                        url, json=params, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                    found = await resp.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self._metrics.incr('bot.api.failed')
+            raise
+        finally:
+            self._metrics.observe('bot.api.' + method, time.monotonic() - started)
+        if not found.get('ok'):
+            raise BotApiError("{}: {}".format(method, found.get('description')))
+        return found['result']
+
+    async def close(self):
+        if self._session and self._owns_session:
+            await self._session.close()
+            self._session = None
+
+    async def getMe(self):
+        return await self._api('getMe', {})
+
+    async def sendMessage(self, chat_id, text, reply_markup=None):
+        return await self._api(
+            'sendMessage', { 'chat_id': chat_id, 'text': text, 'reply_markup': reply_markup })
+
+    async def editMessageText(self, chat_id, message_id, text, reply_markup=None):
+        return await self._api(
+            'editMessageText',
+            { 'chat_id': chat_id, 'message_id': message_id, 'text': text, 'reply_markup': reply_markup })
+
+    async def getUpdates(self, offset=None, timeout=0):
+        return await self._api(
+            'getUpdates',
+            { 'offset': offset, 'timeout': timeout, 'allowed_updates': ['message'] },
+            timeout=timeout + self.POLL_SLACK_SECONDS)
+
+    # Long-polls for updates and hands each message to |handler|, as a new
+    # task if it's a coroutine function.
+    async def messageLoop(self, handler):
+        while True:
+            try:
+                updates = await self.getUpdates(self._offset, self.POLL_TIMEOUT)
+            except (aiohttp.ClientError, asyncio.TimeoutError, BotApiError) as e:
+                print("getUpdates failed: {}".format(e))
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                self._offset = update['update_id'] + 1
+                if 'message' not in update:
+                    continue
+                # A coroutine |handler| holds the next update until it's done.
+                if asyncio.iscoroutinefunction(handler):
+                    await handler(update['message'])
+                else:
+                    handler(update['message'])
+
+    async def print_description(self):
+        me = await self.getMe()
         print("Bot:" + str(me))
 
-    @asyncio.coroutine
     def tell_error(self, chat_id, text):
-        return self.sendMessage(chat_id, text, reply_markup=nt.ReplyKeyboardHide())
+        return self.sendMessage(chat_id, text, reply_markup=self.HIDE_KEYBOARD)
 
-    @asyncio.coroutine
     def tell_stats(self, chat_id, text):
-        return self.sendMessage(chat_id, text, reply_markup=nt.ReplyKeyboardHide())
+        return self.sendMessage(chat_id, text, reply_markup=self.HIDE_KEYBOARD)
+
+    def tell_report(self, chat_id, text):
+        return self.sendMessage(chat_id, text, reply_markup=self.HIDE_KEYBOARD)
+
+    def tell_search_results(self, id, result):
+        markup = self.keyboard([[ SearchConversation.MORE ]]) if result.has_more else self.HIDE_KEYBOARD
+        return self.sendMessage(id, result.format(), reply_markup=markup)
 
-    @asyncio.coroutine
     def tell_where_you_are(self, owner_id, owner_name, chat_id, chat_title):
         text = """
 OK, I got {} is at {}({})
 """.format(owner_name, chat_title, chat_id).strip()
-        return self.sendMessage(chat_id, text, reply_markup=nt.ReplyKeyboardHide())
+        return self.sendMessage(chat_id, text, reply_markup=self.HIDE_KEYBOARD)
 
     def declare_checkin(self, to, record, weekly_stats):
         text = """
@@ -544,33 +2839,34 @@ OK, I got {} is at {}({})
 """.format(record.owner_name,
            weekly_stats.close_count + 1, "th", # TODO(omo): Use correct ordinal
            record.planned_minutes, record.topic).strip()
-        return self.sendMessage(to, text, reply_markup=nt.ReplyKeyboardHide())
+        if self._announcer and to != record.owner_id:
+            return self._announcer.announce(to, text)
+        return self.sendMessage(to, text, reply_markup=self.HIDE_KEYBOARD)
 
     def declare_checkout(self, record):
         text = """
 {} Checked out from {} minute session!
 """.format(record.owner_name, record.planned_minutes).strip()
-        return self.sendMessage(record.owner_id, text, reply_markup=nt.ReplyKeyboardHide())
+        return self.sendMessage(record.owner_id, text, reply_markup=self.HIDE_KEYBOARD)
 
     def declare_abort(self, record):
         text = """
 {} Aborted the session :-(
 """.format(record.owner_name, record.planned_minutes).strip()
-        return self.sendMessage(record.owner_id, text, reply_markup=nt.ReplyKeyboardHide())
+        return self.sendMessage(record.owner_id, text, reply_markup=self.HIDE_KEYBOARD)
 
     def ask_topic(self, record):
         text = "Whatcha gonna do?"
-        return self.sendMessage(record.owner_id, text, reply_markup=nt.ReplyKeyboardHide())
+        return self.sendMessage(record.owner_id, text, reply_markup=self.HIDE_KEYBOARD)
 
     def ack_quit(self, id):
         text = "Call me anytime..."
-        return self.sendMessage(id, text, reply_markup=nt.ReplyKeyboardHide())
+        return self.sendMessage(id, text, reply_markup=self.HIDE_KEYBOARD)
 
     def ask_topic_with_suggestions(self, record, suggestions):
         text = "Whatcha gonna do?"
         kb = suggestions
-        return self.sendMessage(record.owner_id, text, reply_markup=nt.ReplyKeyboardMarkup(
-            keyboard=kb))
+        return self.sendMessage(record.owner_id, text, reply_markup=self.keyboard(kb))
 
     def ask_minutes(self, record):
         text = "How long?"
@@ -579,75 +2875,193 @@ OK, I got {} is at {}({})
             ["30", "45", "60"],
             ["90", "120"]
         ]
-        return self.sendMessage(record.owner_id, text, reply_markup=nt.ReplyKeyboardMarkup(
-            keyboard=kb))
+        return self.sendMessage(record.owner_id, text, reply_markup=self.keyboard(kb))
 
     def ask_checkout(self, id):
         text = "How are you coming along?"
         kb = [['/co', '/abort']]
-        return self.sendMessage(id, text, reply_markup=nt.ReplyKeyboardMarkup(
-            keyboard=kb))
+        return self.sendMessage(id, text, reply_markup=self.keyboard(kb))
 
 #
 # God class.
 #
 class DojoBotApp(object):
-    def __init__(self, bot, store, looper):
+    # |update_limiter| keeps one tenant from taking more than its share of
+    # a store and loop shared with others.
+    def __init__(self, bot, store, looper, metrics=None, capture=None, diagnostics=None,
+                 update_limiter=None):
         self._bot = bot
         self._store = store
         self._conversations = {}
         self._looper = looper
+        self._metrics = metrics or Metrics()
+        self._capture = capture
+        self._diagnostics = diagnostics or Diagnostics()
+        self._update_limiter = update_limiter
+        self._accepting = True
+        self._inflight = set()
+        # owner_id -> (Record, the task sleeping on it)
+        self._reminders = {}
+        self._reports = None
+        bot.use_spawner(self._spawn)
+
+    async def run(self):
+        await self._bot.messageLoop(self._take if self._update_limiter else self._dispatch)
+
+    # The analytics module pulls in NumPy, which we don't want to pay for
+    # at startup.
+    def _report_cache(self):
+        if not self._reports:
+            from cdjbot import analytics
+            self._reports = analytics.ReportCache(self._store)
+        return self._reports
+
+    def _dispatch(self, data):
+        if not self._accepting:
+            return
+        self._spawn(self._diagnostics.profiled(self._handle(data)))
+
+    # Holds up the message loop rather than the update, so that a flood
+    # waits at Telegram instead of piling up in _inflight.
+    async def _take(self, data):
+        if 0 < await self._update_limiter.acquire():
+            self._metrics.incr('app.updates.throttled')
+        self._dispatch(data)
+
+    def _spawn(self, coro):
+        task = self._looper.create_task(coro)
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+        return task
+
+    # Once shutdown() has begun, reminders are kept for the next process
+    # instead of waited for, including those it cancels.
+    async def _remind(self, conv):
+        rec = conv.reminder
+        if rec:
+            self._reminders[rec.owner_id] = (rec, self._looper.current_task())
+            if not self._accepting:
+                return
+        try:
+            await conv.see_you_later()
+        finally:
+            if (rec and self._accepting and
+                    self._reminders.get(rec.owner_id, (None,))[0] is rec):
+                del self._reminders[rec.owner_id]
 
-    @asyncio.coroutine
-    def run(self):
-        yield from self._bot.messageLoop(self._handle)
+    def to_state(self):
+        return {
+            'conversations': [ s for s in [ c.to_state() for c in self._conversations.values() if c ] if s ],
+            'reminders': [ rec._asdict() for rec, task in self._reminders.values() ]
+        }
 
-    @asyncio.coroutine
-    def _start_command_conversation(self, message):
+    def restore(self, state):
+        for s in state.get('conversations', []):
+            conv = CheckinConversation.from_state(self._bot, self._store, self._looper, s)
+            self._conversations[conv.key] = conv
+        for r in state.get('reminders', []):
+            conv = CheckinConversation.from_state(
+                self._bot, self._store, self._looper,
+                { 'record': r, 'asking': None, 'closing': None })
+            self._spawn(self._remind(conv))
+
+    # Stops taking updates, waits up to |deadline| seconds for the ones in
+    # flight, and saves what the next process needs to carry on. Pending
+    # reminders are only sleeping, so they are saved rather than waited for.
+    async def shutdown(self, deadline):
+        started = time.monotonic()
+        self._accepting = False
+        for rec, task in list(self._reminders.values()):
+            if task:
+                task.cancel()
+        # Tasks in flight may spawn more, like a check-in its digest edit.
+        pending = [ t for t in self._inflight if not t.done() ]
+        while pending:
+            left = deadline - (time.monotonic() - started)
+            if 0 < left:
+                done, pending = await self._looper.wait(pending, left)
+            if pending:
+                for t in pending:
+                    t.cancel()
+                self._metrics.incr('shutdown.cancelled', len(pending))
+                break
+            pending = [ t for t in self._inflight if not t.done() ]
+        # Handlers finishing while draining may have added both.
+        state = self.to_state()
+        try:
+            self._store.save_app_state(state)
+        except Exception as e:
+            print("Couldn't save the app state: {}".format(e))
+            self._metrics.incr('shutdown.save_failures')
+        self._metrics.incr('shutdown.conversations', len(state['conversations']))
+        self._metrics.incr('shutdown.reminders', len(state['reminders']))
+        self._metrics.observe('shutdown', time.monotonic() - started)
+
+    async def _start_command_conversation(self, message):
         # XXX: We probably need "/quit" to  clear the state.
         if message.command in ["/ci", "/ci15", "/ci30", "/ci45", "/ci60"]:
             print("Got checkin command")
-            return CheckinConversation.start(self._bot, self._store, self._looper, message)
+            return await CheckinConversation.start(self._bot, self._store, self._looper, message)
         if message.command == "/co":
             print("Got checkout command")
-            return CheckoutConversation.start(self._bot, self._store, self._looper, message)
+            return await CheckoutConversation.start(self._bot, self._store, self._looper, message)
         if message.command == "/abort":
             print("Got abort command")
-            return AbortConversation.start(self._bot, self._store, self._looper, message)
+            return await AbortConversation.start(self._bot, self._store, self._looper, message)
         if message.command == "/cstats":
             print("Got cstat command")
-            return StatConversation.start(self._bot, self._store, self._looper, message)
+            return await StatConversation.start(self._bot, self._store, self._looper, message)
+        if message.command == "/chist":
+            print("Got chist command")
+            return await HistoryConversation.start(self._bot, self._store, self._looper, message)
+        if message.command == "/search":
+            print("Got search command")
+            return await SearchConversation.start(self._bot, self._store, self._looper, message)
+        if message.command == "/report":
+            print("Got report command")
+            return await ReportConversation.start(
+                self._bot, self._store, self._looper, message, self._report_cache())
+        if message.command == "/memdiff" and self._diagnostics.is_admin(message.sender_id):
+            print("Got memdiff command")
+            return await MemoryDiffConversation.start(
+                self._bot, self._store, self._looper, message, self._diagnostics)
         if message.command == "/iamhere":
             print("Got aimhere command")
-            return LocatingConversation.start(self._bot, self._store, self._looper, message)
+            return await LocatingConversation.start(self._bot, self._store, self._looper, message)
         if message.command == "/q":
             print("Got q command")
-            return QuitConversation.start(self._bot, self._store, self._looper, message)
+            return await QuitConversation.start(self._bot, self._store, self._looper, message)
         print("Got unknown command")
         return None
 
-    @asyncio.coroutine
-    def _handle(self, data):
+    async def _handle(self, data):
+        if self._capture:
+            self._capture.tap(data, self._looper.now())
         message = Message(data)
-        if message.command:
-            next_conv = yield from self._start_command_conversation(message)
-            if not next_conv:
-                yield from self._bot.tell_error(
-                    message.sender_id,
-                    "Unknown command {} :-(".format(message.command))
-            elif next_conv.needs_more:
-                self._conversations[message.sender_id] = next_conv
-            else:
-                self._conversations[message.sender_id] = None
-                yield from next_conv.see_you_later()
-        else:
-            conv = self._conversations.get(message.sender_id, None)
-            if not conv:
-                print("No ongoing conversation...")
-                yield from self._bot.tell_error(
-                    message.sender_id, "I don't remember what we were talking about :-(")
-            else:
-                print("Keep conversation...")
-                yield from conv.follow(message)
-                if not conv.needs_more:
+        reminding = None
+        # Reminders get spans of their own, instead of stretching this one.
+        with tracer.span('update', command=message.command or 'reply'):
+            if message.command:
+                next_conv = await self._start_command_conversation(message)
+                if not next_conv:
+                    await self._bot.tell_error(
+                        message.sender_id,
+                        "Unknown command {} :-(".format(message.command))
+                elif next_conv.needs_more:
+                    self._conversations[message.sender_id] = next_conv
+                else:
                     self._conversations[message.sender_id] = None
+                    reminding = next_conv
+            else:
+                conv = self._conversations.get(message.sender_id, None)
+                if not conv:
+                    print("No ongoing conversation...")
+                    await self._bot.tell_error(
+                        message.sender_id, "I don't remember what we were talking about :-(")
+                else:
+                    print("Keep conversation...")
+                    await conv.follow(message)
+                    if not conv.needs_more:
+                        self._conversations[message.sender_id] = None
+        if reminding:
+            await self._remind(reminding)
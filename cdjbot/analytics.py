@@ -0,0 +1,148 @@
+#
+# Check-in history analytics for /report. Records are streamed out of the
+# store into one NumPy array per field, and everything is computed over
+# whole columns at once.
+#
+import collections
+import threading
+import numpy as np
+
+from cdjbot import Record
+
+
+#
+# The fields of a set of records which the reports need, one array each.
+# Open sessions have no finished_at (NaT), and planned_minutes may be
+# missing (NaN) on records that never got that far.
+#
+class RecordColumns(object):
+    FIELDS = [ 'owner_id', 'started_at', 'finished_at', 'planned_minutes', 'state' ]
+    STATES = [ Record.OPEN, Record.CLOSED, Record.ABORTED ]
+
+    def __init__(self, rows):
+        codes = { s: i for i, s in enumerate(self.STATES) }
+        owners, started, finished, planned, states = [], [], [], [], []
+        for row in rows:
+            owners.append(row['owner_id'])
+            started.append(row['started_at'])
+            finished.append(row.get('finished_at'))
+            planned.append(row.get('planned_minutes'))
+            states.append(codes.get(row.get('state'), 0))
+        self.owner_id = np.array(owners, dtype=np.int64)
+        self.started_at = np.array(started, dtype='datetime64[s]')
+        self.finished_at = np.array(finished, dtype='datetime64[s]')
+        self.planned_minutes = np.array(planned, dtype=np.float64)
+        self.state = np.array(states, dtype=np.int8)
+
+    def __len__(self):
+        return len(self.state)
+
+    def is_in(self, state):
+        return self.state == self.STATES.index(state)
+
+
+# Current and longest runs of consecutive days in |days|, sorted unique
+# day numbers. The current run has to reach |today| or yesterday.
+def streaks(days, today):
+    if not len(days):
+        return 0, 0
+    # Where each run starts: wherever the gap from the previous day isn't 1.
+    starts = np.flatnonzero(np.diff(days, prepend=days[0] - 2) != 1)
+    lengths = np.diff(np.append(starts, len(days)))
+    current = int(lengths[-1]) if today - days[-1] <= 1 else 0
+    return current, int(lengths.max())
+
+
+class Report(collections.namedtuple(
+        'ReportBase',
+        ['closed', 'aborted', 'by_hour', 'by_weekday', 'current_streak', 'longest_streak',
+         'planned_minutes', 'actual_minutes', 'overrun_rate'])):
+
+    WEEKDAYS = [ 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun' ]
+
+    @property
+    def completion_rate(self):
+        finished = self.closed + self.aborted
+        return self.closed / finished if finished else 0.0
+
+    @classmethod
+    def compute(cls, columns, today):
+        closed = columns.is_in(Record.CLOSED)
+        # Day and hour numbers since the epoch, UTC as everything else.
+        days = columns.started_at.astype('datetime64[D]').astype(np.int64)
+        hours = columns.started_at.astype('datetime64[h]').astype(np.int64) - days * 24
+        current, longest = streaks(
+            np.unique(days[closed]), np.datetime64(today, 'D').astype(np.int64))
+        timed = closed & ~np.isnat(columns.finished_at) & ~np.isnan(columns.planned_minutes)
+        planned = columns.planned_minutes[timed]
+        actual = (columns.finished_at[timed] - columns.started_at[timed]) / np.timedelta64(1, 'm')
+        return cls(
+            closed=int(np.count_nonzero(closed)),
+            aborted=int(np.count_nonzero(columns.is_in(Record.ABORTED))),
+            by_hour=np.bincount(hours, minlength=24).tolist(),
+            # 1970-01-01 was a Thursday. Monday is 0, as in datetime.weekday().
+            by_weekday=np.bincount((days + 3) % 7, minlength=7).tolist(),
+            current_streak=current,
+            longest_streak=longest,
+            planned_minutes=float(planned.mean()) if len(planned) else 0.0,
+            actual_minutes=float(actual.mean()) if len(actual) else 0.0,
+            overrun_rate=float(np.mean(actual > planned)) if len(actual) else 0.0)
+
+    def format(self):
+        if not self.closed + self.aborted:
+            return "Nothing to report yet. /ci to get started!"
+        busiest = sorted(range(24), key=lambda h: -self.by_hour[h])[:3]
+        lines = [
+            "{} done, {} aborted ({:.0%} completed)".format(
+                self.closed, self.aborted, self.completion_rate),
+            "Streak: {} days (longest {})".format(self.current_streak, self.longest_streak),
+            "Planned {:.0f} minutes, took {:.0f} on average ({:.0%} ran over)".format(
+                self.planned_minutes, self.actual_minutes, self.overrun_rate),
+            "Busiest hours (UTC): {}".format(
+                ", ".join("{:02}:00".format(h) for h in busiest if self.by_hour[h])),
+            " ".join("{} {}".format(d, n) for d, n in zip(self.WEEKDAYS, self.by_weekday)),
+        ]
+        return "\n".join(lines)
+
+
+#
+# Reports by key (a user or a group), kept until a record of one of the
+# owners they cover changes, or the day changes and streaks with it.
+#
+class ReportCache(object):
+    def __init__(self, store):
+        self._store = store
+        # key -> (day, Report)
+        self._reports = {}
+        # owner_id -> keys whose reports cover it
+        self._keys_by_owner = collections.defaultdict(set)
+        # Store changes arrive from executor threads.
+        self._lock = threading.Lock()
+        self._generation = 0
+        store.add_change_listener(self.invalidate)
+
+    def invalidate(self, owner_id):
+        with self._lock:
+            self._generation += 1
+            for key in self._keys_by_owner.pop(owner_id, ()):
+                self._reports.pop(key, None)
+
+    def _load(self, owner_ids, today):
+        rows = self._store.stream_record_fields(owner_ids, RecordColumns.FIELDS)
+        return Report.compute(RecordColumns(rows), today)
+
+    async def report_for(self, looper, key, owner_ids):
+        today = looper.now().date()
+        found = self._reports.get(key)
+        if found and found[0] == today:
+            return found[1]
+        with self._lock:
+            generation = self._generation
+        report = await looper.run_in_executor(self._load, owner_ids, today)
+        with self._lock:
+            # Whatever changed while we were loading may not be in |report|.
+            if generation == self._generation:
+                self._reports[key] = (today, report)
+                for owner_id in owner_ids:
+                    self._keys_by_owner[owner_id].add(key)
+        return report
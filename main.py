@@ -1,27 +1,261 @@
-import os, sys
-import cdjbot
+import os, sys, time, signal, binascii, json
 import asyncio
 
-@asyncio.coroutine
-def start(loop, tg_token, mongo_url):
-    bot = cdjbot.DojoBot(tg_token, loop)
-    store = cdjbot.MongoStore(mongo_url)
-    looper = cdjbot.Looper(loop)
-    app = cdjbot.DojoBotApp(bot, store, looper)
-    yield from store.print_description()
-    yield from bot.print_description()
-    yield from app.run()
+STARTED = time.monotonic()
+STARTUP_TIMEOUT_SECONDS = int(os.environ.get("CDJBOT_STARTUP_TIMEOUT_SECONDS", "15"))
+READY_FILE = os.environ.get("CDJBOT_READY_FILE", "/tmp/cdjbot.ready")
+# Keep this below the docker stop timeout in conf/cdjbot.conf.tmpl.
+SHUTDOWN_DEADLINE_SECONDS = int(os.environ.get("CDJBOT_SHUTDOWN_DEADLINE_SECONDS", "20"))
+
+# One bot of many in this process. |config| is an entry of
+# CDJBOT_TENANTS_FILE: name, token, database and optionally journal_path,
+# capture_path, send_rate and update_rate (a second), and event_log. The Mongo client and
+# the HTTP session are shared between all tenants, everything else is not.
+class Tenant(object):
+    def __init__(self, cdjbot, looper, config, mongo_url, client, session, capture_salt, diagnostics):
+        self.name = config['name']
+        self.looper = looper
+        self.metrics = cdjbot.Metrics()
+        send_rate = config.get('send_rate', cdjbot.DojoBot.SEND_RATE)
+        self.bot = cdjbot.DojoBot(
+            config['token'], self.metrics, looper=looper, session=session,
+            send_limiter=cdjbot.RateLimiter(looper, send_rate, send_rate))
+        store_class = cdjbot.EventStore if config.get('event_log') else cdjbot.MongoStore
+        self.store = store_class(mongo_url, looper, client, config.get('database'))
+        self.app_store = self.store
+        self.journal = None
+        if config.get('journal_path'):
+            self.journal = cdjbot.Journal(config['journal_path'])
+            print("{}: Journal: {} entries to replay".format(self.name, len(self.journal)))
+            self.app_store = cdjbot.JournaledStore(self.store, self.journal)
+        self.capture = None
+        if config.get('capture_path'):
+            self.capture = cdjbot.TrafficCapture(config['capture_path'], capture_salt)
+        update_rate = config.get('update_rate')
+        update_limiter = cdjbot.RateLimiter(looper, update_rate, update_rate) if update_rate else None
+        self.app = cdjbot.DojoBotApp(
+            self.bot, self.app_store, looper, self.metrics, self.capture, diagnostics, update_limiter)
+        # Started by start_jobs(), stopped by stop().
+        self.jobs = []
+        self.backfills = []
+
+    async def connect_store(self):
+        try:
+            await self.looper.run_in_executor(self.store.connect)
+        except Exception as e:
+            # The journal can carry us until Mongo is back.
+            if not self.journal:
+                raise
+            print("{}: Store is not reachable, continuing with the journal: {}".format(self.name, e))
+        await self.store.print_description()
+
+    async def backfill_record_days(self):
+        try:
+            filled = await self.looper.run_in_executor(self.store.backfill_record_days)
+        except Exception as e:
+            print("{}: Daily bucket backfill failed, will retry on restart: {}".format(self.name, e))
+            return
+        if filled:
+            print("{}: Backfilled {} daily buckets".format(self.name, filled))
+
+    async def backfill_events(self):
+        try:
+            imported = await self.looper.run_in_executor(self.store.backfill_events)
+        except Exception as e:
+            print("{}: Event import failed, will retry on restart: {}".format(self.name, e))
+            return
+        if imported:
+            print("{}: Imported {} records into the event log".format(self.name, imported))
+
+    def start_jobs(self, cdjbot, loop):
+        if self.journal:
+            self.jobs.append(cdjbot.JournalFlusher(self.looper, self.metrics, self.app_store))
+        if self.capture:
+            self.jobs.append(cdjbot.CaptureWriter(self.looper, self.metrics, self.capture))
+        if isinstance(self.store, cdjbot.EventStore):
+            self.jobs.append(cdjbot.Projector(self.looper, self.metrics, self.store))
+            self.backfills.append(loop.create_task(self.backfill_events()))
+        self.backfills.append(loop.create_task(self.backfill_record_days()))
+        sweeper = cdjbot.Sweeper(
+            self.looper, self.metrics, self.store,
+            interval=int(os.environ.get("CDJBOT_SWEEP_INTERVAL_SECONDS", "300")),
+            grace_minutes=int(os.environ.get("CDJBOT_SWEEP_GRACE_MINUTES", "60")),
+            policy=os.environ.get("CDJBOT_SWEEP_POLICY", cdjbot.Sweeper.ABORT))
+        archiver = cdjbot.Archiver(
+            self.looper, self.metrics, self.store,
+            horizon_days=int(os.environ.get("CDJBOT_ARCHIVE_HORIZON_DAYS", "90")))
+        reporter = cdjbot.MetricsReporter(
+            self.looper, self.metrics, int(os.environ.get("CDJBOT_METRICS_INTERVAL_SECONDS", "3600")),
+            self.name)
+        self.jobs += [ sweeper, archiver, reporter ]
+        for job in self.jobs:
+            loop.create_task(job.run())
+
+    # Like save_app_state() on the way out, a store error here costs only
+    # the state, not the startup. With the journal on, Mongo may be down.
+    async def restore(self):
+        try:
+            state = await self.looper.run_in_executor(self.app_store.take_app_state)
+        except Exception as e:
+            print("{}: Couldn't take the app state, restoring nothing: {}".format(self.name, e))
+            state = {}
+        self.app.restore(state)
+
+    async def stop(self):
+        await self.app.shutdown(SHUTDOWN_DEADLINE_SECONDS)
+        # Before the last flush and closing the journal, capture and client.
+        await asyncio.gather(*[ job.stop() for job in self.jobs ])
+        # What a backfill has in the executor fails once the client is
+        # closed, and it starts over on the next start.
+        for backfill in self.backfills:
+            backfill.cancel()
+        await asyncio.gather(*self.backfills, return_exceptions=True)
+        await self.bot.close()
+        if self.journal:
+            await self.app_store.flush(self.looper, self.metrics)
+            self.journal.close()
+        if self.capture:
+            self.capture.close()
+        print("[{}]\n{}".format(self.name, self.metrics.report()))
+
+async def start(loop, cdjbot, timer, probe, tenant_configs, mongo_url):
+    with timer.phase('build'):
+        # Shared connection pools count here, the rest per tenant.
+        metrics = cdjbot.Metrics()
+        looper = cdjbot.Looper(loop)
+        # Each tenant keeps a connection busy with its long poll.
+        session = cdjbot.DojoBot.make_session(
+            metrics, limit=cdjbot.DojoBot.CONNECTION_LIMIT + len(tenant_configs))
+        client = cdjbot.MongoStore.make_client(mongo_url)
+        # Set a fixed salt to keep the anonymized ids stable across restarts.
+        capture_salt = os.environ.get("CDJBOT_CAPTURE_SALT") or binascii.hexlify(os.urandom(16)).decode()
+        # Profiles one update in CDJBOT_PROFILE_EVERY, if set.
+        diagnostics = cdjbot.Diagnostics(
+            int(os.environ.get("CDJBOT_PROFILE_EVERY", "0")),
+            [ int(i) for i in os.environ.get("CDJBOT_ADMIN_IDS", "").split(",") if i.strip() ])
+        tenants = [ Tenant(cdjbot, looper, config, mongo_url, client, session, capture_salt, diagnostics)
+                    for config in tenant_configs ]
+        spans = None
+        trace_path = os.environ.get("CDJBOT_TRACE_PATH")
+        if trace_path:
+            spans = cdjbot.SpanFile(trace_path)
+            cdjbot.tracer.start(spans)
+
+    await asyncio.wait_for(asyncio.gather(*(
+        [ timer.timed('store:' + t.name, t.connect_store()) for t in tenants ] +
+        [ timer.timed('bot:' + t.name, t.bot.print_description()) for t in tenants ])),
+        STARTUP_TIMEOUT_SECONDS)
+
+    for tenant in tenants:
+        tenant.start_jobs(cdjbot, loop)
+    jobs = [ cdjbot.MetricsReporter(
+        looper, metrics, int(os.environ.get("CDJBOT_METRICS_INTERVAL_SECONDS", "3600")), 'shared') ]
+    if os.environ.get("CDJBOT_PROFILE_EVERY"):
+        jobs.append(cdjbot.ProfileReporter(
+            looper, metrics, diagnostics,
+            int(os.environ.get("CDJBOT_PROFILE_INTERVAL_SECONDS", "600")),
+            os.environ.get("CDJBOT_PROFILE_PATH", "/tmp/cdjbot.pstats")))
+    for job in jobs:
+        loop.create_task(job.run())
+
+    await timer.timed('restore', asyncio.gather(*[ t.restore() for t in tenants ]))
+
+    report = timer.report()
+    print("Startup:\n" + report)
+    probe.ready(report)
+
+    stopping = loop.create_future()
+    for sig in [signal.SIGTERM, signal.SIGINT]:
+        loop.add_signal_handler(sig, lambda: stopping.done() or stopping.set_result(None))
+    # kill -USR1 for a tracemalloc diff in the log, as /memdiff does for admins.
+    loop.add_signal_handler(signal.SIGUSR1, lambda: loop.create_task(print_memory_diff()))
+    async def print_memory_diff():
+        print(await looper.run_in_executor(diagnostics.memory_diff))
+    intakes = [ loop.create_task(t.app.run()) for t in tenants ]
+    await asyncio.wait(intakes + [stopping], return_when=asyncio.FIRST_COMPLETED)
+
+    print("Shutting down...")
+    probe.clear()
+    for intake in intakes:
+        intake.cancel()
+    await asyncio.gather(*[ t.stop() for t in tenants ])
+    await asyncio.gather(*[ job.stop() for job in jobs ])
+    await session.close()
+    client.close()
+    if spans:
+        cdjbot.tracer.stop()
+        spans.close()
+    print("[shared]\n" + metrics.report())
+
+# A single tenant from CDJBOT_TELEGRAM_TOKEN unless there's CDJBOT_TENANTS_FILE.
+def read_tenant_configs():
+    tenants_file = os.environ.get("CDJBOT_TENANTS_FILE")
+    if tenants_file:
+        with open(tenants_file) as f:
+            return json.load(f)
+    return [ {
+        'name': 'default',
+        'token': os.environ.get("CDJBOT_TELEGRAM_TOKEN"),
+        'journal_path': os.environ.get("CDJBOT_JOURNAL_PATH"),
+        'capture_path': os.environ.get("CDJBOT_CAPTURE_PATH"),
+        'event_log': bool(os.environ.get("CDJBOT_EVENT_LOG")),
+    } ]
+
+def check_tenant_configs(tenant_configs):
+    if not tenant_configs:
+        return "No tenants in CDJBOT_TENANTS_FILE!"
+    for config in tenant_configs:
+        tg_token = config.get('token')
+        if None == tg_token or "INVALID" == tg_token:
+            return "Specify CDJBOT_TELEGRAM_TOKEN!" if 1 == len(tenant_configs) else \
+                "Specify a token for {}!".format(config.get('name'))
+    if 1 < len(tenant_configs):
+        # Tenants sharing a database would see each other's records.
+        for key in [ 'name', 'database' ]:
+            values = [ c.get(key) for c in tenant_configs ]
+            if None in values or len(set(values)) != len(values):
+                return "Give each tenant its own {}!".format(key)
+        # Nor files, which they would write over each other.
+        for key in [ 'journal_path', 'capture_path' ]:
+            values = [ os.path.abspath(c[key]) for c in tenant_configs if c.get(key) ]
+            if len(set(values)) != len(values):
+                return "Give each tenant its own {}!".format(key)
+    return None
 
 if __name__ == "__main__":
-    tg_token = os.environ.get("CDJBOT_TELEGRAM_TOKEN")
-    if None == tg_token or "INVALID" == tg_token:
-        print("Error: Specify CDJBOT_TELEGRAM_TOKEN!")
+    tenant_configs = read_tenant_configs()
+    error = check_tenant_configs(tenant_configs)
+    if error:
+        print("Error: " + error)
         sys.exit(-1)
     mongo_url = os.environ.get("CDJBOT_MONGO_URL")
     if None == mongo_url or "INVALID" == mongo_url:
         print("Error: Specify CDJBOT_MONGO_URL!")
         sys.exit(-1)
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(start(loop, tg_token, mongo_url))
+    # Imported only once we know there is something to run, so that a bad
+    # environment fails fast. A good one pays for it anyway: pymongo, bson
+    # and aiohttp take most of the 'import' phase, and they are needed to
+    # build the store and the bot right after.
+    import cdjbot
+    timer = cdjbot.StartupTimer(STARTED)
+    timer.record('import', time.monotonic() - STARTED)
+    probe = cdjbot.ReadinessProbe(READY_FILE)
+    probe.clear()
+
+    if os.environ.get("CDJBOT_UVLOOP"):
+        # Optional; pip install uvloop.
+        import uvloop
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(start(loop, cdjbot, timer, probe, tenant_configs, mongo_url))
+    except asyncio.TimeoutError:
+        print("Error: Startup took longer than {}s\n{}".format(
+            STARTUP_TIMEOUT_SECONDS, timer.report()))
+        sys.exit(-1)
+    finally:
+        probe.clear()
     print("Done.")
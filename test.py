@@ -1,17 +1,24 @@
 
 import cdjbot as bot
+import cdjbot.analytics as analytics
+import aiohttp.web
 import asyncio
 import unittest
 import unittest.mock as mock
 import dockerip
 import dateutil.parser as dp
 import json
+import re
 import time
+import datetime
+import pymongo
+import tempfile
+import os
+import tracemalloc
 
 
 def get_mock_coro(return_value=None):
-    @asyncio.coroutine
-    def mock_coro(*args, **kwargs):
+    async def mock_coro(*args, **kwargs):
         return return_value
     return mock.Mock(wraps=mock_coro)
 
@@ -43,15 +50,54 @@ def make_mock_bot():
     b.ask_topic_with_suggestions = get_mock_coro()
     b.tell_error = get_mock_coro()
     b.tell_stats = get_mock_coro()
+    b.tell_report = get_mock_coro()
+    b.tell_search_results = get_mock_coro()
     b.tell_where_you_are = get_mock_coro()
     b.ask_checkout = get_mock_coro()
     return b
 
 class FakeLooper():
-    @asyncio.coroutine
-    def sleep(self, seconds):
+    async def sleep(self, seconds):
         pass
 
+    async def run_in_executor(self, fn, *args):
+        return fn(*args)
+
+    def current_task(self):
+        return None
+
+    def now(self):
+        return datetime.datetime.utcnow()
+
+# A local stand-in for api.telegram.org, for DojoBot itself.
+class FakeBotApi(object):
+    RESULTS = {
+        'getMe': { 'id': 1, 'is_bot': True, 'username': 'fakebot' },
+        'getUpdates': [],
+    }
+
+    def __init__(self):
+        self.calls = []
+        self.url = None
+        self._runner = None
+
+    async def _handle(self, request):
+        method = request.match_info['method']
+        self.calls.append((method, await request.json()))
+        result = self.RESULTS.get(method, { 'message_id': len(self.calls) })
+        return aiohttp.web.json_response({ 'ok': True, 'result': result })
+
+    async def start(self):
+        app = aiohttp.web.Application()
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await aiohttp.web.TCPSite(self._runner, '127.0.0.1', 0).start()
+        self.url = 'http://127.0.0.1:{}'.format(self._runner.addresses[0][1])
+
+    async def stop(self):
+        await self._runner.cleanup()
+
 def make_message_with_text(text, **kwargs):
     return bot.Message(make_message_dict(text, **kwargs))
 
@@ -59,6 +105,10 @@ def make_record_with_text(text, **kwargs):
     msg = make_message_with_text(text, **kwargs)
     return bot.Record.from_message(msg)
 
+def make_record_started_ago(text, minutes, **kwargs):
+    rec = make_record_with_text(text, **kwargs)
+    return rec._replace(started_at=rec.started_at - datetime.timedelta(minutes=minutes))
+
 MSG_JSON_WITH_CHAT = """
 {
  "text": "/iamhere@foobot",
@@ -124,6 +174,247 @@ class RecordTest(unittest.TestCase):
         self.assertEqual(record.topic, 'hello, world')
         self.assertFalse(record.needs_resolution())
 
+    def test_too_many_minutes(self):
+        record = bot.Record.from_message(make_message_with_text('/ci 9999999999 hello'))
+        self.assertEqual(record.planned_minutes, None)
+        self.assertEqual(bot.Record.from_message(make_message_with_text('/ci9999999999')).planned_minutes, None)
+        with self.assertRaises(ValueError):
+            record.with_planned_minutes(bot.Record.MAX_PLANNED_MINUTES + 1)
+        self.assertEqual(record.with_planned_minutes(bot.Record.MAX_PLANNED_MINUTES).planned_minutes,
+                         bot.Record.MAX_PLANNED_MINUTES)
+        self.assertEqual(record._replace(planned_minutes=9999999999).planned_until(),
+                         record.started_at + datetime.timedelta(days=1))
+
+    def test_diff(self):
+        record = bot.Record.from_message(make_message_with_text('/ci15 hello'))
+        self.assertEqual(record.with_topic('bye').diff(record), { 'topic': 'bye' })
+        self.assertEqual(record.diff(record), {})
+
+
+class TrafficCaptureTest(unittest.TestCase):
+    def test_tap_and_read(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'capture.jsonl.gz')
+            capture = bot.TrafficCapture(path, 'salt')
+            now = dp.parse('2016-02-04 12:00:00')
+            capture.tap(json.loads(MSG_JSON_WITH_CHAT), now)
+            capture.tap(make_message_dict('/co', user_id=5678), now)
+            capture.close()
+            found = list(bot.TrafficCapture.read(path))
+        self.assertEqual([ t for t, u in found ], [ now, now ])
+        first, second = [ u for t, u in found ]
+        self.assertNotEqual(first['from']['id'], 5678)
+        self.assertEqual(first['from']['id'], second['from']['id'])
+        self.assertTrue(first['chat']['id'] < 0)
+        self.assertNotIn('Morrita', json.dumps(first))
+        self.assertEqual(first['text'], '/iamhere@foobot')
+
+    def test_writer(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'capture.jsonl.gz')
+            capture = bot.TrafficCapture(path, 'salt')
+            capture.tap(make_message_dict('/co'), dp.parse('2016-02-04 12:00:00'))
+            self.assertEqual(capture.pending, 1)
+            metrics = bot.Metrics()
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(bot.CaptureWriter(FakeLooper(), metrics, capture).tick())
+            loop.close()
+            self.assertEqual(capture.pending, 0)
+            self.assertEqual(metrics.count('capture.written'), 1)
+            capture.close()
+            self.assertEqual(len(list(bot.TrafficCapture.read(path))), 1)
+
+
+class VirtualLooperTest(unittest.TestCase):
+    def setUp(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def tearDown(self):
+        self._loop.close()
+
+    def test_sleep(self):
+        start = datetime.datetime(2016, 2, 1)
+        looper = bot.VirtualLooper(self._loop, start)
+        woken = []
+        async def sleeper(seconds):
+            await looper.sleep(seconds)
+            woken.append(looper.now())
+        for s in [60, 30]:
+            self._loop.create_task(sleeper(s))
+        self._loop.run_until_complete(looper.advance_to(start + datetime.timedelta(seconds=45)))
+        self.assertEqual(woken, [ start + datetime.timedelta(seconds=30) ])
+        self._loop.run_until_complete(looper.advance_to(start + datetime.timedelta(days=7)))
+        self.assertEqual(len(woken), 2)
+        self.assertEqual(looper.now(), start + datetime.timedelta(days=7))
+        self.assertEqual(looper.pending_timers, 0)
+
+
+class DojoBotTest(unittest.TestCase):
+    def setUp(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self._api = FakeBotApi()
+        self._metrics = bot.Metrics()
+        self.wait_for(self._api.start())
+
+    def tearDown(self):
+        self.wait_for(self._api.stop())
+        self._loop.close()
+
+    def wait_for(self, future):
+        return self._loop.run_until_complete(future)
+
+    async def send_all(self, target, n):
+        for i in range(n):
+            await target.sendMessage(USER_ID, "hello {}".format(i))
+        await target.getUpdates(None, 0)
+        await target.close()
+
+    def test_keepalive(self):
+        target = bot.DojoBot('TOKEN', self._metrics, self._api.url)
+        self.wait_for(self.send_all(target, 3))
+        self.assertEqual(len(self._api.calls), 4)
+        self.assertEqual(self._api.calls[0], ('sendMessage', { 'chat_id': USER_ID, 'text': 'hello 0' }))
+        self.assertEqual(self._metrics.count('bot.connections.created'), 1)
+        self.assertEqual(self._metrics.count('bot.connections.reused'), 3)
+
+    def test_no_keepalive(self):
+        target = bot.DojoBot('TOKEN', self._metrics, self._api.url, keepalive=False)
+        self.wait_for(self.send_all(target, 3))
+        self.assertEqual(self._metrics.count('bot.connections.created'), 4)
+        self.assertEqual(self._metrics.count('bot.connections.reused'), 0)
+
+    def test_shared_session(self):
+        async def send_from_both():
+            session = bot.DojoBot.make_session(self._metrics)
+            for token in ['TOKEN1', 'TOKEN2']:
+                await self.send_all(bot.DojoBot(token, bot.Metrics(), self._api.url, session=session), 2)
+            self.assertFalse(session.closed)
+            await session.close()
+        self.wait_for(send_from_both())
+        self.assertEqual(len(self._api.calls), 6)
+        self.assertEqual(self._metrics.count('bot.connections.created'), 1)
+        self.assertEqual(self._metrics.count('bot.connections.reused'), 5)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self._start = datetime.datetime(2016, 2, 1)
+        self._looper = bot.VirtualLooper(self._loop, self._start)
+
+    def tearDown(self):
+        self._loop.close()
+
+    def test_acquire(self):
+        limiter = bot.RateLimiter(self._looper, 2, burst=2)
+        passed = []
+        async def call(i):
+            await limiter.acquire()
+            passed.append((i, (self._looper.now() - self._start).total_seconds()))
+        for i in range(5):
+            self._loop.create_task(call(i))
+        self._loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(passed, [ (0, 0), (1, 0) ])
+        self._loop.run_until_complete(self._looper.advance_to(self._start + datetime.timedelta(seconds=10)))
+        self.assertEqual(passed, [ (0, 0), (1, 0), (2, 0.5), (3, 1.0), (4, 1.5) ])
+        # Idle time doesn't pile up into more than |burst|.
+        self.assertEqual(self._loop.run_until_complete(limiter.acquire()), 0)
+        self.assertEqual(self._loop.run_until_complete(limiter.acquire()), 0)
+        third = self._loop.create_task(limiter.acquire())
+        self._loop.run_until_complete(self._looper.advance_to(self._start + datetime.timedelta(seconds=11)))
+        self.assertEqual(third.result(), 0.5)
+
+
+class GroupAnnouncerTest(unittest.TestCase):
+    GROUP_ID = -100
+
+    def setUp(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self._start = datetime.datetime(2016, 2, 1, 9)
+        self._looper = bot.VirtualLooper(self._loop, self._start)
+        self._metrics = bot.Metrics()
+        self._bot = bot.DojoBot('TOKEN', self._metrics, looper=self._looper)
+        self._bot.sendMessage = get_mock_coro({ 'message_id': 7 })
+        self._bot.editMessageText = get_mock_coro()
+
+    def tearDown(self):
+        self._loop.close()
+
+    def wait_for(self, future):
+        return self._loop.run_until_complete(future)
+
+    def advance(self, seconds):
+        self.wait_for(asyncio.sleep(0))
+        self.wait_for(self._looper.advance_to(self._start + datetime.timedelta(seconds=seconds)))
+
+    def checkin(self, to, user_id):
+        rec = make_record_with_text('/ci15 hello', user_id=user_id)
+        self.wait_for(self._bot.declare_checkin(to, rec, bot.RecordStats(0, 0, 0)))
+
+    def test_coalesce(self):
+        for user_id in [1, 2, 3]:
+            self.checkin(self.GROUP_ID, user_id)
+        # Owners still hear back right away.
+        self.checkin(1, 1)
+        self.assertEqual(self._bot.sendMessage.call_count, 2)
+        self._bot.editMessageText.assert_not_called()
+
+        self.advance(bot.GroupAnnouncer.EDIT_DELAY_SECONDS)
+        self._bot.editMessageText.assert_called_once_with(self.GROUP_ID, 7, mock.ANY)
+        self.assertEqual(self._bot.editMessageText.call_args[0][2].count("Checked in!"), 3)
+        self.assertEqual(self._metrics.count('announcer.coalesced'), 2)
+
+    def test_window(self):
+        self.checkin(self.GROUP_ID, 1)
+        self.advance(bot.GroupAnnouncer.WINDOW_SECONDS)
+        self.checkin(self.GROUP_ID, 2)
+        self.assertEqual(self._bot.sendMessage.call_count, 2)
+        self.advance(bot.GroupAnnouncer.WINDOW_SECONDS + bot.GroupAnnouncer.EDIT_DELAY_SECONDS)
+        self._bot.editMessageText.assert_not_called()
+
+    def test_first_send_fails(self):
+        sending = self._loop.create_future()
+        async def send(chat_id, text, **kwargs):
+            if 1 == self._bot.sendMessage.call_count:
+                await sending
+                raise bot.BotApiError("Too Many Requests")
+            return { 'message_id': 8 }
+        self._bot.sendMessage = mock.Mock(wraps=send)
+        rec = make_record_with_text('/ci15 hello', user_id=1)
+        first = self._loop.create_task(self._bot.declare_checkin(self.GROUP_ID, rec, bot.RecordStats(0, 0, 0)))
+        self.wait_for(asyncio.sleep(0))
+        self.checkin(self.GROUP_ID, 2)
+        sending.set_result(None)
+        with self.assertRaises(bot.BotApiError):
+            self.wait_for(first)
+        # The check-in that joined the failed digest still goes out.
+        self.wait_for(asyncio.sleep(0))
+        self.assertEqual(self._bot.sendMessage.call_count, 2)
+        self.assertEqual(self._bot.sendMessage.call_args[0][1].count("Checked in!"), 1)
+
+    def test_edit_fails(self):
+        self._bot.editMessageText = mock.Mock(side_effect=bot.BotApiError("message to edit not found"))
+        for user_id in [1, 2, 3]:
+            self.checkin(self.GROUP_ID, user_id)
+        self.advance(bot.GroupAnnouncer.EDIT_DELAY_SECONDS)
+        # What the digest didn't show yet gets a message of its own.
+        self.assertEqual(self._bot.sendMessage.call_count, 2)
+        self.assertEqual(self._bot.sendMessage.call_args[0][1].count("Checked in!"), 2)
+        self.assertEqual(self._metrics.count('announcer.failed'), 1)
+
+    def test_app_waits_for_edits(self):
+        app = bot.DojoBotApp(self._bot, None, self._looper)
+        self.checkin(self.GROUP_ID, 1)
+        self.checkin(self.GROUP_ID, 2)
+        self.assertEqual(len(app._inflight), 1)
+        self.advance(bot.GroupAnnouncer.EDIT_DELAY_SECONDS)
+        self.assertEqual(len(app._inflight), 0)
+        self._bot.editMessageText.assert_called_once_with(self.GROUP_ID, 7, mock.ANY)
+
 
 class RecordStatsTest(unittest.TestCase):
     def test_format_weekly_monthly(self):
@@ -186,8 +477,8 @@ class CheckinTest(ConversationTest):
         self.wait_for(co.follow(make_message_with_text("Topic")))
 
     def test_needs_topics_suggested(self):
-        self._store.add_record(make_record_with_text('/ci15 LAST', user_id=USER_ID))
-        self._store.add_record(make_record_with_text('/ci20 LAST', user_id=USER_ID))
+        self._store.add_record(make_record_with_text('/ci15 LAST', user_id=USER_ID).with_closed())
+        self._store.add_record(make_record_with_text('/ci20 LAST', user_id=USER_ID).with_closed())
         co = self.wait_for(
             bot.CheckinConversation.start(
                 self._bot, self._store, FakeLooper(),
@@ -226,6 +517,7 @@ class CheckinTest(ConversationTest):
                 self._bot, self._store, FakeLooper(),
                 make_message_with_text('/ci30 hello, world')))
         self.assertEqual(self._store.record_stats(USER_ID).minutes, 15)
+        self.assertEqual(self._store.find_last_open_for(USER_ID).planned_minutes, 30)
 
     def test_wrong_minutes(self):
         co = self.wait_for(
@@ -343,6 +635,65 @@ class MongoStoreTest(unittest.TestCase):
         open1b = self._store.find_last_open_for(1)
         self.assertEqual(open1b, None)
 
+    def test_beginnings(self):
+        now = dp.parse('2016-03-10 12:34:56')
+        self.assertEqual(bot.MongoStore.beginning_of_this_week(now), dp.parse('2016-03-07'))
+        self.assertEqual(bot.MongoStore.beginning_of_this_month(now), dp.parse('2016-03-01'))
+
+    def test_weekly_stats_on_virtual_clock(self):
+        loop = asyncio.new_event_loop()
+        looper = bot.VirtualLooper(loop, dp.parse('2016-03-06 23:00:00'))
+        store = bot.MongoStore(DOCKER_MONGO_URL, looper)
+        store.add_record(bot.Record.from_message(
+            make_message_with_text('/ci15 Sunday'), looper.now()).with_closed(looper.now()))
+        self.assertEqual(store.record_stats_weekly(USER_ID).close_count, 1)
+        loop.run_until_complete(looper.advance_to(dp.parse('2016-03-07 01:00:00')))
+        self.assertEqual(store.record_stats_weekly(USER_ID).close_count, 0)
+        loop.close()
+
+    def test_add_closing(self):
+        open1 = self._store.add_record(make_record_with_text('/ci15 REC1', user_id=1))
+        open2 = self._store.add_record(
+            make_record_with_text('/ci30 REC2', user_id=1), closing=open1.with_closed())
+        self.assertEqual(self._store.find_last_open_for(1).id, open2.id)
+        self.assertEqual(self._store.record_stats(1).close_count, 1)
+
+    def test_add_twice_without_closing(self):
+        # Two quick /ci, both of which found nothing open.
+        open1 = self._store.add_record(make_record_with_text('/ci15 REC1', user_id=1))
+        open2 = self._store.add_record(make_record_with_text('/ci30 REC2', user_id=1))
+        self.assertEqual(self._store.find_last_open_for(1).id, open2.id)
+        self.assertEqual(self._store.record_stats(1).close_count, 1)
+        self.assertNotEqual(open1.id, open2.id)
+
+    def test_close_duplicate_opens(self):
+        self._store._records.drop_index('one_open_per_owner')
+        for minutes in [ 120, 60, 30 ]:
+            self._store._records.insert_one(
+                make_record_started_ago('/ci15 OLD', minutes, user_id=1).to_dict())
+        self._store._close_duplicate_opens()
+        self.assertEqual(self._store._records.count_documents({ 'state': bot.Record.OPEN }), 1)
+        self.assertEqual(self._store.record_stats(1).close_count, 2)
+        self.assertEqual(self._store.record_stats(1).actual_minutes, 90)
+
+    def test_add_closing_stale(self):
+        open1 = self._store.add_record(make_record_with_text('/ci15 REC1', user_id=1))
+        # Another checkin has won the race and replaced open1 already.
+        open2 = self._store.add_record(
+            make_record_with_text('/ci30 REC2', user_id=1), closing=open1.with_closed())
+        open3 = self._store.add_record(
+            make_record_with_text('/ci45 REC3', user_id=1), closing=open1.with_closed())
+        self.assertEqual(self._store.find_last_open_for(1).id, open3.id)
+        self.assertEqual(self._store.record_stats(1).close_count, 2)
+
+    def test_update_only_changes(self):
+        rec = self._store.add_record(make_record_with_text('/ci15 REC1', user_id=1))
+        with mock.patch.object(self._store._records, 'find_one_and_update', return_value=None) as update:
+            self._store.update_record(rec.with_closed(), rec)
+        update.assert_called_once_with(
+            { '_id': rec.id }, { '$set': { 'state': bot.Record.CLOSED, 'finished_at': mock.ANY } },
+            projection=mock.ANY)
+
     def test_record_stats(self):
         self._store.add_record(make_record_with_text('/ci15 REC1', user_id=1).with_closed())
         self._store.add_record(make_record_with_text('/ci30 REC2', user_id=1).with_closed())
@@ -357,23 +708,780 @@ class MongoStoreTest(unittest.TestCase):
         self.assertEqual(zero.close_count, 0)
         self.assertEqual(zero.abort_count, 0)
 
+    def test_expire_abandoned_records(self):
+        grace = datetime.timedelta(minutes=60)
+        self._store.add_record(make_record_started_ago('/ci15 OLD', 100, user_id=1))
+        self._store.add_record(make_record_started_ago('/ci60 RECENT', 100, user_id=2))
+        self._store.add_record(make_record_started_ago('/ci15 OLD', 100, user_id=3).with_closed())
+        self.assertEqual(self._store.expire_abandoned_records(grace, False, 10), 1)
+        self.assertEqual(self._store.find_last_open_for(1), None)
+        self.assertEqual(self._store.record_stats(1).abort_count, 1)
+        self.assertNotEqual(self._store.find_last_open_for(2), None)
+        self.assertEqual(self._store.expire_abandoned_records(grace, False, 10), 0)
+
+    def test_expire_abandoned_records_closing(self):
+        grace = datetime.timedelta(minutes=60)
+        for i in range(3):
+            self._store.add_record(make_record_started_ago('/ci15 OLD', 100, user_id=i))
+        self.assertEqual(self._store.expire_abandoned_records(grace, True, 2), 2)
+        self.assertEqual(self._store.expire_abandoned_records(grace, True, 2), 1)
+        self.assertEqual(self._store.record_stats(0).minutes, 15)
+
+    def test_archive_records(self):
+        self._store.add_record(make_record_started_ago('/ci15 OLD', 60 * 24 * 100, user_id=1).with_closed())
+        self._store.add_record(make_record_started_ago('/ci30 OLD', 60 * 24 * 100, user_id=1).with_aborted())
+        self._store.add_record(make_record_with_text('/ci20 NEW', user_id=1).with_closed())
+        horizon = datetime.datetime.utcnow() - datetime.timedelta(days=90)
+        self.assertEqual(self._store.archive_records(horizon, 10), 2)
+        self.assertEqual(self._store.record_count(), 1)
+        self.assertEqual(self._store.record_stats(1)[:3], (35, 2, 1))
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=200)
+        self.assertEqual(self._store.record_stats(1, since)[:3], (35, 2, 1))
+        self.assertEqual(self._store.record_stats(1, since, horizon)[:3], (15, 1, 1))
+        self.assertEqual(self._store.archive_records(horizon, 10), 0)
+
+    def test_archive_records_rerun(self):
+        old = make_record_started_ago('/ci15 OLD', 60 * 24 * 100, user_id=1).with_closed()
+        old = self._store.add_record(old)
+        horizon = datetime.datetime.utcnow() - datetime.timedelta(days=90)
+        # As if the previous run crashed before deleting the hot copy.
+        self._store._archive.insert_one(dict(old.to_dict(), _id=old.id))
+        self.assertEqual(self._store.archive_records(horizon, 10), 1)
+        self.assertEqual(self._store.record_stats(1)[:3], (15, 1, 0))
+
+    def test_record_days(self):
+        rec = self._store.add_record(make_record_started_ago('/ci30 REC1', 45, user_id=1))
+        self.assertEqual(self._store.record_stats(1), bot.RecordStats(0, 0, 0))
+        self._store.update_record(rec.with_closed(), rec)
+        self.assertEqual(self._store.record_stats(1), bot.RecordStats(30, 1, 0, 45))
+        # Recomputed rather than added up, so redoing it changes nothing.
+        self._store._update_day(1, rec.started_at)
+        days = self._store.record_days(1, rec.started_at - datetime.timedelta(days=7))
+        self.assertEqual(list(days.values()), [ bot.RecordStats(30, 1, 0, 45) ])
+
+    def test_backfill_record_days(self):
+        # A database from before the buckets.
+        rec = make_record_started_ago('/ci15 OLD', 60, user_id=1).with_closed()
+        self._store._records.insert_one(rec.to_dict())
+        self._store._state.delete_many({ '_id': bot.MongoStore.COL_DAYS })
+        store = bot.MongoStore(DOCKER_MONGO_URL)
+        # Counted from the records until the buckets are there.
+        self.assertEqual(store.record_stats(1).close_count, 1)
+        self.assertEqual(list(store.record_days(1, rec.started_at).values()), [ bot.RecordStats(15, 1, 0, 60) ])
+        self.assertEqual(store.backfill_record_days(), 1)
+        self.assertEqual(store._days.count_documents({}), 1)
+        self.assertEqual(store.record_stats(1).close_count, 1)
+        self.assertEqual(store.backfill_record_days(), 0)
+
+    def test_update_day_race(self):
+        rec = self._store.add_record(make_record_started_ago('/ci30 REC1', 45, user_id=1))
+        archive = self._store._archive
+        racing = []
+        def find(*args, **kwargs):
+            # Someone closes the record and updates the bucket while we
+            # are between reading the records and writing the bucket.
+            if not racing:
+                racing.append(True)
+                self._store._records.update_one({ '_id': rec.id }, { '$set': rec.with_closed().finish_dict() })
+                self._store._update_day(1, rec.started_at)
+            return archive.find(*args, **kwargs)
+        with mock.patch.object(self._store, '_archive', mock.Mock(wraps=archive, find=find)):
+            self._store._update_day(1, rec.started_at)
+        self.assertEqual(self._store.record_stats(1)[:3], (30, 1, 0))
+
+    def test_search_records(self):
+        old = self._store.add_record(
+            make_record_started_ago('/ci30 write paper', 60 * 24 * 100, user_id=1).with_closed())
+        self._store.archive_records(datetime.datetime.utcnow() - datetime.timedelta(days=90), 10)
+        # As if archiving it crashed before deleting the hot copy.
+        self._store._records.insert_one(dict(old.to_dict(), _id=old.id))
+        for text in [ '/ci15 Paper review', '/ci45 write code', '/ci20 read paper' ]:
+            self._store.add_record(make_record_with_text(text, user_id=1).with_closed())
+            time.sleep(0.001)
+        self._store.add_record(make_record_with_text('/ci60 paper', user_id=2).with_closed())
+        first = self._store.search_records(1, 'paper', page_size=2)
+        self.assertEqual(first.count, 3)
+        self.assertEqual(first.stats.close_count, 3)
+        self.assertEqual(first.stats.minutes, 65)
+        self.assertEqual([ r.topic for r in first.records ], [ 'read paper', 'Paper review' ])
+        self.assertTrue(first.has_more)
+        second = self._store.search_records(1, 'paper', page=1, page_size=2)
+        self.assertEqual([ r.topic for r in second.records ], [ 'write paper' ])
+        self.assertFalse(second.has_more)
+        self.assertEqual(self._store.search_records(1, 'nothing').format(), 'Nothing about "nothing" yet.')
+
+    def test_search_records_same_start(self):
+        rec = make_record_with_text('/ci15 paper', user_id=1).with_closed()
+        for i in range(3):
+            self._store._records.insert_one(rec.to_dict())
+        pages = [ self._store.search_records(1, 'paper', page=i, page_size=1).records[0].id for i in range(3) ]
+        self.assertEqual(len(set(pages)), 3)
+
+    def test_shared_client(self):
+        other = bot.MongoStore(DOCKER_MONGO_URL, client=self._store._client, database='cdjbot-test-other')
+        other.drop_all_collections()
+        other.add_record(make_record_with_text('/ci15 OTHER', user_id=1))
+        self.assertEqual(self._store.find_last_open_for(1), None)
+        self.assertEqual(other.find_last_open_for(1).topic, 'OTHER')
+        other.drop_all_collections()
+
     def test_upsert_user(self):
         self._store.upsert_user(make_test_user())
-        self.assertEqual(self._store._users.count(), 1)
+        self.assertEqual(self._store._users.count_documents({}), 1)
         self._store.upsert_user(make_test_user())
-        self.assertEqual(self._store._users.count(), 1)
+        self.assertEqual(self._store._users.count_documents({}), 1)
 
     def test_find_recent_record_topics(self):
-        self._store.add_record(make_record_with_text('/ci15 REC1', user_id=1))
+        self._store.add_record(make_record_with_text('/ci15 REC1', user_id=1).with_closed())
         time.sleep(0.001)
-        self._store.add_record(make_record_with_text('/ci30 REC2', user_id=1))
+        self._store.add_record(make_record_with_text('/ci30 REC2', user_id=1).with_closed())
         time.sleep(0.001)
-        self._store.add_record(make_record_with_text('/ci60 REC3', user_id=1))
-        self._store.add_record(make_record_with_text('/ci60 REC3', user_id=1))
+        self._store.add_record(make_record_with_text('/ci60 REC3', user_id=1).with_closed())
+        self._store.add_record(make_record_with_text('/ci60 REC3', user_id=1).with_closed())
         topics = self._store.find_recent_record_topics(1, 3)
         self.assertEqual(sorted(topics), ["REC2", "REC3"])
 
 
+class EventStoreTest(unittest.TestCase):
+    def setUp(self):
+        self._store = bot.EventStore(DOCKER_MONGO_URL)
+        self._store.drop_all_collections()
+
+    def test_checkin_checkout(self):
+        rec = self._store.add_record(make_record_with_text('/ci15 REC1', user_id=1))
+        # Nothing is projected until someone asks.
+        self.assertEqual(self._store.record_count(), 0)
+        self.assertEqual(self._store.find_last_open_for(1).id, rec.id)
+        self._store.update_record(rec.with_closed(), rec)
+        self.assertEqual(self._store.find_last_open_for(1), None)
+        self.assertEqual(self._store.record_stats(1).close_count, 1)
+        self.assertEqual(self._store.find_recent_record_topics(1, 3), ['REC1'])
+        self.assertEqual(
+            [ e['type'] for e in self._store._events.find(sort=[ ('_id', 1) ]) ],
+            [ bot.EventStore.CHECKIN, bot.EventStore.CHECKOUT ])
+
+    def test_projector(self):
+        self._store.add_record(make_record_with_text('/ci15 REC1', user_id=1).with_aborted())
+        loop = asyncio.new_event_loop()
+        metrics = bot.Metrics()
+        loop.run_until_complete(bot.Projector(bot.Looper(loop), metrics, self._store).tick())
+        loop.close()
+        self.assertEqual(metrics.count('projector.events'), 1)
+        self.assertEqual(self._store.record_count(), 1)
+        self.assertEqual(self._store.record_stats(1).abort_count, 1)
+
+    def test_add_twice(self):
+        rec = self._store.add_record(make_record_with_text('/ci15 REC1', user_id=1))
+        self._store.add_record(rec)
+        self.assertEqual(self._store._events.count_documents({}), 1)
+
+    def test_checkin_ends_open(self):
+        self._store.add_record(make_record_with_text('/ci15 REC1', user_id=1))
+        rec2 = self._store.add_record(make_record_with_text('/ci15 REC2', user_id=1))
+        self.assertEqual(self._store.find_last_open_for(1).id, rec2.id)
+        self.assertEqual(self._store.record_stats(1).close_count, 1)
+
+    def test_expire_abandoned_records(self):
+        grace = datetime.timedelta(minutes=60)
+        rec = self._store.add_record(make_record_started_ago('/ci15 OLD', 100, user_id=1))
+        self.assertEqual(self._store.expire_abandoned_records(grace, False, 10), 1)
+        # Checked out before the expiry got projected.
+        self._store.update_record(rec.with_closed(), rec)
+        self.assertEqual(self._store.expire_abandoned_records(grace, False, 10), 0)
+        self.assertEqual(self._store.record_stats(1).abort_count, 1)
+        self.assertEqual(self._store.record_stats(1).close_count, 0)
+
+    def test_update_record_fields_before_projection(self):
+        rec = self._store.add_record(make_record_with_text('/ci15 REC1', user_id=1))
+        self._store.update_record_fields(rec.id, { 'topic': 'REC2' })
+        self.assertEqual(self._store.find_last_open_for(1).topic, 'REC2')
+
+    def test_restart(self):
+        rec = self._store.add_record(make_record_with_text('/ci15 REC1', user_id=1))
+        self._store.update_record(rec.with_closed(), rec)
+        self._store.project()
+        restarted = bot.EventStore(DOCKER_MONGO_URL)
+        # Events within the settle window are applied again, to the same end.
+        self.assertEqual(restarted.project(), 2)
+        self.assertEqual(restarted.record_stats(1).close_count, 1)
+        self.assertEqual(restarted.find_last_open_for(1), None)
+
+    def test_rebuild_projections(self):
+        for i, text in enumerate([ '/ci15 REC1', '/ci30 REC2', '/ci45 REC1' ]):
+            rec = self._store.add_record(make_record_with_text(text, user_id=i % 2))
+            self._store.update_record(rec.with_closed(), rec)
+        self._store.add_record(make_record_with_text('/ci60 OPEN', user_id=1))
+        self._store.project()
+        summary = self._store.record_summary()
+        self.assertEqual(self._store.rebuild_projections(), 7)
+        self.assertEqual(self._store.record_summary(), summary)
+        self.assertEqual(self._store.record_stats(0).minutes, 60)
+        self.assertEqual(sorted(self._store.find_recent_record_topics(1, 3)), ['OPEN', 'REC2'])
+
+    def test_catch_up_one_owner(self):
+        rec = self._store.add_record(make_record_with_text('/ci15 REC1', user_id=1))
+        self._store.add_record(make_record_with_text('/ci15 REC2', user_id=2))
+        self.assertEqual(self._store.find_last_open_for(1).id, rec.id)
+        # Only the reader's own events, and the projector still has the rest.
+        self.assertEqual(self._store.record_count(), 1)
+        self.assertIsNone(self._store._state.find_one({ '_id': bot.EventStore.CHECKPOINT_ID }))
+        self._store.update_record(rec.with_topic('REC3'), rec)
+        self.assertEqual(self._store.project(), 3)
+        self.assertEqual(self._store.record_count(), 2)
+        self.assertEqual(self._store.find_last_open_for(1).topic, 'REC3')
+
+    def test_catch_up_while_projecting(self):
+        self._store.add_record(make_record_with_text('/ci15 REC1', user_id=1))
+        with self._store._project_lock, mock.patch.object(bot.EventStore, 'CATCH_UP_WAIT_SECONDS', 0.01):
+            self.assertIsNone(self._store.find_last_open_for(1))
+        self.assertIsNotNone(self._store.find_last_open_for(1))
+
+    def test_rebuild_after_archive(self):
+        old = make_record_started_ago('/ci15 OLD', 60 * 24 * 100, user_id=1).with_closed()
+        self._store.add_record(old)
+        self._store.project()
+        horizon = datetime.datetime.utcnow() - datetime.timedelta(days=90)
+        self.assertEqual(self._store.archive_records(horizon, 10), 1)
+        self._store.rebuild_projections()
+        self.assertEqual(self._store.record_count(), 0)
+        self.assertEqual(self._store.record_stats(1).close_count, 1)
+        self.assertEqual(self._store.find_recent_record_topics(1, 3), ['OLD'])
+
+    def test_backfill_events(self):
+        before = bot.MongoStore(DOCKER_MONGO_URL)
+        before.add_record(make_record_with_text('/ci15 OLD', user_id=1).with_closed())
+        self.assertEqual(self._store.backfill_events(), 1)
+        self.assertEqual(self._store.backfill_events(), 0)
+        self._store.add_record(make_record_with_text('/ci15 NEW', user_id=1).with_closed())
+        self._store.rebuild_projections()
+        self.assertEqual(self._store.record_count(), 2)
+        self.assertEqual(self._store.record_stats(1).close_count, 2)
+
+
+class AnalyticsTest(unittest.TestCase):
+    def setUp(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def tearDown(self):
+        self._loop.close()
+
+    def make_row(self, started, minutes, took=None, state=bot.Record.CLOSED, owner_id=USER_ID):
+        started = dp.parse(started)
+        finished = started + datetime.timedelta(minutes=took or minutes)
+        return { 'owner_id': owner_id, 'started_at': started, 'planned_minutes': minutes,
+                 'finished_at': None if state == bot.Record.OPEN else finished, 'state': state }
+
+    def test_compute(self):
+        rows = [
+            self.make_row('2016-03-05 09:10', 30, took=40),
+            self.make_row('2016-03-06 09:20', 30),
+            self.make_row('2016-03-07 21:00', 60, took=50),
+            self.make_row('2016-03-07 22:00', 15, state=bot.Record.ABORTED),
+            self.make_row('2016-03-09 10:00', 30),
+            self.make_row('2016-03-10 08:00', 15, state=bot.Record.OPEN),
+        ]
+        report = analytics.Report.compute(analytics.RecordColumns(rows), dp.parse('2016-03-10').date())
+        self.assertEqual((report.closed, report.aborted), (4, 1))
+        self.assertAlmostEqual(report.completion_rate, 0.8)
+        self.assertEqual(report.by_hour[9], 2)
+        self.assertEqual(report.by_weekday, [2, 0, 1, 1, 0, 1, 1])
+        self.assertEqual((report.current_streak, report.longest_streak), (1, 3))
+        self.assertAlmostEqual(report.planned_minutes, 37.5)
+        self.assertAlmostEqual(report.actual_minutes, 37.5)
+        self.assertAlmostEqual(report.overrun_rate, 0.25)
+        self.assertIn("80% completed", report.format())
+
+    def test_empty(self):
+        report = analytics.Report.compute(analytics.RecordColumns([]), datetime.date(2016, 3, 10))
+        self.assertEqual(report.closed, 0)
+        self.assertEqual(sum(report.by_hour), 0)
+        self.assertIn("Nothing to report", report.format())
+
+    def test_cache(self):
+        store = make_clean_mongo_store()
+        cache = analytics.ReportCache(store)
+        report_for = lambda: self._loop.run_until_complete(
+            cache.report_for(FakeLooper(), ('user', USER_ID), [ USER_ID ]))
+        rec = store.add_record(make_record_with_text('/ci15 hello'))
+        self.assertEqual(report_for().closed, 0)
+        store.update_record(rec.with_closed(), rec)
+        first = report_for()
+        self.assertEqual(first.closed, 1)
+        self.assertIs(report_for(), first)
+        store.add_record(make_record_with_text('/ci15 again'))
+        self.assertIsNot(report_for(), first)
+
+
+class DiagnosticsTest(unittest.TestCase):
+    def setUp(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def tearDown(self):
+        self._loop.close()
+        tracemalloc.stop()
+
+    def test_profiled(self):
+        diagnostics = bot.Diagnostics(profile_every=2)
+        async def update(i):
+            await asyncio.sleep(0)
+            return sorted(range(i))
+        for i in range(4):
+            self.assertEqual(self._loop.run_until_complete(diagnostics.profiled(update(i))), list(range(i)))
+        report = diagnostics.profile_report()
+        self.assertIn("Profiled 2 of 4 updates", report)
+        self.assertIn("update", report)
+
+    def test_off(self):
+        diagnostics = bot.Diagnostics()
+        coro = asyncio.sleep(0)
+        self.assertIs(diagnostics.profiled(coro), coro)
+        self._loop.run_until_complete(coro)
+
+    def test_memory_diff(self):
+        diagnostics = bot.Diagnostics()
+        self.assertIn("from now on", diagnostics.memory_diff())
+        grown = [ str(i) * 10 for i in range(10000) ]
+        self.assertIn("Top growth", diagnostics.memory_diff())
+
+
+class TracerTest(unittest.TestCase):
+    def setUp(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, 'spans')
+        self._spans = bot.SpanFile(self._path)
+        bot.tracer.start(self._spans)
+
+    def tearDown(self):
+        bot.tracer.stop()
+        self._spans.close()
+        self._loop.close()
+        self._dir.cleanup()
+
+    def read_spans(self):
+        bot.tracer.stop()
+        self._spans.close()
+        return { s['name']: s for s in bot.SpanFile.read(self._path) }
+
+    def test_update(self):
+        app = bot.DojoBotApp(make_mock_bot(), make_clean_mongo_store(), FakeLooper())
+        self._loop.run_until_complete(app._handle(make_message_dict('/ci15 hello')))
+        spans = self.read_spans()
+        root = spans['update']
+        self.assertNotIn('parentId', root)
+        self.assertEqual(root['tags'], { 'command': '/ci15' })
+        self.assertEqual(spans['checkin.finish']['parentId'], root['id'])
+        self.assertEqual(spans['store.add_record']['parentId'], spans['checkin.finish']['id'])
+        self.assertEqual(spans['store.find_user']['traceId'], root['traceId'])
+        # The reminder, which FakeLooper doesn't wait for, is traced on its own.
+        self.assertNotIn('parentId', spans['checkin.remind'])
+        self.assertNotEqual(spans['checkin.remind']['traceId'], root['traceId'])
+
+    def test_executor(self):
+        async def run():
+            with bot.tracer.span('outer'):
+                await bot.Looper(self._loop).run_in_executor(
+                    bot.traced('inner')(lambda: None))
+        self._loop.run_until_complete(run())
+        spans = self.read_spans()
+        self.assertEqual(spans['inner']['parentId'], spans['outer']['id'])
+
+    def test_off(self):
+        bot.tracer.stop()
+        self.assertIs(bot.tracer.span('nothing'), bot.Tracer.NULL_SPAN)
+
+
+# Matches topics with a regex rather than the text index, which some
+# stand-ins for mongod lack, so the rest of search_records() runs anyway.
+class RegexSearchMongoStore(bot.MongoStore):
+    def _search_match(self, owner_id, query):
+        words = "|".join(re.escape(w) for w in query.split())
+        return { 'owner_id': owner_id, 'topic': { '$regex': r'\b({})\b'.format(words), '$options': 'i' } }
+
+
+class SearchRecordsTest(unittest.TestCase):
+    def setUp(self):
+        self._store = RegexSearchMongoStore(DOCKER_MONGO_URL)
+        self._store.drop_all_collections()
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def tearDown(self):
+        self._loop.close()
+
+    def test_hot_and_archived(self):
+        old = self._store.add_record(
+            make_record_started_ago('/ci30 old paper', 60 * 24 * 100, user_id=1).with_closed())
+        self._store.archive_records(datetime.datetime.utcnow() - datetime.timedelta(days=90), 10)
+        # Archived, but the hot copy isn't deleted yet.
+        self._store._records.insert_one(dict(old.to_dict(), _id=old.id))
+        same = make_record_started_ago('/ci15 paper', 60, user_id=1).with_closed()
+        for i in range(3):
+            self._store._records.insert_one(same.to_dict())
+        newest = self._store.add_record(make_record_with_text('/ci15 new paper', user_id=1).with_closed())
+        self._store.add_record(make_record_with_text('/ci15 code', user_id=1).with_closed())
+        pages = [ self._store.search_records(1, 'paper', page=i, page_size=2) for i in range(3) ]
+        self.assertEqual([ p.count for p in pages ], [ 5, 5, 5 ])
+        self.assertEqual(pages[0].stats.minutes, 90)
+        ids = [ r.id for p in pages for r in p.records ]
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual((ids[0], ids[-1]), (newest.id, old.id))
+        self.assertEqual([ p.has_more for p in pages ], [ True, True, False ])
+
+    def test_stop(self):
+        bot_ = make_mock_bot()
+        store = mock.Mock(bot.MongoStore)
+        store.search_records.return_value = bot.SearchResult('paper', [], 11, bot.RecordStats(0, 0, 0), 0, 10)
+        conv = self._loop.run_until_complete(bot.SearchConversation.start(
+            bot_, store, FakeLooper(), make_message_with_text('/search paper')))
+        self.assertTrue(conv.needs_more)
+        self._loop.run_until_complete(conv.follow(make_message_with_text('more')))
+        store.search_records.assert_called_with(USER_ID, 'paper', 1)
+        self._loop.run_until_complete(conv.follow(make_message_with_text('thanks')))
+        bot_.tell_error.assert_called_once_with(USER_ID, mock.ANY)
+        self.assertFalse(conv.needs_more)
+
+
+# Remembers where each read went.
+class RoutingMongoStore(bot.MongoStore):
+    def __init__(self, url):
+        super().__init__(url)
+        self.routes = []
+
+    def _route(self, op, owner_ids=()):
+        found = super()._route(op, owner_ids)
+        self.routes.append((op, found[0]))
+        return found
+
+
+class ReadRoutingTest(unittest.TestCase):
+    def setUp(self):
+        self._store = RoutingMongoStore(DOCKER_MONGO_URL)
+        self._store.drop_all_collections()
+
+    def routes_of(self, fn, *args):
+        self._store.routes = []
+        fn(*args)
+        return self._store.routes
+
+    def test_routes(self):
+        store = self._store
+        self.assertEqual(self.routes_of(store.find_last_open_for, 1), [ ('find_last_open_for', 'primary') ])
+        self.assertEqual(self.routes_of(store.record_stats, 1), [ ('record_stats', 'secondary') ])
+        self.assertEqual(self.routes_of(store.find_recent_record_topics, 1, 5),
+                         [ ('find_recent_record_topics', 'secondary') ])
+        self.assertEqual(self.routes_of(store.find_user, 1), [ ('find_user', 'secondary') ])
+
+    def test_read_your_writes(self):
+        store = self._store
+        store.add_record(make_record_with_text('/ci15 REC1', user_id=1).with_closed())
+        self.assertEqual(self.routes_of(store.record_stats_weekly, 1), [ ('record_stats', 'primary') ])
+        self.assertEqual(self.routes_of(store.record_stats_weekly, 2), [ ('record_stats', 'secondary') ])
+        self.assertEqual(store.record_stats_weekly(1).close_count, 1)
+        # Once the secondaries have surely caught up.
+        store._written_at[1] -= bot.MongoStore.MAX_STALENESS_SECONDS + 1
+        self.assertEqual(self.routes_of(store.record_stats_weekly, 1), [ ('record_stats', 'secondary') ])
+
+    def test_forget_old_writes(self):
+        store = self._store
+        store.mark_written(1)
+        later = time.monotonic() + bot.MongoStore.MAX_STALENESS_SECONDS + 1
+        with mock.patch.object(bot.time, 'monotonic', return_value=later):
+            store.mark_written(2)
+        self.assertEqual(list(store._written_at), [ 2 ])
+
+    def test_journaled_writes(self):
+        with tempfile.TemporaryDirectory() as d:
+            journal = bot.Journal(os.path.join(d, 'journal'))
+            journaled = bot.JournaledStore(self._store, journal)
+            journaled.add_record(make_record_with_text('/ci15 REC1', user_id=1))
+            journal.close()
+        # Not in the store yet, but it will be soon.
+        self.assertEqual(self.routes_of(self._store.record_stats_weekly, 1), [ ('record_stats', 'primary') ])
+
+
+class BackgroundJobTest(unittest.TestCase):
+    class Job(bot.BackgroundJob):
+        def __init__(self, looper, metrics):
+            super().__init__(looper, metrics, 10)
+            self.running = None
+            self.ran = 0
+
+        async def run_once(self):
+            await self.running
+            self.ran += 1
+
+    def setUp(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self._start = datetime.datetime(2016, 2, 1)
+        self._looper = bot.VirtualLooper(self._loop, self._start)
+        self._job = self.Job(self._looper, bot.Metrics())
+        self._job.running = self._loop.create_future()
+        self._task = self._loop.create_task(self._job.run())
+        self._loop.run_until_complete(asyncio.sleep(0))
+
+    def tearDown(self):
+        self._loop.close()
+
+    def test_stop_idle(self):
+        self._loop.run_until_complete(self._job.stop())
+        self.assertTrue(self._task.done())
+        self.assertEqual(self._job.ran, 0)
+
+    def test_stop_lets_tick_finish(self):
+        self._loop.run_until_complete(self._looper.advance_to(self._start + datetime.timedelta(seconds=10)))
+        stopping = self._loop.create_task(self._job.stop())
+        self._loop.run_until_complete(asyncio.sleep(0))
+        self.assertFalse(stopping.done())
+        self._job.running.set_result(None)
+        self._loop.run_until_complete(stopping)
+        self.assertEqual(self._job.ran, 1)
+        self.assertTrue(self._task.done())
+
+
+class SweeperTest(unittest.TestCase):
+    def setUp(self):
+        self._store = make_clean_mongo_store()
+        self._metrics = bot.Metrics()
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def tearDown(self):
+        self._loop.close()
+
+    def test_batches(self):
+        for i in range(5):
+            self._store.add_record(make_record_started_ago('/ci15 OLD', 100, user_id=i))
+        sweeper = bot.Sweeper(FakeLooper(), self._metrics, self._store, batch_size=2)
+        self._loop.run_until_complete(sweeper.tick())
+        self.assertEqual(self._metrics.count('sweeper.expired'), 5)
+        self.assertEqual(self._metrics.count('sweeper.batches'), 3)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            bot.Sweeper(FakeLooper(), self._metrics, self._store, policy='forget')
+
+    def test_bad_records(self):
+        # Left by versions which took any number of minutes, or none.
+        for user_id, minutes in [ (1, 9999999999), (2, None) ]:
+            rec = make_record_started_ago('/ci15 OLD', 60 * 24 * 2, user_id=user_id)
+            self._store._records.insert_one(rec._replace(planned_minutes=minutes).to_dict())
+        self._store.add_record(make_record_started_ago('/ci15 OLD', 100, user_id=3))
+        sweeper = bot.Sweeper(FakeLooper(), self._metrics, self._store)
+        self._loop.run_until_complete(sweeper.tick())
+        self.assertEqual(self._metrics.count('sweeper.errors'), 0)
+        # The first runs a day at most. The second can't tell and stays open.
+        self.assertEqual(self._metrics.count('sweeper.expired'), 2)
+        self.assertIsNone(self._store.find_last_open_for(1))
+        self.assertEqual(self._store.find_last_open_for(2).state, bot.Record.OPEN)
+        self.assertIsNone(self._store.find_last_open_for(3))
+
+
+# A local stand-in for MongoStore which can be taken down.
+class OutageStore(object):
+    def __init__(self):
+        self.down = False
+        self.failure = pymongo.errors.AutoReconnect
+        self.records = {}
+        self.users = {}
+
+    def _check(self):
+        if self.down:
+            raise self.failure("down")
+
+    def add_record(self, rec, closing=None):
+        self._check()
+        if closing and self.records[closing.id].state == bot.Record.OPEN:
+            self.records[closing.id] = closing
+        self.records.setdefault(rec.id, rec)
+        return rec
+
+    def update_record_fields(self, id, fields):
+        self._check()
+        self.records[id] = self.records[id]._replace(**fields)
+
+    def find_last_open_for(self, owner_id):
+        self._check()
+        found = [ r for r in self.records.values()
+                  if r.owner_id == owner_id and r.state == bot.Record.OPEN ]
+        return found[0] if found else None
+
+    def record_stats_weekly(self, owner_id):
+        self._check()
+        return bot.RecordStats(0, 0, 0)
+
+    def find_recent_record_topics(self, owner_id, n):
+        self._check()
+        return []
+
+    def find_user(self, id):
+        self._check()
+        return None
+
+    def record_stats(self, owner_id, since=None, until=None):
+        self._check()
+        return bot.RecordStats(0, 0, 0)
+
+    def find_users_in_chat(self, chat_id):
+        self._check()
+        return []
+
+    def upsert_user(self, user):
+        self._check()
+        self.users[user.telegram_id] = user
+
+    def take_app_state(self):
+        self._check()
+        return {}
+
+    def mark_written(self, owner_id):
+        pass
+
+    def stream_record_fields(self, owner_ids, fields):
+        self._check()
+        for rec in self.records.values():
+            yield { f: getattr(rec, f) for f in fields }
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_half_open(self):
+        breaker = bot.CircuitBreaker(threshold=2, reset_seconds=30)
+        with mock.patch.object(bot.time, 'monotonic', return_value=100):
+            breaker.failed()
+            self.assertTrue(breaker.allows())
+            breaker.failed()
+            self.assertFalse(breaker.allows())
+        with mock.patch.object(bot.time, 'monotonic', return_value=130):
+            # A single trial call.
+            self.assertTrue(breaker.allows())
+            self.assertFalse(breaker.allows())
+            breaker.succeeded()
+            self.assertTrue(breaker.allows())
+
+
+class JournaledStoreTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, 'journal')
+        self._backing = OutageStore()
+        self._metrics = bot.Metrics()
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def tearDown(self):
+        self._loop.close()
+        self._dir.cleanup()
+
+    def make_store(self):
+        return bot.JournaledStore(
+            self._backing, bot.Journal(self._path), bot.CircuitBreaker(threshold=1))
+
+    def flush(self, store):
+        self._loop.run_until_complete(store.flush(FakeLooper(), self._metrics))
+
+    def test_outage(self):
+        self._backing.down = True
+        store = self.make_store()
+        rec = store.add_record(make_record_with_text('/ci15 hello'))
+        self.assertEqual(store.find_last_open_for(USER_ID).id, rec.id)
+        self.flush(store)
+        self.assertTrue(store.breaker.is_open)
+        self.assertEqual(self._backing.records, {})
+        # Reads degrade instead of raising while the breaker is open.
+        self.assertEqual(store.find_recent_record_topics(USER_ID, 5), [])
+        store.update_record(rec.with_closed(), rec)
+        self.assertEqual(store.find_last_open_for(USER_ID), None)
+
+        self._backing.down = False
+        store.breaker.succeeded()
+        self.flush(store)
+        self.assertEqual(self._backing.records[rec.id].state, bot.Record.CLOSED)
+        self.assertEqual(self._metrics.count('journal.replayed'), 2)
+
+    def test_read_timeout(self):
+        self._backing.down = True
+        self._backing.failure = pymongo.errors.ExecutionTimeout
+        store = self.make_store()
+        self.assertEqual(store.find_user(USER_ID), None)
+        self.assertTrue(store.breaker.is_open)
+
+    def test_iamhere(self):
+        self._backing.down = True
+        store = self.make_store()
+        app = bot.DojoBotApp(make_mock_bot(), store, FakeLooper())
+        self._loop.run_until_complete(app._handle(json.loads(MSG_JSON_WITH_CHAT)))
+        app._bot.tell_where_you_are.assert_called_once_with(5678, 'foo', -6789, 'The Title')
+        self.assertEqual(store.find_user(5678).chat_id, -6789)
+        self.assertEqual(self._backing.users, {})
+
+        self._backing.down = False
+        store.breaker.succeeded()
+        self.flush(store)
+        self.assertEqual(self._backing.users[5678].chat_id, -6789)
+
+    def test_fail_fast(self):
+        self._backing.down = True
+        store = self.make_store()
+        with self.assertRaises(pymongo.errors.AutoReconnect):
+            store.take_app_state()
+        self.assertTrue(store.breaker.is_open)
+        self._backing.take_app_state = mock.Mock()
+        with self.assertRaises(pymongo.errors.ConnectionFailure):
+            store.take_app_state()
+        self._backing.take_app_state.assert_not_called()
+        self.assertEqual(store.record_stats(USER_ID), bot.RecordStats(0, 0, 0))
+
+    def test_read_fallbacks(self):
+        store = self.make_store()
+        self._backing.records = { 1: make_record_with_text('/ci15 hello') }
+        self.assertEqual(list(store.stream_record_fields([USER_ID], ['topic'])), [ { 'topic': 'hello' } ])
+        self._backing.down = True
+        self.assertEqual(list(store.stream_record_fields([USER_ID], ['topic'])), [])
+        self.assertTrue(store.breaker.is_open)
+        # No more calls to the store until the breaker closes.
+        self._backing.find_users_in_chat = mock.Mock()
+        self.assertEqual(store.find_users_in_chat(-100), [])
+        self._backing.find_users_in_chat.assert_not_called()
+
+    def test_checkin_over_open_session(self):
+        mongo = make_clean_mongo_store()
+        ongoing = mongo.add_record(make_record_started_ago('/ci60 before', 30))
+        store = bot.JournaledStore(mongo, bot.Journal(self._path), bot.CircuitBreaker(threshold=1))
+        # Mongo goes away, and the /ci which follows doesn't see the open session.
+        store.breaker.failed()
+        self.assertEqual(store.find_last_open_for(USER_ID), None)
+        rec = store.add_record(make_record_with_text('/ci15 during'))
+        store.update_record(rec.with_topic('during outage'), rec)
+
+        store.breaker.succeeded()
+        self.flush(store)
+        self.assertEqual(self._metrics.count('journal.refused'), 0)
+        found = mongo.find_last_open_for(USER_ID)
+        self.assertEqual((found.id, found.topic), (rec.id, 'during outage'))
+        self.assertEqual(mongo.record_stats(USER_ID).close_count, 1)
+        self.assertEqual(mongo.record_stats(USER_ID).actual_minutes, 30)
+        self.assertNotEqual(ongoing.id, found.id)
+
+    def test_recover(self):
+        self._backing.down = True
+        store = self.make_store()
+        rec = store.add_record(make_record_with_text('/ci15 hello'))
+        store._journal.close()
+        with open(self._path, 'a') as f:
+            f.write('{"torn": ')
+
+        self._backing.down = False
+        recovered = self.make_store()
+        self.assertEqual(recovered.find_last_open_for(USER_ID).id, rec.id)
+        self.flush(recovered)
+        self.assertEqual(self._backing.records[rec.id].topic, 'hello')
+        self.assertEqual(len(bot.Journal(self._path)), 0)
+
+
 class AppTest(unittest.TestCase):
     def setUp(self):
         self._bot = make_mock_bot()
@@ -401,6 +1509,113 @@ class AppTest(unittest.TestCase):
         self.wait_for(
             app._handle(make_message_dict('/co')))
 
+    def test_chist(self):
+        app = bot.DojoBotApp(self._bot, self._store, self._looper)
+        self.wait_for(app._handle(make_message_dict('/ci15 hello, world')))
+        self.wait_for(app._handle(make_message_dict('/co')))
+        self.wait_for(app._handle(make_message_dict('/chist')))
+        text = self._bot.tell_stats.call_args[0][1]
+        self.assertEqual(len(text.split("\n")), 9)
+        self.assertIn("1 CI, 15 minutes planned", text)
+
+    def test_memdiff_for_admins_only(self):
+        app = bot.DojoBotApp(self._bot, self._store, self._looper,
+                             diagnostics=bot.Diagnostics(admin_ids=[ USER_ID ]))
+        self.wait_for(app._handle(make_message_dict('/memdiff', user_id=5678)))
+        self._bot.tell_error.assert_called_once_with(5678, mock.ANY)
+        self.wait_for(app._handle(make_message_dict('/memdiff')))
+        self._bot.sendMessage.assert_called_once_with(USER_ID, mock.ANY)
+        tracemalloc.stop()
+
+    def test_report(self):
+        app = bot.DojoBotApp(self._bot, self._store, self._looper)
+        self.wait_for(app._handle(make_message_dict('/ci15 hello, world')))
+        self.wait_for(app._handle(make_message_dict('/co')))
+        self.wait_for(app._handle(make_message_dict('/report')))
+        self._bot.tell_report.assert_called_once_with(USER_ID, mock.ANY)
+        self.assertIn("1 done", self._bot.tell_report.call_args[0][1])
+
+    def test_search(self):
+        app = bot.DojoBotApp(self._bot, self._store, self._looper)
+        for i in range(bot.MongoStore.SEARCH_PAGE_SIZE + 1):
+            self.wait_for(app._handle(make_message_dict('/ci15 hello, world {}'.format(i))))
+            self.wait_for(app._handle(make_message_dict('/co')))
+        self.wait_for(app._handle(make_message_dict('/search world')))
+        result = self._bot.tell_search_results.call_args[0][1]
+        self.assertEqual(result.count, bot.MongoStore.SEARCH_PAGE_SIZE + 1)
+        self.assertTrue(result.has_more)
+        self.wait_for(app._handle(make_message_dict('more')))
+        result = self._bot.tell_search_results.call_args[0][1]
+        self.assertEqual([ r.topic for r in result.records ], [ 'hello, world 0' ])
+        self.assertIsNone(app._conversations[USER_ID])
+
+    def test_search_stop(self):
+        app = bot.DojoBotApp(self._bot, self._store, self._looper)
+        for i in range(bot.MongoStore.SEARCH_PAGE_SIZE + 1):
+            self._store.add_record(make_record_with_text('/ci15 hello {}'.format(i)).with_closed())
+        self.wait_for(app._handle(make_message_dict('/search hello')))
+        self.wait_for(app._handle(make_message_dict('thanks')))
+        self._bot.tell_error.assert_called_once_with(USER_ID, mock.ANY)
+        self.assertIn('/search', self._bot.tell_error.call_args[0][1])
+        self.assertIsNone(app._conversations[USER_ID])
+
+    def test_update_limiter(self):
+        start = datetime.datetime(2016, 2, 1)
+        looper = bot.VirtualLooper(self._loop, start)
+        metrics = bot.Metrics()
+        app = bot.DojoBotApp(self._bot, self._store, looper, metrics, update_limiter=bot.RateLimiter(looper, 1))
+        app._handle = get_mock_coro()
+        self.wait_for(app._take(make_message_dict('/ci15 hello')))
+        # The message loop waits, rather than the update after it's taken.
+        taking = self._loop.create_task(app._take(make_message_dict('/co')))
+        self.wait_for(asyncio.sleep(0))
+        self.assertFalse(taking.done())
+        self.assertEqual(app._handle.call_count, 1)
+        self.wait_for(looper.advance_to(start + datetime.timedelta(seconds=1)))
+        self.assertTrue(taking.done())
+        self.assertEqual(app._handle.call_count, 2)
+        self.assertEqual(metrics.count('app.updates.throttled'), 1)
+
+    def test_checkin_finishing_during_shutdown(self):
+        metrics = bot.Metrics()
+        app = bot.DojoBotApp(self._bot, self._store, bot.Looper(self._loop), metrics)
+        declaring = self._loop.create_future()
+        async def declare_checkin(*args):
+            await declaring
+        self._bot.declare_checkin = mock.Mock(wraps=declare_checkin)
+        app._dispatch(make_message_dict('/ci15 hello'))
+        self.wait_for(asyncio.sleep(0))
+        stopping = self._loop.create_task(app.shutdown(2))
+        self.wait_for(asyncio.sleep(0))
+        declaring.set_result(None)
+        started = time.monotonic()
+        self.wait_for(stopping)
+        # Its reminder is saved rather than slept on until the deadline.
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(metrics.count('shutdown.cancelled'), 0)
+        self.assertEqual(len(self._store.take_app_state()['reminders']), 1)
+
+    def test_shutdown_and_restore(self):
+        metrics = bot.Metrics()
+        app = bot.DojoBotApp(self._bot, self._store, bot.Looper(self._loop), metrics)
+        # One conversation waiting for the topic, one session waiting for its reminder.
+        self.wait_for(app._handle(make_message_dict('/ci15')))
+        app._dispatch(make_message_dict('/ci30 hello', user_id=5678))
+        self.wait_for(asyncio.sleep(0))
+        self.wait_for(app.shutdown(1))
+        app._dispatch(make_message_dict('/co'))
+        self.assertEqual(len(app._inflight), 0)
+        self.assertEqual(metrics.count('shutdown.conversations'), 1)
+        self.assertEqual(metrics.count('shutdown.reminders'), 1)
+
+        restored = bot.DojoBotApp(self._bot, self._store, bot.Looper(self._loop))
+        restored.restore(self._store.take_app_state())
+        self.assertEqual(len(restored._inflight), 1)
+        self.wait_for(restored._handle(make_message_dict('Topic')))
+        self._bot.declare_checkin.assert_called_with(USER_ID, mock.ANY, mock.ANY)
+        self.assertEqual(self._store.take_app_state(), {})
+        self.wait_for(restored.shutdown(0))
+
 
 if __name__ == '__main__':
     unittest.main()